@@ -1,3 +1,4 @@
+using Grpc.Core;
 using Mediafeeder;
 using MediaFeeder.Data;
 using MediaFeeder.Tasks;
@@ -47,7 +48,9 @@ public sealed class YouTubeDownloadVideoConsumer(
         );
         logger.LogInformation("Will be saved to {}", path);
 
-        var downloadResponse = await downloaderClient.DownloadAsync(
+        // The download runs as a job on the downloader, so a dropped connection
+        // only means watching it again rather than losing the result
+        var job = await downloaderClient.StartJobAsync(
             new Mediafeeder.DownloadRequest
             {
                 VideoUrl = $"https://www.youtube.com/watch?v={video.VideoId}",
@@ -55,8 +58,15 @@ public sealed class YouTubeDownloadVideoConsumer(
             },
             cancellationToken: cancellationToken
         );
+        logger.LogInformation(
+            "Started download job {Job} for {Video}",
+            job.JobId,
+            context.Request.VideoId
+        );
+
+        var downloadResponse = await WatchJob(job, context.Request.VideoId, cancellationToken);
 
-        if (downloadResponse.Status == Status.Done)
+        if (downloadResponse.Status == Mediafeeder.Status.Done)
         {
             logger.LogInformation(
                 "Successfully downloaded {Video} to {Path}",
@@ -78,4 +88,56 @@ public sealed class YouTubeDownloadVideoConsumer(
         // New task library can't do this, and I don't think anything uses it anyway
         //await context.RespondAsync(downloadResponse);
     }
+
+    private async Task<Mediafeeder.DownloadReply> WatchJob(
+        Mediafeeder.Job job,
+        int videoId,
+        CancellationToken cancellationToken
+    )
+    {
+        var downloadResponse = job.Reply;
+        while (true)
+        {
+            try
+            {
+                using var call = downloaderClient.WatchJobs(
+                    new WatchJobsRequest { JobIds = { job.JobId }, ProgressInterval = 30 },
+                    cancellationToken: cancellationToken
+                );
+
+                await foreach (
+                    var update in call.ResponseStream.ReadAllAsync(cancellationToken)
+                )
+                {
+                    downloadResponse = update.Reply;
+                    if (downloadResponse.Status == Mediafeeder.Status.InProgress)
+                        logger.LogInformation(
+                            "Downloading {Video}: {Stage} {Progress:P1} of {TotalBytes} bytes at {Speed} B/s, ETA {Eta}s",
+                            videoId,
+                            downloadResponse.Stage,
+                            downloadResponse.Progress,
+                            downloadResponse.TotalBytes,
+                            downloadResponse.Speed,
+                            downloadResponse.Eta
+                        );
+                }
+
+                return downloadResponse;
+            }
+            catch (RpcException e)
+                when (e.StatusCode
+                        is StatusCode.Unavailable
+                            or StatusCode.DeadlineExceeded
+                            or StatusCode.Internal
+                )
+            {
+                logger.LogWarning(
+                    e,
+                    "Lost connection watching download job {Job}, reconnecting",
+                    job.JobId
+                );
+                await Task.Delay(TimeSpan.FromSeconds(10), cancellationToken);
+            }
+        }
+    }
 }
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""Bytes written postprocessing one download, with yt-dlp's chain and ours.
+
+Runs FFmpegEmbedSubtitle, ModifyChapters, FFmpegMetadata and EmbedThumbnail
+one after another, then SinglePassFFmpeg followed by EmbedThumbnail, without
+and with the uncut original it keeps for recutting. Each runs on a copy of
+the same video, with the same subtitles, chapters, SponsorBlock segments and
+thumbnail. Bytes written come from /proc/self/io, which counts
+ffmpeg's writes once it has exited.
+
+    python benchmarks/bench_postprocess.py [VIDEO] [--duration SECONDS]
+
+Without a VIDEO, a test pattern of `--duration` seconds is generated.
+Needs ffmpeg and ffprobe on the PATH.
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from typing import Any
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from options import YDL_DOWNLOAD_OPTS
+from postprocess import SinglePassFFmpegPP
+from yt_dlp import YoutubeDL
+from yt_dlp.postprocessor.embedthumbnail import EmbedThumbnailPP
+from yt_dlp.postprocessor.ffmpeg import (
+    FFmpegEmbedSubtitlePP,
+    FFmpegMetadataPP,
+    FFmpegPostProcessor,
+)
+from yt_dlp.postprocessor.modify_chapters import ModifyChaptersPP
+
+
+def _pp_args(key: str) -> dict[str, Any]:
+    for pp in YDL_DOWNLOAD_OPTS["postprocessors"]:
+        if pp["key"] == key:
+            return {k: v for k, v in pp.items() if k not in ("key", "when")}
+    raise KeyError(key)
+
+
+def _old_chain(ydl: YoutubeDL) -> list[Any]:
+    single_pass = _pp_args("SinglePassFFmpeg")
+    return [
+        FFmpegEmbedSubtitlePP(ydl, single_pass["already_have_subtitle"]),
+        ModifyChaptersPP(
+            ydl,
+            single_pass["remove_chapters_patterns"],
+            single_pass["remove_sponsor_segments"],
+            single_pass["remove_ranges"],
+            sponsorblock_chapter_title=single_pass["sponsorblock_chapter_title"],
+            force_keyframes=single_pass["force_keyframes"],
+        ),
+        FFmpegMetadataPP(ydl, single_pass["add_metadata"], single_pass["add_chapters"]),
+        EmbedThumbnailPP(ydl, **_pp_args("EmbedThumbnail")),
+    ]
+
+
+def _new_chain(ydl: YoutubeDL, keep_uncut: bool = False) -> list[Any]:
+    single_pass = SinglePassFFmpegPP(ydl, **_pp_args("SinglePassFFmpeg"))
+    single_pass.keep_uncut = keep_uncut
+    return [single_pass, EmbedThumbnailPP(ydl, **_pp_args("EmbedThumbnail"))]
+
+
+def _ffmpeg(*args: str) -> None:
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args], check=True
+    )
+
+
+def _make_video(path: str, duration: float) -> None:
+    _ffmpeg(
+        "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac", path,
+    )  # fmt: skip
+
+
+def _duration(path: str) -> float:
+    with YoutubeDL({"quiet": True}) as ydl:
+        metadata = FFmpegPostProcessor(ydl).get_metadata_object(path)
+    return float(metadata["format"]["duration"])
+
+
+def _make_inputs(directory: str, source: str) -> dict[str, Any]:
+    """Copy `source` into `directory` along with the files yt-dlp would fetch."""
+    video = os.path.join(directory, "video.mp4")
+    shutil.copyfile(source, video)
+    duration = _duration(video)
+
+    subtitle = os.path.join(directory, "video.en.vtt")
+    with open(subtitle, "w", encoding="utf-8") as f:
+        f.write("WEBVTT\n\n")
+        for i in range(int(duration) // 2):
+            f.write(f"00:{i * 2 // 60:02}:{i * 2 % 60:02}.000 --> ")
+            f.write(f"00:{(i * 2 + 1) // 60:02}:{(i * 2 + 1) % 60:02}.500\n")
+            f.write(f"Line {i}\n\n")
+
+    thumbnail = os.path.join(directory, "video.jpg")
+    _ffmpeg("-i", video, "-frames:v", "1", thumbnail)
+
+    quarter = duration / 4
+    return {
+        "id": "benchmark",
+        "title": "Postprocessing benchmark",
+        "ext": "mp4",
+        "filepath": video,
+        "duration": duration,
+        "__real_download": True,
+        "chapters": [
+            {
+                "start_time": i * quarter,
+                "end_time": (i + 1) * quarter,
+                "title": f"Part {i + 1}",
+            }
+            for i in range(4)
+        ],  # fmt: skip
+        "sponsorblock_chapters": [
+            {
+                "start_time": quarter * 1.5,
+                "end_time": quarter * 1.75,
+                "category": "sponsor",
+                "categories": [("sponsor", 0, 0)],
+                "title": "Sponsor",
+                "type": "skip",
+                "name": "Sponsor",
+                "category_names": ["Sponsor"],
+            },
+        ],  # fmt: skip
+        "requested_subtitles": {
+            "en": {"ext": "vtt", "filepath": subtitle, "name": "English"}
+        },
+        "thumbnails": [{"id": "0", "filepath": thumbnail}],
+    }
+
+
+def _written() -> int:
+    """Bytes written by this process and every child it has waited for."""
+    with open("/proc/self/io") as io:
+        for line in io:
+            name, value = line.split(":")
+            if name == "wchar":
+                return int(value)
+    raise RuntimeError("/proc/self/io has no wchar")
+
+
+def _run(
+    name: str,
+    chain: Callable[[YoutubeDL], list[Any]],
+    source: str,
+) -> None:
+    runs = 0
+    original = FFmpegPostProcessor.real_run_ffmpeg
+
+    def counted(self: FFmpegPostProcessor, *args: Any, **kwargs: Any) -> Any:
+        nonlocal runs
+        runs += 1
+        return original(self, *args, **kwargs)
+
+    with tempfile.TemporaryDirectory() as directory:
+        info: Any = _make_inputs(directory, source)
+        size = os.path.getsize(info["filepath"])
+
+        with YoutubeDL({"quiet": True, "noprogress": True}) as ydl:
+            pps = chain(ydl)
+            FFmpegPostProcessor.real_run_ffmpeg = counted
+            try:
+                before, started = _written(), time.perf_counter()
+                for pp in pps:
+                    files_to_delete, info = pp.run(info)
+                    for path in files_to_delete:
+                        os.remove(path)
+                elapsed = time.perf_counter() - started
+                written = _written() - before
+            finally:
+                FFmpegPostProcessor.real_run_ffmpeg = original
+
+        print(
+            f"{name:<12} {runs:>2} ffmpeg runs, {written / 1e6:8.1f} MB written "
+            f"({written / size:4.1f}x the video), {elapsed:6.2f}s"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare postprocessing writes")
+    parser.add_argument("video", nargs="?", help="video to postprocess")
+    parser.add_argument("--duration", type=float, default=120)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        source = args.video
+        if source is None:
+            source = os.path.join(directory, "source.mp4")
+            _make_video(source, args.duration)
+        print(f"{os.path.getsize(source) / 1e6:.1f} MB video")
+
+        _run("yt-dlp chain", _old_chain, source)
+        _run("single pass", _new_chain, source)
+        # Cut downloads also write their uncut original, unless KEEP_UNCUT is off
+        _run("keep uncut", lambda ydl: _new_chain(ydl, keep_uncut=True), source)
+
+
+if __name__ == "__main__":
+    main()
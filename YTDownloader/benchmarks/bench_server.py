@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""Throughput, latency, memory and writes of the whole server, with no network.
+
+Generates a test video and serves it from a stand-in video host on
+127.0.0.1, as progressive files, DASH and HLS. The real server is started
+with the stand-in extractor from benchmarks/yt_dlp_plugins, then driven
+through About, Download and a concurrent mix of both.
+
+    python benchmarks/bench_server.py [SCENARIO ...] [--jobs N] [--concurrency N]
+        [--executor thread|process] [--duration SECONDS] [--latency MS]
+
+Each scenario reports jobs a second, p50 and p99 latency, peak RSS of the
+server and its worker processes, and bytes written per job. As in
+bench_postprocess.py, bytes written come from /proc/<pid>/io, which counts
+ffmpeg's writes once it has exited. Needs ffmpeg on the PATH, and the
+downloadServer_pb2 modules generated next to main.py, as the Dockerfile
+does.
+"""
+
+import argparse
+import functools
+import http.server
+import itertools
+import json
+import math
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from concurrent import futures
+from typing import Any
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, SERVER_DIR)
+
+import downloadServer_pb2  # noqa: E402
+import downloadServer_pb2_grpc  # noqa: E402
+import grpc  # noqa: E402
+from grpc_health.v1 import health_pb2, health_pb2_grpc  # noqa: E402
+
+SCENARIOS = ("about", "about-cached", "progressive", "dash", "hls", "mix")
+
+# Seconds between keyframes, and so the length of each DASH and HLS fragment
+FRAGMENT_SECONDS = 2
+
+
+def _ffmpeg(*args: str) -> None:
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args], check=True
+    )
+
+
+def _make_media(directory: str, duration: float) -> dict[str, Any]:
+    """Write the files the stand-in host serves, and return its metadata."""
+    source = os.path.join(directory, "source.mp4")
+    _ffmpeg(
+        "-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={duration}",
+        "-f", "lavfi", "-i", f"sine=frequency=440:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", str(30 * FRAGMENT_SECONDS),
+        "-c:a", "aac", source,
+    )  # fmt: skip
+
+    progressive = os.path.join(directory, "progressive")
+    os.makedirs(progressive)
+    _ffmpeg("-i", source, "-map", "0:v", "-c", "copy", "-movflags", "+faststart",
+            os.path.join(progressive, "video.mp4"))  # fmt: skip
+    _ffmpeg("-i", source, "-map", "0:a", "-c", "copy", "-movflags", "+faststart",
+            os.path.join(progressive, "audio.m4a"))  # fmt: skip
+
+    dash = os.path.join(directory, "dash")
+    os.makedirs(dash)
+    _ffmpeg(
+        "-i", source, "-map", "0:v", "-map", "0:a", "-c", "copy",
+        "-f", "dash", "-seg_duration", str(FRAGMENT_SECONDS),
+        "-use_template", "1", "-use_timeline", "0",
+        os.path.join(dash, "manifest.mpd"),
+    )  # fmt: skip
+
+    hls = os.path.join(directory, "hls")
+    os.makedirs(hls)
+    for stream, selector in (("video", "0:v"), ("audio", "0:a")):
+        _ffmpeg(
+            "-i", source, "-map", selector, "-c", "copy",
+            "-f", "hls", "-hls_time", str(FRAGMENT_SECONDS),
+            "-hls_playlist_type", "vod", "-hls_segment_type", "fmp4",
+            "-hls_fmp4_init_filename", f"{stream}-init.mp4",
+            "-hls_segment_filename", os.path.join(hls, f"{stream}-%d.m4s"),
+            os.path.join(hls, f"{stream}.m3u8"),
+        )  # fmt: skip
+
+    _ffmpeg("-i", source, "-frames:v", "1", os.path.join(directory, "thumbnail.jpg"))
+    with open(os.path.join(directory, "subtitles.en.vtt"), "w") as f:
+        f.write("WEBVTT\n\n")
+        for i in range(int(duration) // 2):
+            f.write(f"00:{i * 2 // 60:02}:{i * 2 % 60:02}.000 --> ")
+            f.write(f"00:{(i * 2 + 1) // 60:02}:{(i * 2 + 1) % 60:02}.500\n")
+            f.write(f"Line {i}\n\n")
+
+    sizes = {
+        stream: os.path.getsize(os.path.join(progressive, name))
+        for stream, name in (("video", "video.mp4"), ("audio", "audio.m4a"))
+    }
+    quarter = duration / 4
+    return {
+        "title": "Server benchmark",
+        "description": "A test pattern",
+        "duration": int(duration),
+        "vcodec": "avc1.64001f",
+        "acodec": "mp4a.40.2",
+        "width": 1280,
+        "height": 720,
+        "sizes": sizes,
+        "timestamp": int(time.time()),
+        "upload_date": time.strftime("%Y%m%d"),
+        "chapters": [
+            {
+                "start_time": i * quarter,
+                "end_time": (i + 1) * quarter,
+                "title": f"Part {i + 1}",
+            }
+            for i in range(4)
+        ],
+    }
+
+
+class _Host(http.server.SimpleHTTPRequestHandler):
+    """Serves /media from a directory, and the metadata for any video at /api."""
+
+    metadata = b""
+    latency = 0.0
+
+    def do_GET(self) -> None:
+        time.sleep(self.latency)
+        if self.path.startswith("/api/"):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(self.metadata)))
+            self.end_headers()
+            self.wfile.write(self.metadata)
+        elif self.path.startswith("/media/"):
+            self.path = self.path.removeprefix("/media")
+            super().do_GET()
+        else:
+            self.send_error(404)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+class _HostServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request: Any, client_address: Any) -> None:
+        # Clients hanging up part way through a file are nothing to report
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def _start_host(directory: str, metadata: dict[str, Any], latency: float) -> str:
+    handler = type(
+        "Host",
+        (_Host,),
+        {"metadata": json.dumps(metadata).encode(), "latency": latency},
+    )
+    host = _HostServer(
+        ("127.0.0.1", 0), functools.partial(handler, directory=directory)
+    )
+    threading.Thread(target=host.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{host.server_address[1]}"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_server(
+    args: argparse.Namespace, origin: str, log: Any
+) -> tuple[subprocess.Popen[bytes], str]:
+    address = f"127.0.0.1:{_free_port()}"
+    plugins = os.path.dirname(os.path.abspath(__file__))
+    env = {
+        **os.environ,
+        "LISTEN_ADDRESS": address,
+        "PYTHONPATH": os.pathsep.join(
+            filter(None, [plugins, os.environ.get("PYTHONPATH")])
+        ),
+        "JOB_EXECUTOR": args.executor,
+        "MAX_DOWNLOADS": str(args.concurrency),
+        "MAX_DOWNLOADS_PER_HOST": str(args.concurrency),
+        "MAX_QUEUED_DOWNLOADS": str(args.jobs),
+        # Nothing the server does may reach the internet
+        "SPONSORBLOCK_API": origin,
+        "DOWNLOAD_JOURNAL_PATH": "",
+        "ABOUT_CACHE_PATH": "",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "main.py"], cwd=SERVER_DIR, env=env, stdout=log, stderr=log
+    )
+
+    health = health_pb2_grpc.HealthStub(grpc.insecure_channel(address))
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline and server.poll() is None:
+        try:
+            reply = health.Check(health_pb2.HealthCheckRequest(), timeout=1)
+            if reply.status == health_pb2.HealthCheckResponse.SERVING:
+                return server, address
+        except grpc.RpcError:
+            time.sleep(0.2)
+
+    server.kill()
+    raise RuntimeError(f"The server did not start, see {log.name}")
+
+
+def _tree(pid: int) -> list[int]:
+    """`pid` and every process descended from it."""
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                parent = int(stat.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    found, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        found.append(current)
+        pending.extend(children.get(current, []))
+    return found
+
+
+def _read_proc(pid: int, name: str) -> str:
+    try:
+        with open(f"/proc/{pid}/{name}") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+
+def _rss(pids: list[int]) -> int:
+    statms = [_read_proc(pid, "statm") for pid in pids]
+    pages = sum(int(statm.split()[1]) for statm in statms if statm)
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def _written(pids: list[int]) -> int:
+    """Bytes written by `pids`, and every child they have waited for."""
+    total = 0
+    for pid in pids:
+        for line in _read_proc(pid, "io").splitlines():
+            name, value = line.split(":")
+            if name == "wchar":
+                total += int(value)
+    return total
+
+
+class _PeakRSS:
+    """Samples the RSS of a process tree from a background thread."""
+
+    def __init__(self, pid: int, interval: float = 0.05) -> None:
+        self._pid = pid
+        self._interval = interval
+        self._stopped = threading.Event()
+        self.peak = 0
+        threading.Thread(target=self._sample, daemon=True).start()
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self._interval):
+            self.peak = max(self.peak, _rss(_tree(self._pid)))
+
+    def reset(self) -> None:
+        self.peak = _rss(_tree(self._pid))
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+Job = Callable[[], bool]
+
+
+def _about(stub: Any, url: str, no_cache: bool) -> Job:
+    def run() -> bool:
+        stub.About(downloadServer_pb2.AboutRequest(VideoUrl=url, NoCache=no_cache))
+        return True
+
+    return run
+
+
+def _download(stub: Any, url: str, output_path: str) -> Job:
+    def run() -> bool:
+        reply = stub.Download(
+            downloadServer_pb2.DownloadRequest(VideoUrl=url, OutputPath=output_path)
+        )
+        return reply.Status == downloadServer_pb2.DONE
+
+    return run
+
+
+def _jobs(stub: Any, scenario: str, origin: str, out: str, count: int) -> list[Job]:
+    def job(kind: str, i: int) -> Job:
+        video_id = f"{scenario}-{i}"
+        match kind:
+            case "about":
+                return _about(stub, f"{origin}/watch/dash/{video_id}", True)
+            case "about-cached":
+                return _about(stub, f"{origin}/watch/dash/cached", False)
+            case _:
+                return _download(
+                    stub,
+                    f"{origin}/watch/{kind}/{video_id}",
+                    os.path.join(out, f"{video_id}.%(ext)s"),
+                )
+
+    if scenario == "mix":
+        kinds = itertools.cycle(("about", "progressive", "about-cached", "dash", "hls"))
+        return [job(kind, i) for i, kind in zip(range(count), kinds)]
+    return [job(scenario, i) for i in range(count)]
+
+
+def _timed(job: Job) -> tuple[float, bool]:
+    started = time.perf_counter()
+    try:
+        ok = job()
+    except grpc.RpcError:
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+def _run(
+    name: str,
+    jobs: list[Job],
+    concurrency: int,
+    server: subprocess.Popen[bytes],
+    peak_rss: _PeakRSS,
+) -> None:
+    peak_rss.reset()
+    before, started = _written(_tree(server.pid)), time.perf_counter()
+    with futures.ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(_timed, jobs))
+    elapsed = time.perf_counter() - started
+    written = _written(_tree(server.pid)) - before
+
+    latencies = [latency for latency, _ in results]
+    failed = sum(not ok for _, ok in results)
+    print(
+        f"{name:<13} {len(jobs) / elapsed:7.2f} jobs/s, "
+        f"p50 {_percentile(latencies, 50) * 1000:7.0f} ms, "
+        f"p99 {_percentile(latencies, 99) * 1000:7.0f} ms, "
+        f"peak RSS {peak_rss.peak / 1e6:6.0f} MB, "
+        f"{written / len(jobs) / 1e6:7.1f} MB written/job"
+        + (f", {failed} failed" if failed else "")
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the gRPC server")
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    parser.add_argument("--jobs", type=int, default=20, help="jobs per scenario")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--executor", choices=("thread", "process"), default="thread")
+    parser.add_argument("--duration", type=float, default=30, help="video seconds")
+    parser.add_argument(
+        "--latency", type=float, default=0, help="ms the host waits per request"
+    )
+    args = parser.parse_args()
+    for scenario in args.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        media = os.path.join(directory, "media")
+        os.makedirs(media)
+        metadata = _make_media(media, args.duration)
+        size = sum(metadata["sizes"].values())
+        print(f"{args.duration:.0f}s video, {size / 1e6:.1f} MB")
+        origin = _start_host(media, metadata, args.latency / 1000)
+
+        out = os.path.join(directory, "out")
+        with open(os.path.join(directory, "server.log"), "wb") as log:
+            server, address = _start_server(args, origin, log)
+            peak_rss = _PeakRSS(server.pid)
+            try:
+                stub = downloadServer_pb2_grpc.YTDownloaderStub(
+                    grpc.insecure_channel(address)
+                )
+                # Imports and the like, left out of the first scenario
+                os.makedirs(out)
+                _timed(
+                    _download(
+                        stub,
+                        f"{origin}/watch/progressive/warm-up",
+                        os.path.join(out, "warm-up.%(ext)s"),
+                    )
+                )
+                for scenario in args.scenarios or SCENARIOS:
+                    shutil.rmtree(out)
+                    os.makedirs(out)
+                    jobs = _jobs(stub, scenario, origin, out, args.jobs)
+                    _run(scenario, jobs, args.concurrency, server, peak_rss)
+            finally:
+                peak_rss.stop()
+                # Lets it shut its worker processes down
+                server.send_signal(signal.SIGINT)
+                server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""Stand-in extractor for the video host bench_server.py runs.
+
+yt-dlp loads it as a plugin from any yt_dlp_plugins package on sys.path,
+so the server and its worker processes pick it up from PYTHONPATH.
+"""
+
+from typing import Any
+
+from yt_dlp.extractor.common import InfoExtractor
+
+
+class FakeHostIE(InfoExtractor):
+    _VALID_URL = (
+        r"(?P<origin>http://127\.0\.0\.1:\d+)/watch/"
+        r"(?P<kind>progressive|dash|hls)/(?P<id>[\w-]+)"
+    )
+
+    def _real_extract(self, url: str) -> dict[str, Any]:
+        parts = self._match_valid_url(url)
+        origin, kind, video_id = parts.group(  # pyright: ignore[reportOptionalMemberAccess]
+            "origin", "kind", "id"
+        )
+        media = f"{origin}/media"
+        # The page fetch a real extractor makes, with a server side delay if set
+        info = self._download_json(f"{origin}/api/{video_id}", video_id)
+
+        match kind:
+            case "dash":
+                formats = self._extract_mpd_formats(
+                    f"{media}/dash/manifest.mpd", video_id, mpd_id="dash"
+                )
+                # Sizes as YouTube gives them, which About reports
+                for f in formats:
+                    stream = "audio" if f.get("vcodec") == "none" else "video"
+                    f["filesize_approx"] = info["sizes"][stream]
+            case "hls":
+                formats = [
+                    {
+                        "format_id": f"hls-{stream}",
+                        "url": f"{media}/hls/{stream}.m3u8",
+                        "protocol": "m3u8_native",
+                        "ext": "mp4" if stream == "video" else "m4a",
+                        "vcodec": info["vcodec"] if stream == "video" else "none",
+                        "acodec": info["acodec"] if stream == "audio" else "none",
+                        "filesize_approx": info["sizes"][stream],
+                    }
+                    for stream in ("video", "audio")
+                ]
+            case _:
+                formats = [
+                    {
+                        "format_id": "video",
+                        "url": f"{media}/progressive/video.mp4",
+                        "ext": "mp4",
+                        "vcodec": info["vcodec"],
+                        "acodec": "none",
+                        "width": info["width"],
+                        "height": info["height"],
+                        "filesize": info["sizes"]["video"],
+                    },
+                    {
+                        "format_id": "audio",
+                        "url": f"{media}/progressive/audio.m4a",
+                        "ext": "m4a",
+                        "vcodec": "none",
+                        "acodec": info["acodec"],
+                        "filesize": info["sizes"]["audio"],
+                    },
+                ]
+
+        return {
+            "id": video_id,
+            "title": f"{info['title']} {video_id}",
+            "description": info["description"],
+            "duration": info["duration"],
+            "formats": formats,
+            "thumbnail": f"{media}/thumbnail.jpg",
+            "automatic_captions": {
+                "en": [{"url": f"{media}/subtitles.en.vtt", "ext": "vtt"}]
+            },
+            "chapters": info["chapters"],
+            "channel_id": "fakehost",
+            "age_limit": 0,
+            "categories": ["Benchmarks"],
+            "tags": ["benchmark"],
+            "playable_in_embed": True,
+            "timestamp": info["timestamp"],
+            "upload_date": info["upload_date"],
+            "view_count": 0,
+            "availability": "public",
+            "live_status": "not_live",
+        }
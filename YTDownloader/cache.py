@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import downloadServer_pb2
+
+
+class AboutCache:
+    """Caches About replies by video, in memory and optionally in a SQLite file.
+
+    Fields like the title, duration or channel hardly ever change, while view
+    counts and availability do, so each entry has two lifetimes: it answers
+    any request for `volatile_ttl` seconds after it was fetched, and requests
+    that only need the static fields for `static_ttl` seconds.
+    """
+
+    # Rows written to disk between sweeps of expired and least recently used rows
+    _PRUNE_EVERY = 100
+
+    def __init__(
+        self,
+        max_entries: int,
+        static_ttl: float,
+        volatile_ttl: float,
+        path: str | None = None,
+        max_disk_entries: int = 0,
+    ) -> None:
+        self.max_entries = max_entries
+        self.static_ttl = static_ttl
+        self.volatile_ttl = volatile_ttl
+        self.max_disk_entries = max_disk_entries
+
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[str, downloadServer_pb2.AboutReply] = OrderedDict()
+        self._db: sqlite3.Connection | None = None
+        self._writes = 0
+
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS about ("
+                "key TEXT PRIMARY KEY, fetched REAL, used REAL, reply BLOB)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS about_used ON about (used)")
+            self._prune()
+
+    def get(
+        self, key: str, static_only: bool = False
+    ) -> downloadServer_pb2.AboutReply | None:
+        ttl = self.static_ttl if static_only else self.volatile_ttl
+        now = time.time()
+
+        with self._lock:
+            reply = self._memory.get(key)
+            if reply is not None:
+                self._memory.move_to_end(key)
+            else:
+                reply = self._load(key, now)
+                if reply is None:
+                    return None
+                self._remember(key, reply)
+
+            if now - reply.FetchedAt > ttl:
+                return None
+
+            cached = downloadServer_pb2.AboutReply()
+            cached.CopyFrom(reply)
+            return cached
+
+    def put(self, key: str, reply: downloadServer_pb2.AboutReply) -> None:
+        """Store `reply`, which must have FetchedAt set."""
+        stored = downloadServer_pb2.AboutReply()
+        stored.CopyFrom(reply)
+        # Large, and only useful while fresh
+        stored.ClearField("Extraction")
+        # Timings are of the call that extracted, not of those served from here
+        stored.ClearField("Timings")
+
+        with self._lock:
+            self._remember(key, stored)
+
+            if self._db is not None:
+                with self._db:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO about VALUES (?, ?, ?, ?)",
+                        (
+                            key,
+                            stored.FetchedAt,
+                            time.time(),
+                            stored.SerializeToString(),
+                        ),
+                    )
+                self._writes += 1
+                if self._writes % self._PRUNE_EVERY == 0:
+                    self._prune()
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+
+    def _remember(self, key: str, reply: downloadServer_pb2.AboutReply) -> None:
+        self._memory[key] = reply
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _load(self, key: str, now: float) -> downloadServer_pb2.AboutReply | None:
+        if self._db is None:
+            return None
+
+        row = self._db.execute(
+            "SELECT reply FROM about WHERE key = ? AND fetched >= ?",
+            (key, now - self.static_ttl),
+        ).fetchone()
+        if row is None:
+            return None
+
+        with self._db:
+            self._db.execute("UPDATE about SET used = ? WHERE key = ?", (now, key))
+        return downloadServer_pb2.AboutReply.FromString(row[0])
+
+    def _prune(self) -> None:
+        assert self._db is not None
+        with self._db:
+            self._db.execute(
+                "DELETE FROM about WHERE fetched < ?", (time.time() - self.static_ttl,)
+            )
+            if self.max_disk_entries > 0:
+                self._db.execute(
+                    "DELETE FROM about WHERE key NOT IN "
+                    "(SELECT key FROM about ORDER BY used DESC LIMIT ?)",
+                    (self.max_disk_entries,),
+                )
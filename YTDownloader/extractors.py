@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import functools
+from urllib.parse import urlparse
+
+import yt_dlp.extractor
+from yt_dlp.extractor.common import InfoExtractor
+
+# URLs whose extractor is remembered. Finding it tries every extractor's URL
+# pattern in turn, and is done for each request on the server's event loop
+EXTRACTOR_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=EXTRACTOR_CACHE_SIZE)
+def extractor_for(url: str) -> type[InfoExtractor] | None:
+    """The extractor yt-dlp would pick for `url`, ignoring the generic fallback."""
+    for ie in yt_dlp.extractor.gen_extractor_classes():
+        if ie.ie_key() != "Generic" and ie.suitable(url):
+            return ie
+    return None
+
+
+def extractor_name(url: str) -> str:
+    """The extractor yt-dlp would use for `url`, by name."""
+    ie = extractor_for(url)
+    return ie.ie_key() if ie is not None else "Generic"
+
+
+def video_key(url: str) -> str:
+    """A stable key for the video at `url`, the same for every URL form of it."""
+    ie = extractor_for(url)
+    if ie is not None:
+        video_id = ie.get_temp_id(url)
+        if video_id:
+            return f"{ie.ie_key()}:{video_id}"
+    return url
+
+
+def limit_key(url: str) -> str:
+    """The key per-host download limits are counted against.
+
+    This is the extractor yt-dlp would use for the URL, so youtube.com and
+    youtu.be links share a limit, falling back to the host name for anything
+    only the generic extractor understands.
+    """
+    ie = extractor_for(url)
+    if ie is not None:
+        return ie.ie_key()
+    return urlparse(url).hostname or ""
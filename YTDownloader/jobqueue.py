@@ -0,0 +1,570 @@
+# -*- coding: utf-8 -*-
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, replace
+from typing import Any, Protocol
+
+import downloadServer_pb2
+from extractors import video_key
+from registry import Job
+from scheduler import SchedulerFull
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class QueuedJob:
+    id: str
+    request: downloadServer_pb2.DownloadRequest
+    # The last reply its node reported, or its final one
+    reply: downloadServer_pb2.DownloadReply
+    # The node holding its lease, and until when in Unix time
+    node: str | None
+    lease_until: float | None
+    attempts: int
+    cancelled: bool
+    finished: bool
+    # Increases with every change, so watchers can tell what they have seen
+    version: int
+
+    def message(self) -> downloadServer_pb2.Job:
+        request = downloadServer_pb2.DownloadRequest()
+        request.CopyFrom(self.request)
+        # Large, and no use to anyone watching the job
+        request.ClearField("Extraction")
+        return downloadServer_pb2.Job(JobId=self.id, Request=request, Reply=self.reply)
+
+
+class JobQueue(Protocol):
+    """Download jobs shared between servers, which claim them one at a time.
+
+    A claim is a lease, which the node renews while it works on the job.
+    Jobs whose lease runs out, because their node died or hung, go to the
+    next node to claim one, up to `max_attempts` claims in all.
+    """
+
+    def enqueue(self, request: downloadServer_pb2.DownloadRequest) -> QueuedJob:
+        """Add a job, or return the unfinished one for the same download.
+
+        Two nodes must never run the same download, as they would write to
+        the same partial files.
+        """
+        ...
+
+    def find(self, video_url: str, output_path: str) -> QueuedJob | None:
+        """The unfinished job downloading `video_url` into `output_path`, if any."""
+        ...
+
+    def claim(self, node: str, lease: float) -> QueuedJob | None:
+        """Lease the oldest job nobody holds to `node` for `lease` seconds."""
+        ...
+
+    def renew(
+        self,
+        job_id: str,
+        node: str,
+        lease: float,
+        reply: downloadServer_pb2.DownloadReply,
+    ) -> QueuedJob | None:
+        """Extend `node`'s lease and store its progress, None if it lost the lease."""
+        ...
+
+    def finish(
+        self, job_id: str, node: str, reply: downloadServer_pb2.DownloadReply
+    ) -> None: ...
+
+    def release(self, job_id: str, node: str) -> None:
+        """Hand a job back, for another node to claim without waiting out the lease."""
+        ...
+
+    def cancel(self, job_id: str) -> QueuedJob | None:
+        """Cancel a job, at once if unclaimed, or when its node next renews."""
+        ...
+
+    def get(self, job_id: str) -> QueuedJob | None: ...
+
+    def close(self) -> None: ...
+
+
+def _queued_reply() -> downloadServer_pb2.DownloadReply:
+    return downloadServer_pb2.DownloadReply(
+        Status=downloadServer_pb2.STARTING, Stage=downloadServer_pb2.QUEUED
+    )
+
+
+def _claimable(job: QueuedJob, now: float) -> bool:
+    return not job.finished and (job.lease_until is None or job.lease_until < now)
+
+
+def _unclaimed_reply(
+    job: QueuedJob, max_attempts: int
+) -> downloadServer_pb2.DownloadReply | None:
+    """The final reply for a claimable job that should not run again, if any."""
+    if job.cancelled:
+        return downloadServer_pb2.DownloadReply(Status=downloadServer_pb2.CANCELLED)
+    if job.attempts >= max_attempts:
+        logger.warning(
+            "Giving up on %s after %s attempts", job.request.VideoUrl, job.attempts
+        )
+        return downloadServer_pb2.DownloadReply(
+            Status=downloadServer_pb2.TEMPORARY_ERROR
+        )
+    return None
+
+
+class MemoryJobQueue:
+    """A `JobQueue` held in this process, standing in for a shared one."""
+
+    def __init__(self, max_attempts: int, retention: float) -> None:
+        self.max_attempts = max_attempts
+        self.retention = retention
+
+        self._lock = threading.Lock()
+        # Oldest first, as dicts keep insertion order
+        self._jobs: dict[str, QueuedJob] = {}
+        self._finished_at: dict[str, float] = {}
+        # The video key and output path of each job, telling the same download
+        self._downloads: dict[str, tuple[str, str]] = {}
+
+    def enqueue(self, request: downloadServer_pb2.DownloadRequest) -> QueuedJob:
+        stored = downloadServer_pb2.DownloadRequest()
+        stored.CopyFrom(request)
+        key = video_key(request.VideoUrl)
+        job = QueuedJob(
+            id=uuid.uuid4().hex,
+            request=stored,
+            reply=_queued_reply(),
+            node=None,
+            lease_until=None,
+            attempts=0,
+            cancelled=False,
+            finished=False,
+            version=0,
+        )
+        with self._lock:
+            self._prune()
+            running = self._find(key, request.OutputPath)
+            if running is not None:
+                return running
+            self._jobs[job.id] = job
+            self._downloads[job.id] = (key, request.OutputPath)
+        return job
+
+    def find(self, video_url: str, output_path: str) -> QueuedJob | None:
+        key = video_key(video_url)
+        with self._lock:
+            return self._find(key, output_path)
+
+    def claim(self, node: str, lease: float) -> QueuedJob | None:
+        now = time.time()
+        with self._lock:
+            for job in list(self._jobs.values()):
+                if not _claimable(job, now):
+                    continue
+                final = _unclaimed_reply(job, self.max_attempts)
+                if final is not None:
+                    self._finish(job, final)
+                    continue
+                return self._update(
+                    job, node=node, lease_until=now + lease, attempts=job.attempts + 1
+                )
+        return None
+
+    def renew(
+        self,
+        job_id: str,
+        node: str,
+        lease: float,
+        reply: downloadServer_pb2.DownloadReply,
+    ) -> QueuedJob | None:
+        with self._lock:
+            job = self._held(job_id, node)
+            if job is None:
+                return None
+            return self._update(job, lease_until=time.time() + lease, reply=reply)
+
+    def finish(
+        self, job_id: str, node: str, reply: downloadServer_pb2.DownloadReply
+    ) -> None:
+        with self._lock:
+            job = self._held(job_id, node)
+            if job is not None:
+                self._finish(job, reply)
+
+    def release(self, job_id: str, node: str) -> None:
+        with self._lock:
+            job = self._held(job_id, node)
+            if job is not None:
+                self._update(job, node=None, lease_until=None)
+
+    def cancel(self, job_id: str) -> QueuedJob | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            if job.node is None:
+                return self._finish(
+                    job,
+                    downloadServer_pb2.DownloadReply(
+                        Status=downloadServer_pb2.CANCELLED
+                    ),
+                )
+            return self._update(job, cancelled=True)
+
+    def get(self, job_id: str) -> QueuedJob | None:
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def close(self) -> None:
+        pass
+
+    def _find(self, key: str, output_path: str) -> QueuedJob | None:
+        for job_id, download in self._downloads.items():
+            job = self._jobs[job_id]
+            if not job.finished and download == (key, output_path):
+                return job
+        return None
+
+    def _held(self, job_id: str, node: str) -> QueuedJob | None:
+        job = self._jobs.get(job_id)
+        if job is None or job.finished or job.node != node:
+            return None
+        return job
+
+    def _update(self, job: QueuedJob, **changes: Any) -> QueuedJob:
+        updated = replace(job, version=job.version + 1, **changes)
+        self._jobs[job.id] = updated
+        return updated
+
+    def _finish(
+        self, job: QueuedJob, reply: downloadServer_pb2.DownloadReply
+    ) -> QueuedJob:
+        self._finished_at[job.id] = time.time()
+        return self._update(
+            job, node=None, lease_until=None, reply=reply, finished=True
+        )
+
+    def _prune(self) -> None:
+        expired = time.time() - self.retention
+        for job_id, finished_at in list(self._finished_at.items()):
+            if finished_at < expired:
+                del self._finished_at[job_id]
+                del self._jobs[job_id]
+                del self._downloads[job_id]
+
+
+class SQLiteJobQueue:
+    """A `JobQueue` in a SQLite file, which servers on several hosts can share.
+
+    Leases are in Unix time, so the hosts' clocks need to agree to well
+    within a lease.
+    """
+
+    _COLUMNS = (
+        "id, request, reply, node, lease_until, attempts, cancelled, "
+        "finished IS NOT NULL, version"
+    )
+
+    def __init__(self, path: str, max_attempts: int, retention: float) -> None:
+        self.max_attempts = max_attempts
+        self.retention = retention
+
+        self._lock = threading.Lock()
+        # Transactions are begun by hand, so claims can take the write lock
+        # before looking. WAL needs shared memory, which a network filesystem
+        # has no way of sharing between hosts, so the default journal is kept.
+        self._db = sqlite3.connect(
+            path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, request BLOB NOT NULL, reply BLOB NOT NULL, "
+            "node TEXT, lease_until REAL, attempts INTEGER NOT NULL DEFAULT 0, "
+            "cancelled INTEGER NOT NULL DEFAULT 0, finished REAL, "
+            "enqueued REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0, "
+            "video_key TEXT, output_path TEXT)"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+        for column in ("video_key", "output_path"):
+            if column not in columns:
+                self._db.execute(f"ALTER TABLE jobs ADD COLUMN {column} TEXT")
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_waiting ON jobs (finished, enqueued)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_unfinished ON jobs "
+            "(output_path, video_key) WHERE finished IS NULL"
+        )
+
+    def enqueue(self, request: downloadServer_pb2.DownloadRequest) -> QueuedJob:
+        job_id = uuid.uuid4().hex
+        reply = _queued_reply()
+        key = video_key(request.VideoUrl)
+        now = time.time()
+        with self._transaction():
+            self._db.execute(
+                "DELETE FROM jobs WHERE finished < ?", (now - self.retention,)
+            )
+            running = self._find(key, request.OutputPath)
+            if running is not None:
+                return running
+            self._db.execute(
+                "INSERT INTO jobs (id, request, reply, enqueued, video_key, "
+                "output_path) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    request.SerializeToString(),
+                    reply.SerializeToString(),
+                    now,
+                    key,
+                    request.OutputPath,
+                ),
+            )
+            return self._get(job_id)  # pyright: ignore[reportReturnType]
+
+    def find(self, video_url: str, output_path: str) -> QueuedJob | None:
+        key = video_key(video_url)
+        with self._lock:
+            return self._find(key, output_path)
+
+    def claim(self, node: str, lease: float) -> QueuedJob | None:
+        now = time.time()
+        with self._transaction():
+            while True:
+                row = self._db.execute(
+                    f"SELECT {self._COLUMNS} FROM jobs WHERE finished IS NULL "
+                    "AND (lease_until IS NULL OR lease_until < ?) "
+                    "ORDER BY enqueued LIMIT 1",
+                    (now,),
+                ).fetchone()
+                if row is None:
+                    return None
+                job = self._job(row)
+                final = _unclaimed_reply(job, self.max_attempts)
+                if final is None:
+                    self._db.execute(
+                        "UPDATE jobs SET node = ?, lease_until = ?, "
+                        "attempts = attempts + 1, version = version + 1 WHERE id = ?",
+                        (node, now + lease, job.id),
+                    )
+                    return self._get(job.id)
+                self._finish(job.id, final)
+
+    def renew(
+        self,
+        job_id: str,
+        node: str,
+        lease: float,
+        reply: downloadServer_pb2.DownloadReply,
+    ) -> QueuedJob | None:
+        with self._transaction():
+            held = self._db.execute(
+                "UPDATE jobs SET lease_until = ?, reply = ?, version = version + 1 "
+                "WHERE id = ? AND node = ? AND finished IS NULL",
+                (time.time() + lease, reply.SerializeToString(), job_id, node),
+            ).rowcount
+            return self._get(job_id) if held else None
+
+    def finish(
+        self, job_id: str, node: str, reply: downloadServer_pb2.DownloadReply
+    ) -> None:
+        with self._transaction():
+            if self._held(job_id, node):
+                self._finish(job_id, reply)
+
+    def release(self, job_id: str, node: str) -> None:
+        with self._transaction():
+            self._db.execute(
+                "UPDATE jobs SET node = NULL, lease_until = NULL, "
+                "version = version + 1 "
+                "WHERE id = ? AND node = ? AND finished IS NULL",
+                (job_id, node),
+            )
+
+    def cancel(self, job_id: str) -> QueuedJob | None:
+        with self._transaction():
+            job = self._get(job_id)
+            if job is None or job.finished:
+                return job
+            if job.node is None:
+                self._finish(
+                    job_id,
+                    downloadServer_pb2.DownloadReply(
+                        Status=downloadServer_pb2.CANCELLED
+                    ),
+                )
+            else:
+                self._db.execute(
+                    "UPDATE jobs SET cancelled = 1, version = version + 1 WHERE id = ?",
+                    (job_id,),
+                )
+            return self._get(job_id)
+
+    def get(self, job_id: str) -> QueuedJob | None:
+        with self._lock:
+            return self._get(job_id)
+
+    def close(self) -> None:
+        self._db.close()
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def _get(self, job_id: str) -> QueuedJob | None:
+        row = self._db.execute(
+            f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return self._job(row) if row is not None else None
+
+    def _find(self, key: str, output_path: str) -> QueuedJob | None:
+        row = self._db.execute(
+            f"SELECT {self._COLUMNS} FROM jobs WHERE finished IS NULL "
+            "AND output_path = ? AND video_key = ? ORDER BY enqueued LIMIT 1",
+            (output_path, key),
+        ).fetchone()
+        return self._job(row) if row is not None else None
+
+    def _held(self, job_id: str, node: str) -> bool:
+        return (
+            self._db.execute(
+                "SELECT 1 FROM jobs WHERE id = ? AND node = ? AND finished IS NULL",
+                (job_id, node),
+            ).fetchone()
+            is not None
+        )
+
+    def _finish(self, job_id: str, reply: downloadServer_pb2.DownloadReply) -> None:
+        self._db.execute(
+            "UPDATE jobs SET node = NULL, lease_until = NULL, reply = ?, "
+            "finished = ?, version = version + 1 WHERE id = ?",
+            (reply.SerializeToString(), time.time(), job_id),
+        )
+
+    @staticmethod
+    def _job(row: tuple[Any, ...]) -> QueuedJob:
+        job_id, request, reply, node, lease_until, attempts = row[:6]
+        return QueuedJob(
+            id=job_id,
+            request=downloadServer_pb2.DownloadRequest.FromString(request),
+            reply=downloadServer_pb2.DownloadReply.FromString(reply),
+            node=node,
+            lease_until=lease_until,
+            attempts=attempts,
+            cancelled=bool(row[6]),
+            finished=bool(row[7]),
+            version=row[8],
+        )
+
+
+class QueueWorker:
+    """Claims jobs from a `JobQueue` whenever `has_room`, and runs them here.
+
+    Each lease is renewed a third of the way through, with the job's
+    progress. A job whose lease is lost, to a node that thought this one
+    had died, is cancelled here, leaving its partial files to the other.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        node: str,
+        lease: float,
+        poll_interval: float,
+        has_room: Callable[[], bool],
+        start: Callable[[QueuedJob], Job],
+    ) -> None:
+        self._queue = queue
+        self._node = node
+        self._lease = lease
+        self._poll_interval = poll_interval
+        self._has_room = has_room
+        self._start = start
+
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._running: set[str] = set()
+        threading.Thread(target=self._claim, name="queue", daemon=True).start()
+
+    def close(self) -> None:
+        """Stop claiming, and hand back the jobs still running for other nodes."""
+        self._stop.set()
+        with self._lock:
+            running = list(self._running)
+            self._running.clear()
+        for job_id in running:
+            self._queue.release(job_id, self._node)
+
+    def _claim(self) -> None:
+        while not self._stop.is_set():
+            queued = None
+            try:
+                if self._has_room():
+                    queued = self._queue.claim(self._node, self._lease)
+            except sqlite3.Error as e:
+                logger.warning("Can't claim a queued job: %s", e)
+            if queued is None:
+                self._stop.wait(self._poll_interval)
+                continue
+
+            logger.info("Claimed queued download of %s", queued.request.VideoUrl)
+            try:
+                job = self._start(queued)
+            except SchedulerFull:
+                self._queue.release(queued.id, self._node)
+                self._stop.wait(self._poll_interval)
+                continue
+
+            with self._lock:
+                self._running.add(queued.id)
+            threading.Thread(
+                target=self._tend, args=(queued.id, job), daemon=True
+            ).start()
+
+    def _tend(self, job_id: str, job: Job) -> None:
+        while not job.progress.wait(self._lease / 3):
+            with self._lock:
+                if job_id not in self._running:
+                    return
+            try:
+                held = self._queue.renew(
+                    job_id, self._node, self._lease, job.progress.snapshot()
+                )
+            except sqlite3.Error as e:
+                # Tried again a third of a lease later, before it runs out
+                logger.warning("Can't renew the lease on %s: %s", job_id, e)
+                continue
+            if held is None:
+                logger.warning(
+                    "Lost the lease on %s to another node", job.request.VideoUrl
+                )
+                with self._lock:
+                    self._running.discard(job_id)
+                job.keep_partials = True
+                job.cancel()
+                return
+            if held.cancelled:
+                job.cancel()
+
+        with self._lock:
+            if job_id not in self._running:
+                return
+            self._running.discard(job_id)
+        try:
+            self._queue.finish(job_id, self._node, job.progress.result())
+        except sqlite3.Error as e:
+            # Run again by whichever node claims it once the lease runs out
+            logger.warning("Can't finish %s: %s", job_id, e)
@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import re
+import shutil
+import time
+import zlib
+from collections.abc import Iterator
+from typing import Any
+
+import downloadServer_pb2
+import yt_dlp
+from extractors import video_key
+from journal import JobJournal
+from manifest import build_manifest
+from options import DEFAULT_SPONSORBLOCK_API, JobOptions, add_profile, output_prefix
+from postprocess import SinglePassFFmpegPP, uncut_path
+from profiles import load_profiles
+from sponsorblock import CachedSponsorBlockPP, SponsorBlockCache
+from timings import PhaseTimer, Timings, profiled, timing_messages
+from ydl_pool import JobHooks, YoutubeDLPool
+from yt_dlp.networking.exceptions import network_exceptions
+from yt_dlp.utils import (
+    DownloadError,
+    ExtractorError,
+    GeoRestrictedError,
+    UnsupportedError,
+)
+
+# Idle YoutubeDL instances kept for reuse by later jobs, in each process
+YDL_POOL_SIZE = int(os.environ.get("YDL_POOL_SIZE", "4"))
+
+# SQLite file recording running downloads, so they can resume after a crash
+DOWNLOAD_JOURNAL_PATH = os.environ.get("DOWNLOAD_JOURNAL_PATH", "")
+
+# SponsorBlock API, and seconds its segments are cached for. The cache is kept in
+# memory, or in a SQLite file that worker processes share.
+SPONSORBLOCK_API = os.environ.get("SPONSORBLOCK_API", DEFAULT_SPONSORBLOCK_API)
+SPONSORBLOCK_TTL = float(os.environ.get("SPONSORBLOCK_TTL", str(6 * 3600)))
+SPONSORBLOCK_CACHE_PATH = os.environ.get("SPONSORBLOCK_CACHE_PATH", "")
+
+# Seconds Download uses the format URLs of an About extraction for, instead of
+# extracting again. YouTube's stop working after six hours.
+EXTRACTION_TTL = float(os.environ.get("EXTRACTION_TTL", str(4 * 3600)))
+
+# Bytes an About extraction may decompress to, as clients hand them back
+MAX_EXTRACTION_SIZE = int(os.environ.get("MAX_EXTRACTION_SIZE", str(32 * 1024 * 1024)))
+
+# Whether finished downloads are hashed for their manifest. Off by default, as
+# hashing reads the whole file back after postprocessing.
+CONTENT_HASH = os.environ.get("CONTENT_HASH", "0") == "1"
+
+# Whether downloads cut by SponsorBlock keep their uncut original next to them,
+# listed in their manifest. It takes as much space again, but without it they
+# can't be recut.
+KEEP_UNCUT = os.environ.get("KEEP_UNCUT", "1") == "1"
+
+# Fragments of a fragmented download timed together, for requests with Timings set
+TIMING_FRAGMENT_BATCH = int(os.environ.get("TIMING_FRAGMENT_BATCH", "50"))
+
+# The info key `download` hands its phase timings on to the caller in
+PHASE_TIMINGS = "__phase_timings"
+
+# TOML file of download profiles requests can pick, as yt-dlp command line arguments
+DOWNLOAD_PROFILES_PATH = os.environ.get("DOWNLOAD_PROFILES_PATH", "")
+
+YDL_POOL = YoutubeDLPool(YDL_POOL_SIZE)
+JOURNAL = JobJournal(DOWNLOAD_JOURNAL_PATH) if DOWNLOAD_JOURNAL_PATH else None
+SPONSORBLOCK = SponsorBlockCache(
+    SPONSORBLOCK_API, SPONSORBLOCK_TTL, SPONSORBLOCK_CACHE_PATH
+)
+CachedSponsorBlockPP.cache = SPONSORBLOCK
+SinglePassFFmpegPP.keep_uncut = KEEP_UNCUT
+if DOWNLOAD_PROFILES_PATH:
+    for name, profile in load_profiles(DOWNLOAD_PROFILES_PATH).items():
+        add_profile(name, profile)
+
+
+def warm_up() -> None:
+    """Build the YoutubeDL instances jobs use before they are needed."""
+    YDL_POOL.warm(JobOptions.for_about())
+    YDL_POOL.warm(JobOptions.for_download(downloadServer_pb2.DownloadRequest()))
+    YDL_POOL.warm(JobOptions.for_postprocess(downloadServer_pb2.DownloadRequest()))
+    YDL_POOL.warm(JobOptions.for_recut(downloadServer_pb2.RecutRequest()))
+
+
+class WorkerError(Exception):
+    """An error from a job run in a worker process, classified before it was sent.
+
+    yt-dlp's errors carry their traceback, so they can't be pickled.
+    """
+
+    def __init__(
+        self,
+        message: str,
+        status: "downloadServer_pb2.Status.ValueType",
+        error_class: str,
+    ) -> None:
+        super().__init__(message, status, error_class)
+        self.status = status
+        self.error_class = error_class
+
+    @classmethod
+    def of(cls, e: BaseException) -> "WorkerError":
+        return cls(str(e), error_status(e), error_class(e))
+
+    def __str__(self) -> str:
+        return self.args[0]
+
+
+def _cause(e: BaseException) -> BaseException:
+    """What went wrong, rather than yt-dlp's report of it."""
+    if isinstance(e, DownloadError) and e.exc_info is not None:
+        return e.exc_info[1] or e
+    return e
+
+
+def error_class(e: BaseException) -> str:
+    if isinstance(e, WorkerError):
+        return e.error_class
+    return type(_cause(e)).__name__
+
+
+def error_status(e: BaseException) -> "downloadServer_pb2.Status.ValueType":
+    """Whether a job that failed with `e` is worth retrying later."""
+    if isinstance(e, WorkerError):
+        return e.status
+    e = _cause(e)
+
+    if isinstance(e, (UnsupportedError, GeoRestrictedError)):
+        return downloadServer_pb2.PERMANENT_ERROR
+    # Extractors also flag network errors as expected
+    if (
+        isinstance(e, ExtractorError)
+        and e.expected
+        and not isinstance(e.exc_info[1], network_exceptions)
+    ):
+        return downloadServer_pb2.PERMANENT_ERROR
+    return downloadServer_pb2.TEMPORARY_ERROR
+
+
+def about(request: downloadServer_pb2.AboutRequest) -> downloadServer_pb2.AboutReply:
+    timer = PhaseTimer(None, TIMING_FRAGMENT_BATCH, "extraction")
+    with YDL_POOL.checkout(JobOptions.for_about(), timer) as ydl:
+        info = ydl.sanitize_info(ydl.extract_info(request.VideoUrl, download=False))
+        timer.mark("reply")
+
+        response = downloadServer_pb2.AboutReply()
+        response.AgeLimit = info["age_limit"]
+        response.Category.extend(info["categories"])
+        response.ChannelId = info["channel_id"]
+        response.Description = info["description"]
+        response.Duration = info["duration"]
+        response.Embeddable = info["playable_in_embed"]
+        response.FileSize = info["filesize_approx"]
+
+        if "release_timestamp" in info and info["release_timestamp"] is not None:
+            response.Released = info["release_timestamp"]
+
+        if "release_date" in info:
+            response.ReleaseDate = int(
+                datetime.datetime.timestamp(
+                    datetime.datetime.strptime(info["release_date"], "%Y%M%d")
+                )
+            )
+
+        response.Tags.extend(info["tags"])
+        response.ThumbnailUrl = info["thumbnail"]
+        response.Timestamp = info["timestamp"]
+        response.Title = info["title"]
+        response.UploadDate = int(
+            datetime.datetime.timestamp(
+                datetime.datetime.strptime(info["upload_date"], "%Y%M%d")
+            )
+        )
+        response.Views = info["view_count"]
+
+        match info["availability"]:
+            case "private":
+                response.Availability = downloadServer_pb2.PRIVATE
+            case "premium_only":
+                response.Availability = downloadServer_pb2.PREMIUM_ONLY
+            case "subscriber_only":
+                response.Availability = downloadServer_pb2.SUBSCRIBER_ONLY
+            case "needs_auth":
+                response.Availability = downloadServer_pb2.NEEDS_AUTH
+            case "unlisted":
+                response.Availability = downloadServer_pb2.UNLISTED
+            case "public":
+                response.Availability = downloadServer_pb2.PUBLIC
+
+        response.LiveStatus = _live_status(info["live_status"])
+
+        if request.Extraction:
+            response.Extraction = _pack_extraction(info)
+        if request.Timings:
+            response.Timings.extend(timing_messages(timer.timings()))
+
+        return response
+
+
+def _pack_extraction(info: dict[str, Any]) -> bytes:
+    """An opaque handle on an About extraction, for Download to start from."""
+    info = yt_dlp.YoutubeDL.sanitize_info(info, remove_private_keys=True)
+    extraction = {"fetched": time.time(), "info": info}
+    return zlib.compress(json.dumps(extraction).encode())
+
+
+def unpack_extraction(extraction: bytes) -> tuple[float, dict[str, Any]]:
+    """When an extraction `_pack_extraction` made was fetched, and its info.
+
+    Raises ValueError if it is malformed, or too big once decompressed, as
+    it comes from the client.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(extraction, MAX_EXTRACTION_SIZE)
+    except zlib.error as e:
+        raise ValueError(f"Malformed extraction: {e}") from None
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Extraction is over {MAX_EXTRACTION_SIZE} bytes")
+    if not decompressor.eof:
+        raise ValueError("Extraction is cut short")
+
+    try:
+        unpacked = json.loads(data)
+    except ValueError as e:
+        raise ValueError(f"Malformed extraction: {e}") from None
+    if (
+        not isinstance(unpacked, dict)
+        or not isinstance(unpacked.get("fetched"), (int, float))
+        or not isinstance(unpacked.get("info"), dict)
+    ):
+        raise ValueError("Malformed extraction")
+    return unpacked["fetched"], unpacked["info"]
+
+
+def _unpack_extraction(
+    request: downloadServer_pb2.DownloadRequest,
+) -> dict[str, Any] | None:
+    """The info in a request's extraction, unless too old or for another video."""
+    if not request.HasField("Extraction"):
+        return None
+    fetched, info = unpack_extraction(request.Extraction)
+    if time.time() - fetched > EXTRACTION_TTL or video_key(
+        info.get("webpage_url") or ""
+    ) != video_key(request.VideoUrl):
+        return None
+    return info
+
+
+def _download_extracted(ydl: yt_dlp.YoutubeDL, info: dict[str, Any], url: str) -> int:
+    """Download from an About extraction, extracting again if its URLs fail.
+
+    The same as yt-dlp's --load-info-json, except errors only show in the
+    exit code while ignoring download errors.
+    """
+    ydl.process_ie_result(info, download=True)
+    if ydl._download_retcode == 0:  # pyright: ignore[reportAttributeAccessIssue]
+        return 0
+    ydl.report_warning(f"Downloading from the About extraction failed, trying {url}")
+    ydl._download_retcode = 0  # pyright: ignore[reportAttributeAccessIssue]
+    return ydl.download(url)
+
+
+def _live_status(live_status: str | None) -> "downloadServer_pb2.LiveStatus.ValueType":
+    match live_status:
+        case "is_live":
+            return downloadServer_pb2.IS_LIVE
+        case "is_upcoming":
+            return downloadServer_pb2.IS_UPCOMING
+        case "was_live":
+            return downloadServer_pb2.WAS_LIVE
+        case "not_live":
+            return downloadServer_pb2.NOT_LIVE
+        case "post_live":
+            return downloadServer_pb2.POST_LIVE
+        case _:
+            return downloadServer_pb2.UNKNOWN_LIVE
+
+
+def _playlist_url(playlist: str) -> str:
+    """Accept bare YouTube channel and playlist IDs as well as URLs."""
+    if re.fullmatch(r"UC[\w-]{22}", playlist):
+        # The channel's uploads playlist, newest first
+        playlist = f"UU{playlist[2:]}"
+    if re.fullmatch(r"(?:UU|PL|FL|LL|OL)[\w-]+", playlist):
+        return f"https://www.youtube.com/playlist?list={playlist}"
+    return playlist
+
+
+def list_playlist(
+    request: downloadServer_pb2.ListPlaylistRequest,
+) -> Iterator[downloadServer_pb2.PlaylistEntry]:
+    """List a playlist newest first, stopping as soon as it reaches known videos.
+
+    Entries come from flat extraction without processing, so yt-dlp only
+    fetches the playlist pages actually iterated over, and each is yielded
+    as soon as its page is in.
+    """
+    known = set(request.KnownVideoIds)
+    found = 0
+
+    with YDL_POOL.checkout(JobOptions.for_playlist()) as ydl:
+        info = ydl.extract_info(
+            _playlist_url(request.PlaylistUrl), download=False, process=False
+        )
+        # Channel and handle URLs resolve to the playlist tab they stand for
+        while info.get("_type") in ("url", "url_transparent"):
+            info = ydl.extract_info(
+                info["url"], download=False, ie_key=info.get("ie_key"), process=False
+            )
+
+        for entry in info.get("entries") or ():
+            # Unavailable videos come through as None
+            if entry is None:
+                continue
+            # Entries from generic feeds may only have a URL
+            entry.setdefault("id", entry.get("url"))
+            if entry["id"] in known:
+                break
+            timestamp = entry.get("timestamp")
+            if (
+                request.HasField("Watermark")
+                and timestamp is not None
+                and timestamp <= request.Watermark
+            ):
+                break
+
+            yield _playlist_entry(entry)
+            found += 1
+            if request.MaxEntries and found >= request.MaxEntries:
+                break
+
+
+def _playlist_entry(entry: dict[str, Any]) -> downloadServer_pb2.PlaylistEntry:
+    result = downloadServer_pb2.PlaylistEntry(
+        VideoId=entry["id"],
+        VideoUrl=entry.get("url") or entry.get("webpage_url") or entry["id"],
+        Title=entry.get("title") or "",
+        LiveStatus=_live_status(entry.get("live_status")),
+    )
+
+    if entry.get("duration") is not None:
+        result.Duration = int(entry["duration"])
+    if entry.get("timestamp") is not None:
+        result.Timestamp = int(entry["timestamp"])
+    if entry.get("view_count") is not None:
+        result.Views = int(entry["view_count"])
+    thumbnails = entry.get("thumbnails") or []
+    if thumbnails:
+        result.ThumbnailUrl = thumbnails[-1]["url"]
+
+    return result
+
+
+class _DownloadedInfo:
+    """Passes hooks on, keeping the info yt-dlp has for the downloaded file."""
+
+    def __init__(self, hooks: JobHooks) -> None:
+        self.info: dict[str, Any] | None = None
+        self._hooks = hooks
+
+    def progress_hook(self, d: dict[str, Any]) -> None:
+        self._hooks.progress_hook(d)
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None:
+        # The last step of every download, after merging and any fixups
+        if d["postprocessor"] == "MoveFiles":
+            self.info = d["info_dict"]
+        self._hooks.postprocessor_hook(d)
+
+
+def _profile_path(
+    request: downloadServer_pb2.DownloadRequest,
+) -> str | None:
+    if not request.CaptureProfile:
+        return None
+    # Named after the files it is for, without the template's fields
+    prefix = output_prefix(request.OutputPath).rstrip(".")
+    if not os.path.basename(prefix):
+        prefix = os.path.join(prefix, re.sub(r"\W", "_", video_key(request.VideoUrl)))
+    return f"{prefix}.prof"
+
+
+def download(
+    request: downloadServer_pb2.DownloadRequest, hooks: JobHooks
+) -> dict[str, Any] | downloadServer_pb2.DownloadReply:
+    """Download a video, leaving the postprocessors from options to `postprocess`.
+
+    Starts from the request's About extraction while it is recent enough.
+    Returns the info `postprocess` needs, with the phase timings under
+    PHASE_TIMINGS, or the reply to send if the download failed.
+    """
+    with profiled(_profile_path(request)):
+        return _download(request, hooks)
+
+
+def _failed(
+    request: downloadServer_pb2.DownloadRequest, e: BaseException | None
+) -> None:
+    """Keep the partial files for a retry, unless one could never succeed.
+
+    They are left for the client's retry, rather than restarted on startup.
+    """
+    if JOURNAL is None:
+        return
+    if e is not None and error_status(e) == downloadServer_pb2.PERMANENT_ERROR:
+        JOURNAL.discard(request.OutputPath)
+    else:
+        JOURNAL.hold(request.OutputPath)
+
+
+def _download(
+    request: downloadServer_pb2.DownloadRequest, hooks: JobHooks
+) -> dict[str, Any] | downloadServer_pb2.DownloadReply:
+    format_ids = None
+    if JOURNAL is not None:
+        previous = JOURNAL.start(request.VideoUrl, request.OutputPath, request.Profile)
+        if previous is not None:
+            format_ids = previous.format_ids
+        hooks = JOURNAL.hooks(request.OutputPath, hooks)
+
+    options = JobOptions.for_download(request, format_ids)
+    downloaded = _DownloadedInfo(hooks)
+    # Takes the markers out before the rest of the hooks see them
+    timer = PhaseTimer(downloaded, TIMING_FRAGMENT_BATCH, "extraction")
+    extracted = _unpack_extraction(request)
+
+    status = -1
+
+    try:
+        with YDL_POOL.checkout(options, timer) as ydl:
+            if extracted is not None:
+                status = _download_extracted(ydl, extracted, request.VideoUrl)
+            else:
+                status = ydl.download(request.VideoUrl)
+            reported = ydl.reported_error
+    except Exception as e:
+        _failed(request, e)
+        raise
+
+    if status != 0 or downloaded.info is None:
+        response = downloadServer_pb2.DownloadReply(
+            Status=downloadServer_pb2.TEMPORARY_ERROR,
+            ExitCode=status,
+            Timings=timing_messages(timer.timings()) if request.Timings else [],
+        )
+        if reported is not None:
+            response.Status = error_status(reported)
+            response.Error = str(reported)
+        _failed(request, reported)
+        return response
+
+    # Handed to another process in ProcessRunner, so it must pickle
+    info: dict[str, Any] = yt_dlp.YoutubeDL.sanitize_info(downloaded.info)  # pyright: ignore[reportAssignmentType]
+    info[PHASE_TIMINGS] = timer.timings()
+    return info
+
+
+def postprocess(
+    request: downloadServer_pb2.DownloadRequest,
+    info: dict[str, Any],
+    hooks: JobHooks,
+) -> downloadServer_pb2.DownloadReply:
+    """Run the postprocessors `download` left out on the file it downloaded."""
+    with profiled(_profile_path(request), append=True):
+        return _postprocess(request, info, hooks)
+
+
+def _postprocess(
+    request: downloadServer_pb2.DownloadRequest,
+    info: dict[str, Any],
+    hooks: JobHooks,
+) -> downloadServer_pb2.DownloadReply:
+    timings: Timings = info.pop(PHASE_TIMINGS, [])
+    timer = PhaseTimer(hooks, TIMING_FRAGMENT_BATCH, "postprocess")
+    try:
+        with YDL_POOL.checkout(JobOptions.for_postprocess(request), timer) as ydl:
+            info = ydl.post_process(info["filepath"], info)
+    except Exception:
+        if JOURNAL is not None:
+            JOURNAL.hold(request.OutputPath)
+        raise
+
+    if JOURNAL is not None:
+        JOURNAL.finish(request.OutputPath)
+
+    timer.mark("manifest")
+    response = downloadServer_pb2.DownloadReply()
+    response.Status = downloadServer_pb2.DONE
+    response.Manifest.CopyFrom(build_manifest(info, CONTENT_HASH))
+    response.Filename = response.Manifest.Media.Path
+    response.Progress = 1
+    if request.Timings:
+        response.Timings.extend(timing_messages(timings + timer.timings()))
+    return response
+
+
+def recut(request: downloadServer_pb2.RecutRequest) -> downloadServer_pb2.DownloadReply:
+    """Cut a finished download again, with the SponsorBlock segments there are now.
+
+    Downloads cut when they were downloaded keep the original next to them,
+    and those that weren't are kept as they are on their first recut. Every
+    recut starts from that, so segments since taken out of SponsorBlock
+    come back.
+    """
+    uncut = uncut_path(request.Filename)
+    kept = not os.path.exists(uncut)
+    if kept:
+        # A second name for the same file, so it is never missing from its
+        # path, and the cut is written as a new one over it
+        try:
+            os.link(request.Filename, uncut)
+        except OSError:
+            shutil.copy2(request.Filename, uncut)
+
+    try:
+        with YDL_POOL.checkout(JobOptions.for_recut(request)) as ydl:
+            info = ydl.extract_info(request.VideoUrl, download=False)
+            info = ydl.post_process(uncut, info)
+    except Exception:
+        # Not an original if it was refused as already cut, so every later
+        # recut would be refused too
+        if kept:
+            os.remove(uncut)
+        raise
+
+    # Only the file is known, as the info is from extracting afresh
+    filename = info["filepath"]
+    response = downloadServer_pb2.DownloadReply()
+    response.Status = downloadServer_pb2.DONE
+    response.Manifest.CopyFrom(build_manifest({"filepath": filename}, CONTENT_HASH))
+    response.Filename = filename
+    response.Progress = 1
+    return response
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+import glob
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from dataclasses import dataclass
+from typing import Any
+
+from extractors import video_key
+from ydl_pool import JobHooks
+
+logger = logging.getLogger(__name__)
+
+# Files yt-dlp leaves behind while a download is incomplete
+_PARTIAL = re.compile(r"\.(?:part|ytdl|part-Frag\d+(?:\.part)?|temp(?:\.\w+)?)$")
+
+
+@dataclass(frozen=True)
+class JournalEntry:
+    output_path: str
+    video_url: str
+    format_ids: str | None
+    part_file: str | None
+    downloaded_bytes: int | None
+    fragment_index: int | None
+    fragment_count: int | None
+    started: float
+    updated: float
+    # Cancelled or failed: kept for a later attempt to resume, but not restarted
+    # on startup
+    cancelled: bool
+    profile: str
+
+
+def _partials(path: str) -> list[str]:
+    """The partial files named after `path`, such as its .part and .ytdl files."""
+    return [p for p in glob.glob(f"{glob.escape(path)}*") if _PARTIAL.search(p)]
+
+
+def remove_partials(output_path: str, filenames: Iterable[str] = ()) -> None:
+    """Delete what an unfinished download into `output_path` left behind.
+
+    `filenames` are the files its progress hooks reported, such as each
+    format and subtitle, which go with their partial files. Templates like
+    x.%(ext)s name no file themselves, so without them only partial files
+    of a literal `output_path` are found.
+    """
+    found = set(_partials(output_path))
+    for filename in filenames:
+        found.add(filename)
+        # The .ytdl file is named after the final name, not the .part one
+        found.update(_partials(filename.removesuffix(".part")))
+
+    for path in found:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _format_ids(info: dict[str, Any]) -> str | None:
+    # Merged downloads get a copy of the info for each format, with the
+    # selection as a whole still in requested_formats
+    formats = info.get("requested_formats") or [info]
+    ids = [f["format_id"] for f in formats if f.get("format_id")]
+    return "+".join(ids) or None
+
+
+class JobJournal:
+    """Records running downloads in a SQLite file, so they outlive a crash.
+
+    Each entry holds the formats yt-dlp picked and how far it got. A later
+    attempt at the same output path asks for those formats again, so yt-dlp
+    picks up its .part and .ytdl files rather than starting over with
+    whatever it would choose now. Entries are removed once a download
+    finishes or fails for good, and only downloads a crash interrupted are
+    restarted on startup.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # Worker processes write to the same file as the server
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS downloads ("
+            "output_path TEXT PRIMARY KEY, video_url TEXT, format_ids TEXT, "
+            "part_file TEXT, downloaded_bytes INTEGER, fragment_index INTEGER, "
+            "fragment_count INTEGER, started REAL, updated REAL, "
+            "cancelled INTEGER NOT NULL DEFAULT 0, profile TEXT NOT NULL DEFAULT '')"
+        )
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(downloads)")}
+        if "profile" not in columns:
+            self._db.execute(
+                "ALTER TABLE downloads ADD COLUMN profile TEXT NOT NULL DEFAULT ''"
+            )
+
+    def start(
+        self, video_url: str, output_path: str, profile: str
+    ) -> JournalEntry | None:
+        """Note a download is starting, returning any earlier attempt at it.
+
+        Attempts with another video or profile are discarded, as their formats
+        would not match.
+        """
+        now = time.time()
+
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT * FROM downloads WHERE output_path = ?", (output_path,)
+            ).fetchone()
+            previous = JournalEntry(*row) if row is not None else None
+
+            if previous is not None and (
+                video_key(previous.video_url) != video_key(video_url)
+                or previous.profile != profile
+            ):
+                logger.info(
+                    "Replacing unfinished download of %s into %s",
+                    previous.video_url,
+                    output_path,
+                )
+                remove_partials(output_path, filter(None, [previous.part_file]))
+                previous = None
+
+            if previous is None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO downloads VALUES "
+                    "(?, ?, NULL, NULL, NULL, NULL, NULL, ?, ?, 0, ?)",
+                    (output_path, video_url, now, now, profile),
+                )
+            else:
+                self._db.execute(
+                    "UPDATE downloads SET updated = ?, cancelled = 0 "
+                    "WHERE output_path = ?",
+                    (now, output_path),
+                )
+
+        return previous
+
+    def record(self, output_path: str, d: dict[str, Any]) -> None:
+        """Store how far a download has got, from a yt-dlp progress hook call."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE downloads SET format_ids = COALESCE(?, format_ids), "
+                "part_file = ?, downloaded_bytes = ?, fragment_index = ?, "
+                "fragment_count = ?, updated = ? WHERE output_path = ?",
+                (
+                    _format_ids(d.get("info_dict") or {}),
+                    d.get("tmpfilename"),
+                    d.get("downloaded_bytes"),
+                    d.get("fragment_index"),
+                    d.get("fragment_count"),
+                    time.time(),
+                    output_path,
+                ),
+            )
+
+    def hold(self, output_path: str) -> None:
+        """Keep a cancelled or failed download's entry, but not restart it on startup.
+
+        A later attempt at the download still resumes from it.
+        """
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE downloads SET cancelled = 1 WHERE output_path = ?",
+                (output_path,),
+            )
+
+    def release(self, output_path: str) -> None:
+        """Restart a download on startup again, as one the server was stopped in."""
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE downloads SET cancelled = 0 WHERE output_path = ?",
+                (output_path,),
+            )
+
+    def finish(self, output_path: str) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM downloads WHERE output_path = ?", (output_path,)
+            )
+
+    def discard(self, output_path: str) -> None:
+        """Give up on a download, deleting its partial files."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT part_file FROM downloads WHERE output_path = ?",
+                (output_path,),
+            ).fetchone()
+        remove_partials(output_path, filter(None, [row and row[0]]))
+        self.finish(output_path)
+
+    def pending(self) -> list[JournalEntry]:
+        """Downloads started but never finished, oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT * FROM downloads ORDER BY started"
+            ).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def hooks(self, output_path: str, hooks: JobHooks) -> JobHooks:
+        return _JournalHooks(self, output_path, hooks)
+
+    def close(self) -> None:
+        self._db.close()
+
+
+class _JournalHooks:
+    """Records a download's progress in the journal, then passes hooks on."""
+
+    # Seconds between journal writes for the same download
+    _INTERVAL = 5
+
+    def __init__(self, journal: JobJournal, output_path: str, hooks: JobHooks):
+        self._journal = journal
+        self._output_path = output_path
+        self._hooks = hooks
+        self._part_file: str | None = None
+        self._next_write = 0.0
+
+    def progress_hook(self, d: dict[str, Any]) -> None:
+        now = time.monotonic()
+        # Always write when a new file starts, so the chosen formats are kept
+        # however soon the process dies
+        if d["status"] == "downloading" and (
+            d.get("tmpfilename") != self._part_file or now >= self._next_write
+        ):
+            self._part_file = d.get("tmpfilename")
+            self._next_write = now + self._INTERVAL
+            self._journal.record(self._output_path, d)
+
+        self._hooks.progress_hook(d)
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None:
+        self._hooks.postprocessor_hook(d)
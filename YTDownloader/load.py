@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import shutil
+from collections.abc import AsyncIterator, Awaitable, Callable, Sequence
+from typing import Any, NamedTuple
+
+import grpc
+from grpc_health.v1 import health, health_pb2
+from scheduler import DownloadScheduler
+
+logger = logging.getLogger(__name__)
+
+# Trailing metadata every response carries its replica's load in, as an ORCA
+# text report that Envoy and client side balancers can read
+LOAD_REPORT_KEY = "endpoint-load-metrics"
+
+# Health checks report load too, but not health watches, which never finish
+_HEALTH_CHECK = f"/{health.SERVICE_NAME}/Check"
+
+
+class Load(NamedTuple):
+    active: int
+    queued: int
+    postprocessing: int
+    # Bytes free where downloads are written, None if not checked
+    free_disk: int | None
+
+
+class LoadMonitor:
+    """Tells how busy the server is, and whether it has room for more work.
+
+    The server stops serving once `max_queued` downloads are waiting for a
+    slot, or fewer than `min_free_disk` bytes are left in `output_dir`.
+    """
+
+    def __init__(
+        self,
+        scheduler: DownloadScheduler,
+        postprocessing: Callable[[], int],
+        output_dir: str,
+        min_free_disk: int,
+        max_queued: int,
+    ) -> None:
+        self._scheduler = scheduler
+        self._postprocessing = postprocessing
+        self._output_dir = output_dir
+        self._min_free_disk = min_free_disk
+        self._max_queued = max_queued
+        # As last checked by load(), which reports can't afford to do
+        self._last_free_disk: int | None = None
+
+    def load(self) -> Load:
+        self._last_free_disk = self._free_disk()
+        return self._current()
+
+    def serving(self, load: Load) -> bool:
+        if load.queued >= self._max_queued:
+            return False
+        return load.free_disk is None or load.free_disk >= self._min_free_disk
+
+    def report(self) -> str:
+        """The current load, in the ORCA text format.
+
+        Free disk space is as last checked by `load`, so this doesn't block.
+        """
+        load = self._current()
+        # Above 1 once downloads are queued, as weighted balancers expect
+        utilization = (load.active + load.queued) / self._scheduler.max_active
+        metrics = [
+            f"application_utilization={utilization:g}",
+            f"named_metrics.active_downloads={load.active}",
+            f"named_metrics.queued_downloads={load.queued}",
+            f"named_metrics.postprocessing={load.postprocessing}",
+        ]
+        if load.free_disk is not None:
+            metrics.append(f"named_metrics.free_disk_bytes={load.free_disk}")
+        return "TEXT " + ", ".join(metrics)
+
+    async def watch(
+        self,
+        servicer: health.aio.HealthServicer,  # pyright: ignore[reportAttributeAccessIssue]
+        services: Sequence[str],
+        interval: float,
+    ) -> None:
+        """Keep the health of `services` up to date, until cancelled."""
+        status = None
+        while True:
+            load = await asyncio.to_thread(self.load)
+            serving = (
+                health_pb2.HealthCheckResponse.SERVING
+                if self.serving(load)
+                else health_pb2.HealthCheckResponse.NOT_SERVING
+            )
+            if serving != status:
+                if status is not None:
+                    logger.warning(
+                        "Now %s: %s",
+                        health_pb2.HealthCheckResponse.ServingStatus.Name(serving),
+                        load,
+                    )
+                status = serving
+                for service in services:
+                    await servicer.set(service, serving)
+            await asyncio.sleep(interval)
+
+    def _current(self) -> Load:
+        return Load(
+            self._scheduler.active,
+            self._scheduler.queued,
+            self._postprocessing(),
+            self._last_free_disk,
+        )
+
+    def _free_disk(self) -> int | None:
+        if not self._output_dir:
+            return None
+        try:
+            return shutil.disk_usage(self._output_dir).free
+        except OSError as e:
+            logger.warning("Can't check free space in %s: %s", self._output_dir, e)
+            return None
+
+
+class LoadReportInterceptor(grpc.aio.ServerInterceptor):
+    """Adds the server's load to the trailing metadata of responses.
+
+    Every call to `services` gets it, and health checks.
+    """
+
+    def __init__(self, monitor: LoadMonitor, services: Sequence[str]) -> None:
+        self._monitor = monitor
+        self._prefixes = tuple(f"/{service}/" for service in services)
+
+    async def intercept_service(
+        self,
+        continuation: Callable[
+            [grpc.HandlerCallDetails], Awaitable[grpc.RpcMethodHandler | None]
+        ],
+        handler_call_details: grpc.HandlerCallDetails,
+    ) -> grpc.RpcMethodHandler | None:
+        handler = await continuation(handler_call_details)
+        method = handler_call_details.method
+        if handler is None or not (
+            method.startswith(self._prefixes) or method == _HEALTH_CHECK
+        ):
+            return handler
+
+        # The handlers are coroutines, which the grpc stubs know nothing of
+        if handler.unary_unary is not None:
+            unary: Any = handler.unary_unary
+
+            async def unary_unary(
+                request: Any, context: grpc.aio.ServicerContext
+            ) -> Any:
+                # Set first too, as aborting keeps what was set before it
+                self._add_report(context)
+                try:
+                    return await unary(request, context)
+                finally:
+                    self._add_report(context)
+
+            return grpc.unary_unary_rpc_method_handler(
+                unary_unary,
+                request_deserializer=handler.request_deserializer,
+                response_serializer=handler.response_serializer,
+            )
+
+        if handler.unary_stream is not None:
+            stream: Any = handler.unary_stream
+
+            async def unary_stream(
+                request: Any, context: grpc.aio.ServicerContext
+            ) -> AsyncIterator[Any]:
+                self._add_report(context)
+                try:
+                    async for response in stream(request, context):
+                        yield response
+                finally:
+                    self._add_report(context)
+
+            return grpc.unary_stream_rpc_method_handler(
+                unary_stream,
+                request_deserializer=handler.request_deserializer,
+                response_serializer=handler.response_serializer,
+            )
+
+        return handler
+
+    def _add_report(self, context: grpc.aio.ServicerContext) -> None:
+        metadata = [
+            (key, value)
+            for key, value in context.trailing_metadata() or ()
+            if key != LOAD_REPORT_KEY
+        ]
+        metadata.append((LOAD_REPORT_KEY, self._monitor.report()))
+        context.set_trailing_metadata(metadata)
@@ -1,210 +1,865 @@
 # -*- coding: utf-8 -*-
-import datetime
-import glob
+import asyncio
 import logging
+import os
+import signal
+import socket
+import threading
+import time
+from collections.abc import AsyncIterator, Iterable
 from concurrent import futures
+from typing import Any
 
 import downloadServer_pb2
 import downloadServer_pb2_grpc
 import grpc
 import yt_dlp
 import yt_dlp.version
+from cache import AboutCache
+from extractors import extractor_name, video_key
 from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 from grpc_reflection.v1alpha import reflection
-
-YDL_DOWNLOAD_OPTS = {
-    # 'progress_hooks': [my_hook],
-    "format": "(bv[vcodec~='^(avc|h264)']+ba[acodec~='^(aac|mp?4a)']) / "
-    "(bv[vcodec~='^(vp9)']+ba[acodec=opus])",
-    "format_sort": ["res:1080"],
-    "fragment_retries": 10,
-    "ignoreerrors": "only_download",
-    "outtmpl": {"default": "test"},
-    "postprocessors": [
-        {
-            "key": "SponsorBlock",
-            "api": "https://sponsor.ajay.app",
-            "categories": {
-                "chapter",
-                "filler",
-                "interaction",
-                "intro",
-                "music_offtopic",
-                "outro",
-                "poi_highlight",
-                "preview",
-                "selfpromo",
-                "sponsor",
-            },
-            "when": "after_filter",
-        },
-        {"key": "FFmpegEmbedSubtitle", "already_have_subtitle": False},
-        {
-            "key": "ModifyChapters",
-            "force_keyframes": False,
-            "remove_chapters_patterns": [],
-            "remove_ranges": [],
-            "remove_sponsor_segments": {"interaction", "selfpromo", "sponsor"},
-            "sponsorblock_chapter_title": "[SponsorBlock]: %(category_names)l",
-        },
-        {
-            "key": "FFmpegMetadata",
-            "add_chapters": True,
-            "add_metadata": True,
-        },
-        {"key": "EmbedThumbnail", "already_have_thumbnail": False},
-    ],
-    "retries": 10,
-    "writeautomaticsub": True,
-}
-
-YDL_OPTS = {
-    "fragment_retries": 10,
-    "ignoreerrors": "only_download",
-    "outtmpl": {"default": "test", "pl_thumbnail": ""},
-    "retries": 10,
-}
+from jobqueue import JobQueue, MemoryJobQueue, QueuedJob, QueueWorker, SQLiteJobQueue
+from jobs import (
+    JOURNAL,
+    PHASE_TIMINGS,
+    SPONSORBLOCK,
+    SPONSORBLOCK_CACHE_PATH,
+    error_class,
+    error_status,
+    unpack_extraction,
+)
+from journal import JobJournal, remove_partials
+from load import LoadMonitor, LoadReportInterceptor
+from metrics import Metrics
+from options import DOWNLOAD_PROFILES
+from registry import Job, JobRegistry
+from runners import JobRunner, ProcessRunner, ThreadRunner, lower_priority
+from scheduler import DownloadScheduler, SchedulerFull
+from singleflight import InFlight
+from sponsorblock import SponsorBlockPrefetcher
+from timings import timing_messages
+
+# Minimum seconds between DownloadStream progress messages, unless overridden
+PROGRESS_INTERVAL = float(os.environ.get("PROGRESS_INTERVAL", "1"))
+
+# Downloads running at once, overall and per extractor (or host, for generic URLs)
+MAX_DOWNLOADS = int(os.environ.get("MAX_DOWNLOADS", "2"))
+MAX_DOWNLOADS_PER_HOST = int(
+    os.environ.get("MAX_DOWNLOADS_PER_HOST", str(MAX_DOWNLOADS))
+)
+# Downloads that may wait for a slot before new ones get RESOURCE_EXHAUSTED
+MAX_QUEUED_DOWNLOADS = int(os.environ.get("MAX_QUEUED_DOWNLOADS", "50"))
+
+# Downloads postprocessed at once. Each frees its download slot for the next
+# download first, so the network and the CPUs are kept busy together.
+POSTPROCESS_WORKERS = int(os.environ.get("POSTPROCESS_WORKERS", "2"))
+# Niceness and ionice class:level postprocessing runs at, ffmpeg included
+POSTPROCESS_NICE = int(os.environ.get("POSTPROCESS_NICE", "10"))
+POSTPROCESS_IONICE = os.environ.get("POSTPROCESS_IONICE", "2:7")
+
+# "thread" runs yt-dlp inside the server process, "process" in a pool of workers
+JOB_EXECUTOR = os.environ.get("JOB_EXECUTOR", "thread")
+WORKER_PROCESSES = int(os.environ.get("WORKER_PROCESSES", str(os.cpu_count() or 2)))
+# Worker processes are replaced after this many jobs, or once above this RSS
+WORKER_MAX_JOBS = int(os.environ.get("WORKER_MAX_JOBS", "20"))
+WORKER_MAX_RSS_MB = int(os.environ.get("WORKER_MAX_RSS_MB", "512"))
+
+# About extractions and playlist listings run at once, for all clients together.
+# Calls beyond that wait their turn without holding a thread.
+ABOUT_WORKERS = int(os.environ.get("ABOUT_WORKERS", "8"))
+# Playlist entries ListPlaylist fetches ahead of what the client has taken
+PLAYLIST_BUFFER = int(os.environ.get("PLAYLIST_BUFFER", "100"))
+# About extractions run at once for each BatchAbout call
+BATCH_ABOUT_CONCURRENCY = int(os.environ.get("BATCH_ABOUT_CONCURRENCY", "4"))
+
+# About replies kept in memory, and optionally on disk in a SQLite file
+ABOUT_CACHE_ENTRIES = int(os.environ.get("ABOUT_CACHE_ENTRIES", "1000"))
+ABOUT_CACHE_PATH = os.environ.get("ABOUT_CACHE_PATH", "")
+ABOUT_CACHE_DISK_ENTRIES = int(os.environ.get("ABOUT_CACHE_DISK_ENTRIES", "100000"))
+# Seconds a cached About reply is used for, and for requests with StaticOnly set
+ABOUT_VOLATILE_TTL = float(os.environ.get("ABOUT_VOLATILE_TTL", "3600"))
+ABOUT_STATIC_TTL = float(os.environ.get("ABOUT_STATIC_TTL", str(7 * 24 * 3600)))
+
+# Seconds finished jobs are kept for GetJob and WatchJobs
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", str(24 * 3600)))
+
+# "delete" removes a cancelled download's partial files, "keep" leaves them for a
+# later attempt at the same download to resume from
+CANCELLED_DOWNLOADS = os.environ.get("CANCELLED_DOWNLOADS", "delete")
+
+# Interrupted downloads younger than this many seconds are resumed on startup,
+# older ones have their partial files deleted
+DOWNLOAD_RESUME_AGE = float(os.environ.get("DOWNLOAD_RESUME_AGE", str(24 * 3600)))
+
+# Address the gRPC server listens on
+LISTEN_ADDRESS = os.environ.get("LISTEN_ADDRESS", "0.0.0.0:30033")
+
+# Directory downloads are written to, and the free space below which the server
+# reports NOT_SERVING so balancers send downloads to other replicas
+OUTPUT_DIR = os.environ.get("OUTPUT_DIR", "")
+MIN_FREE_DISK_MB = int(os.environ.get("MIN_FREE_DISK_MB", "1024"))
+# Downloads waiting for a slot at which the server reports NOT_SERVING
+HEALTH_MAX_QUEUED = int(os.environ.get("HEALTH_MAX_QUEUED", str(MAX_QUEUED_DOWNLOADS)))
+# Seconds between checks of the load behind the health status
+HEALTH_INTERVAL = float(os.environ.get("HEALTH_INTERVAL", "5"))
+
+# Queue StartJob adds downloads to, for every server sharing it to claim from:
+# "memory" for one in this process, or a SQLite file on a volume they all mount.
+# None if unset, each server running the jobs it is sent.
+JOB_QUEUE = os.environ.get("JOB_QUEUE", "")
+# This server's name in the queue, which must differ between servers sharing one
+NODE_NAME = os.environ.get("NODE_NAME", f"{socket.gethostname()}-{os.getpid()}")
+# Seconds a claimed job is held for without its server renewing the claim, and
+# claims on a job before it fails for good, as it keeps killing its server
+JOB_QUEUE_LEASE = float(os.environ.get("JOB_QUEUE_LEASE", "60"))
+JOB_QUEUE_MAX_ATTEMPTS = int(os.environ.get("JOB_QUEUE_MAX_ATTEMPTS", "3"))
+# Seconds between looks for a job to claim while there is none, or no room
+JOB_QUEUE_POLL_INTERVAL = float(os.environ.get("JOB_QUEUE_POLL_INTERVAL", "2"))
+
+# Port serving Prometheus metrics on /metrics, none if unset
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+
+logger = logging.getLogger(__name__)
 
 
 class Downloader(downloadServer_pb2_grpc.YTDownloaderServicer):
-    def About(
-        self, request: downloadServer_pb2.AboutRequest, context: grpc.ServicerContext
+    def __init__(
+        self,
+        scheduler: DownloadScheduler,
+        runner: JobRunner,
+        postprocessor: JobRunner,
+        about_cache: AboutCache,
+        jobs: JobRegistry,
+        prefetcher: SponsorBlockPrefetcher | None = None,
+        metrics: Metrics | None = None,
+        queue: JobQueue | None = None,
+    ) -> None:
+        self._scheduler = scheduler
+        self._runner = runner
+        self._postprocessor = postprocessor
+        self._about_cache = about_cache
+        self._jobs = jobs
+        self._prefetcher = prefetcher
+        self._metrics = metrics or Metrics()
+        self._queue = queue
+
+        # yt-dlp runs on these threads, or waits on them for a worker process,
+        # as RPCs are handled on the event loop
+        self._about_pool = futures.ThreadPoolExecutor(
+            ABOUT_WORKERS, thread_name_prefix="about"
+        )
+        # Lookups in the About cache and the job queue, quick but on disk
+        self._blocking = futures.ThreadPoolExecutor(4, thread_name_prefix="blocking")
+        # A thread for every download slot and queue place, and more for those
+        # waiting on postprocessing, so downloads rarely wait for a thread
+        self._download_pool = futures.ThreadPoolExecutor(
+            scheduler.max_active + scheduler.max_queued + POSTPROCESS_WORKERS,
+            thread_name_prefix="download",
+        )
+
+        # Worker processes started from these threads inherit their priority
+        self._postprocess_pool = futures.ThreadPoolExecutor(
+            POSTPROCESS_WORKERS,
+            thread_name_prefix="postprocess",
+            initializer=lower_priority,
+            initargs=(POSTPROCESS_NICE, POSTPROCESS_IONICE),
+        )
+
+        # Identical requests attach to the job already running for them
+        self._about_in_flight: InFlight[
+            tuple[str, bool, bool], futures.Future[downloadServer_pb2.AboutReply]
+        ] = InFlight()
+        self._downloads_in_flight: InFlight[tuple[str, str], Job] = InFlight()
+
+        # Downloads waiting for a postprocessing slot, and holding one
+        self._postprocess_lock = threading.Lock()
+        self._postprocess_waiting = 0
+        self._postprocess_running = 0
+
+        self._metrics.gauge(
+            "ytdownloader_downloads_queued",
+            "Downloads waiting for a download slot",
+            lambda: scheduler.queued,
+        )
+        self._metrics.gauge(
+            "ytdownloader_downloads_active",
+            "Downloads holding a download slot",
+            lambda: scheduler.active,
+        )
+        self._metrics.gauge(
+            "ytdownloader_postprocess_queued",
+            "Downloads waiting for a postprocessing slot",
+            lambda: self._postprocess_waiting,
+        )
+        self._metrics.gauge(
+            "ytdownloader_postprocess_active",
+            "Downloads being postprocessed",
+            lambda: self._postprocess_running,
+        )
+
+    @property
+    def postprocessing(self) -> int:
+        """Downloads waiting for a postprocessing slot or holding one."""
+        with self._postprocess_lock:
+            return self._postprocess_waiting + self._postprocess_running
+
+    async def About(
+        self,
+        request: downloadServer_pb2.AboutRequest,
+        context: grpc.aio.ServicerContext,
     ) -> downloadServer_pb2.AboutReply:
-        with yt_dlp.YoutubeDL(YDL_OPTS) as ydl:
-            info = ydl.sanitize_info(ydl.extract_info(request.VideoUrl, download=False))
-
-            response = downloadServer_pb2.AboutReply()
-            response.AgeLimit = info["age_limit"]
-            response.Category.extend(info["categories"])
-            response.ChannelId = info["channel_id"]
-            response.Description = info["description"]
-            response.Duration = info["duration"]
-            response.Embeddable = info["playable_in_embed"]
-            response.FileSize = info["filesize_approx"]
-
-            if "release_timestamp" in info and info["release_timestamp"] is not None:
-                response.Released = info["release_timestamp"]
-
-            if "release_date" in info:
-                response.ReleaseDate = int(
-                    datetime.datetime.timestamp(
-                        datetime.datetime.strptime(info["release_date"], "%Y%M%d")
+        return await self._about(request)
+
+    async def BatchAbout(
+        self,
+        request: downloadServer_pb2.BatchAboutRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[downloadServer_pb2.AboutReply]:
+        running = asyncio.Semaphore(BATCH_ABOUT_CONCURRENCY)
+
+        async def item(url: str) -> downloadServer_pb2.AboutReply:
+            async with running:
+                return await self._batch_about_item(
+                    downloadServer_pb2.AboutRequest(
+                        VideoUrl=url,
+                        NoCache=request.NoCache,
+                        StaticOnly=request.StaticOnly,
+                        Extraction=request.Extraction,
                     )
                 )
 
-            response.Tags.extend(info["tags"])
-            response.ThumbnailUrl = info["thumbnail"]
-            response.Timestamp = info["timestamp"]
-            response.Title = info["title"]
-            response.UploadDate = int(
-                datetime.datetime.timestamp(
-                    datetime.datetime.strptime(info["upload_date"], "%Y%M%d")
-                )
+        pending = [asyncio.create_task(item(url)) for url in request.VideoUrls]
+        try:
+            for done in asyncio.as_completed(pending):
+                yield await done
+        finally:
+            # Stop extracting the rest if the client has gone away
+            for task in pending:
+                task.cancel()
+
+    async def ListPlaylist(
+        self,
+        request: downloadServer_pb2.ListPlaylistRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[downloadServer_pb2.PlaylistEntry]:
+        loop = asyncio.get_running_loop()
+        # Bounded, so a slow client holds yt-dlp back from fetching more pages.
+        # None marks the end, and an exception the listing failing.
+        entries: asyncio.Queue[downloadServer_pb2.PlaylistEntry | Exception | None] = (
+            asyncio.Queue(PLAYLIST_BUFFER)
+        )
+        stopped = threading.Event()
+
+        def put(item: downloadServer_pb2.PlaylistEntry | Exception | None) -> None:
+            asyncio.run_coroutine_threadsafe(entries.put(item), loop).result()
+
+        def produce() -> None:
+            try:
+                for entry in self._runner.list_playlist(request):
+                    if stopped.is_set():
+                        return
+                    put(entry)
+                put(None)
+            except Exception as e:
+                put(e)
+
+        self._about_pool.submit(produce)
+        try:
+            while (entry := await entries.get()) is not None:
+                if isinstance(entry, Exception):
+                    raise entry
+                yield entry
+        finally:
+            # Makes room for a put already waiting, after which the listing stops
+            stopped.set()
+            while not entries.empty():
+                entries.get_nowait()
+
+    async def _about(
+        self, request: downloadServer_pb2.AboutRequest
+    ) -> downloadServer_pb2.AboutReply:
+        # Resolving the extractor is slow for the first URL of each site
+        key = await asyncio.wrap_future(
+            self._blocking.submit(video_key, request.VideoUrl)
+        )
+        # Cached replies have no extraction to hand out
+        if not request.NoCache and not request.Extraction:
+            looked_up_at = time.monotonic()
+            cached = await asyncio.wrap_future(
+                self._blocking.submit(self._about_cache.get, key, request.StaticOnly)
             )
-            response.Views = info["view_count"]
-
-            match info["availability"]:
-                case "private":
-                    response.Availability = downloadServer_pb2.PRIVATE
-                case "premium_only":
-                    response.Availability = downloadServer_pb2.PREMIUM_ONLY
-                case "subscriber_only":
-                    response.Availability = downloadServer_pb2.SUBSCRIBER_ONLY
-                case "needs_auth":
-                    response.Availability = downloadServer_pb2.NEEDS_AUTH
-                case "unlisted":
-                    response.Availability = downloadServer_pb2.UNLISTED
-                case "public":
-                    response.Availability = downloadServer_pb2.PUBLIC
-
-            match info["live_status"]:
-                case "is_live":
-                    response.LiveStatus = downloadServer_pb2.IS_LIVE
-                case "is_upcoming":
-                    response.LiveStatus = downloadServer_pb2.IS_UPCOMING
-                case "was_live":
-                    response.LiveStatus = downloadServer_pb2.WAS_LIVE
-                case "not_live":
-                    response.LiveStatus = downloadServer_pb2.NOT_LIVE
-                case "post_live":
-                    response.LiveStatus = downloadServer_pb2.POST_LIVE
-
-            return response
-
-    def Download(
-        self, request: downloadServer_pb2.DownloadRequest, context: grpc.ServicerContext
-    ) -> downloadServer_pb2.DownloadReply:
-        opts = YDL_DOWNLOAD_OPTS
+            self._metrics.about_cache.inc("miss" if cached is None else "hit")
+            if cached is not None:
+                cached.VideoUrl = request.VideoUrl
+                if request.Timings:
+                    cached.Timings.extend(
+                        timing_messages([("cache", time.monotonic() - looked_up_at)])
+                    )
+                return cached
+
+        flight = (key, request.Extraction, request.Timings)
+        extraction, started = self._about_in_flight.join_or_start(
+            flight, futures.Future
+        )
+        if started:
+            self._about_pool.submit(self._extract, flight, request, extraction)
+
+        # Shielded, as one caller going away must not cancel it for the others
+        extracted = await asyncio.shield(asyncio.wrap_future(extraction))
+        # Every request sharing the extraction gets its own copy to fill in
+        response = downloadServer_pb2.AboutReply()
+        response.CopyFrom(extracted)
+        response.VideoUrl = request.VideoUrl
+        return response
 
-        response = downloadServer_pb2.DownloadReply()
-        response.Status = downloadServer_pb2.STARTING
+    def _extract(
+        self,
+        flight: tuple[str, bool, bool],
+        request: downloadServer_pb2.AboutRequest,
+        extraction: futures.Future[downloadServer_pb2.AboutReply],
+    ) -> None:
+        started_at = time.monotonic()
+        try:
+            extracted = self._runner.about(request)
+            extracted.FetchedAt = int(time.time())
+            self._about_cache.put(flight[0], extracted)
+            extraction.set_result(extracted)
+        except Exception as e:
+            self._metrics.errors.inc("about", error_class(e))
+            extraction.set_exception(e)
+        finally:
+            self._about_in_flight.done(flight)
+            self._metrics.extraction_seconds.observe(
+                time.monotonic() - started_at,
+                "About",
+                extractor_name(request.VideoUrl),
+            )
 
-        # def status_hook(d):
-        #    if response.Filename != d["Filename"]:
-        #        print(d["Filename"])
-        #        response.Filename = d["filename"]
-        # if "downloaded_bytes" in d and "total_bytes" in d and d["downloaded_bytes"] is not None and d["total_bytes"] is not None:
-        #    response.Progress = float(d["downloaded_bytes"])/d["total_bytes"]
+    async def _batch_about_item(
+        self, request: downloadServer_pb2.AboutRequest
+    ) -> downloadServer_pb2.AboutReply:
+        try:
+            response = await self._about(request)
+        except Exception as e:
+            logger.warning("About failed for %s: %s", request.VideoUrl, e)
+            return downloadServer_pb2.AboutReply(
+                VideoUrl=request.VideoUrl, Status=error_status(e), Error=str(e)
+            )
 
-        # opts["progress_hooks"] = [status_hook]
-        opts["outtmpl"] = {"default": request.OutputPath}
+        response.Status = downloadServer_pb2.DONE
+        return response
 
-        status = -1
+    async def Download(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> downloadServer_pb2.DownloadReply:
+        job = await self._start_download_rpc(request, context)
+        with job.attached(self._blocking):
+            return await job.progress.finished()
+
+    async def DownloadStream(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[downloadServer_pb2.DownloadReply]:
+        interval = (
+            request.ProgressInterval
+            if request.HasField("ProgressInterval")
+            else PROGRESS_INTERVAL
+        )
+
+        job = await self._start_download_rpc(request, context)
+        with job.attached(self._blocking):
+            async for reply in job.progress.updates(interval):
+                yield reply
+
+    async def StartJob(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> downloadServer_pb2.Job:
+        if self._queue is not None:
+            await self._check_profile(request.Profile, context)
+            await self._check_extraction(request, context)
+            queued = await asyncio.wrap_future(
+                self._blocking.submit(self._queue.enqueue, request)
+            )
+            return queued.message()
+
+        job = await self._start_download_rpc(request, context)
+        job.keep()
+        return job.message()
+
+    async def GetJob(
+        self,
+        request: downloadServer_pb2.JobRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> downloadServer_pb2.Job:
+        return (await self._get_job(request.JobId, context)).message()
+
+    async def CancelJob(
+        self,
+        request: downloadServer_pb2.JobRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> downloadServer_pb2.Job:
+        job = await self._get_job(request.JobId, context)
+        if isinstance(job, Job):
+            # Killing its ffmpeg looks through every process
+            await asyncio.wrap_future(self._blocking.submit(job.cancel))
+            return job.message()
+
+        # Its server cancels it when next renewing its claim
+        assert self._queue is not None
+        cancelled = await asyncio.wrap_future(
+            self._blocking.submit(self._queue.cancel, job.id)
+        )
+        return (cancelled or job).message()
+
+    async def WatchJobs(
+        self,
+        request: downloadServer_pb2.WatchJobsRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> AsyncIterator[downloadServer_pb2.Job]:
+        interval = (
+            request.ProgressInterval
+            if request.HasField("ProgressInterval")
+            else PROGRESS_INTERVAL
+        )
+        job_ids = list(request.JobIds)
+        for job_id in job_ids:
+            await self._get_job(job_id, context)
+
+        sent: dict[str, int] = {}
+        finished: dict[str, bool] = {}
+        seen = -1
+        # Ends by being cancelled once the client goes away
+        while True:
+            # Wake up now and then for queued jobs running elsewhere
+            seen = await self._jobs.wait(seen, timeout=5)
+
+            jobs = self._jobs.jobs(job_ids)
+            for job in jobs:
+                # Read before the snapshot, so a finished job's last reply is sent
+                finished[job.id] = job.progress.done
+                version = job.progress.version
+                if sent.get(job.id) != version:
+                    sent[job.id] = version
+                    yield job.message()
+
+            # Queued jobs running elsewhere, as of their server's last renewal
+            elsewhere = set(job_ids) - {job.id for job in jobs}
+            for queued in await self._queued_jobs(elsewhere):
+                finished[queued.id] = queued.finished
+                if sent.get(queued.id) != queued.version:
+                    sent[queued.id] = queued.version
+                    yield queued.message()
+
+            # Jobs dropped after the retention window count as finished
+            if job_ids and all(finished.get(job_id, True) for job_id in job_ids):
+                return
+            await asyncio.sleep(interval)
+
+    async def RecutDownload(
+        self,
+        request: downloadServer_pb2.RecutRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> downloadServer_pb2.DownloadReply:
+        if not os.path.isfile(request.Filename):
+            await context.abort(
+                grpc.StatusCode.NOT_FOUND, f"No file {request.Filename}"
+            )
+        await self._check_profile(request.Profile, context)
+        # Rewrites the whole video, so it waits its turn with postprocessing
+        return await asyncio.wrap_future(
+            self._postprocess_pool.submit(self._postprocessor.recut, request)
+        )
+
+    async def _get_job(
+        self, job_id: str, context: grpc.aio.ServicerContext
+    ) -> Job | QueuedJob:
+        job = self._jobs.get(job_id) or next(
+            iter(await self._queued_jobs([job_id])), None
+        )
+        if job is None:
+            await context.abort(grpc.StatusCode.NOT_FOUND, f"No job {job_id}")
+        return job
+
+    async def _queued_jobs(self, job_ids: Iterable[str]) -> list[QueuedJob]:
+        queue = self._queue
+        if queue is None:
+            return []
+
+        def get() -> list[QueuedJob]:
+            queued = (queue.get(job_id) for job_id in job_ids)
+            return [job for job in queued if job is not None]
+
+        return await asyncio.wrap_future(self._blocking.submit(get))
+
+    def start_queued(self, queued: QueuedJob) -> Job:
+        """Run a job claimed from the queue, under the queue's job ID."""
+        job = self._start_download(queued.request, queued.id)
+        job.keep()
+        return job
+
+    def resume_interrupted(self, journal: JobJournal, max_age: float) -> None:
+        """Restart the downloads a previous run was stopped in the middle of.
+
+        Those from the job queue are left for it to hand out again.
+        """
+        for entry in journal.pending():
+            if (
+                self._queue is not None
+                and self._queue.find(entry.video_url, entry.output_path) is not None
+            ):
+                continue
+            if time.time() - entry.updated > max_age:
+                logger.info("Discarding interrupted download of %s", entry.video_url)
+                journal.discard(entry.output_path)
+                continue
+            if entry.cancelled:
+                continue
+            if (entry.profile or "default") not in DOWNLOAD_PROFILES:
+                logger.warning(
+                    "Not resuming %s, its profile %s is gone",
+                    entry.video_url,
+                    entry.profile,
+                )
+                continue
 
-        # async def download():
-        with yt_dlp.YoutubeDL(YDL_DOWNLOAD_OPTS) as ydl:
-            status = ydl.download(request.VideoUrl)
+            logger.info(
+                "Resuming download of %s into %s from %s bytes",
+                entry.video_url,
+                entry.output_path,
+                entry.downloaded_bytes or 0,
+            )
+            request = downloadServer_pb2.DownloadRequest(
+                VideoUrl=entry.video_url,
+                OutputPath=entry.output_path,
+                Profile=entry.profile,
+            )
+            try:
+                self._start_download(request).keep()
+            except SchedulerFull:
+                # Left in the journal for the client's retry to pick up
+                logger.warning("Queue full, not resuming %s", entry.video_url)
+
+    async def _start_download_rpc(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> Job:
+        await self._check_profile(request.Profile, context)
+        await self._check_extraction(request, context)
+        try:
+            return await asyncio.wrap_future(
+                self._blocking.submit(self._start_download, request)
+            )
+        except SchedulerFull as e:
+            await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED, str(e))
+
+    def _start_download(
+        self, request: downloadServer_pb2.DownloadRequest, job_id: str | None = None
+    ) -> Job:
+        """Start downloading, or attach to the same download already running.
+
+        Clients attaching later, such as a retry after the server restarted,
+        get the same job. Raises SchedulerFull if there is no room for it.
+        """
+        key = (video_key(request.VideoUrl), request.OutputPath)
+
+        def start() -> Job:
+            ticket = self._scheduler.admit(request.VideoUrl)
+            return self._jobs.create(request, ticket, job_id)
+
+        job, started = self._downloads_in_flight.join_or_start(key, start)
+        if started:
+            if self._prefetcher is not None:
+                self._prefetcher.add(request.VideoUrl)
+            self._download_pool.submit(self._download, key, job)
+        else:
+            logger.info("Attaching to running download of %s", request.VideoUrl)
 
-        # loop = asyncio.new_event_loop()
-        # task = loop.create_task(download())
-        # loop.run_forever()
+        return job
 
-        # while not task.done():
-        #    yield response
-        #    time.sleep(1)
+    async def _check_profile(
+        self, profile: str, context: grpc.aio.ServicerContext
+    ) -> None:
+        if (profile or "default") not in DOWNLOAD_PROFILES:
+            await context.abort(
+                grpc.StatusCode.INVALID_ARGUMENT, f"No profile {profile}"
+            )
 
-        # loop.close()
+    async def _check_extraction(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        context: grpc.aio.ServicerContext,
+    ) -> None:
+        """Refuse an Extraction the client sent that can't be unpacked."""
+        if not request.HasField("Extraction"):
+            return
+        try:
+            await asyncio.wrap_future(
+                self._blocking.submit(unpack_extraction, request.Extraction)
+            )
+        except ValueError as e:
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+    def _download(self, key: tuple[str, str], job: Job) -> None:
+        response = downloadServer_pb2.DownloadReply(
+            Status=downloadServer_pb2.TEMPORARY_ERROR
+        )
+        extractor = extractor_name(job.request.VideoUrl)
+        stage = "download"
+        queued_at = time.monotonic()
+        try:
+            with job.ticket:
+                queued = ("queued", time.monotonic() - queued_at)
+                job.progress.start()
+                started_at = time.monotonic()
+                try:
+                    downloaded = self._runner.download(job.request, job.progress)
+                finally:
+                    self._observe_download(job, extractor, started_at)
+
+            if isinstance(downloaded, downloadServer_pb2.DownloadReply):
+                response = downloaded
+                if job.request.Timings:
+                    response.Timings.insert(0, timing_messages([queued])[0])
+            else:
+                downloaded[PHASE_TIMINGS].insert(0, queued)
+                job.progress.queue_postprocessing()
+                stage = "postprocess"
+                with self._postprocess_lock:
+                    self._postprocess_waiting += 1
+                response = self._postprocess_pool.submit(
+                    self._postprocess, job, downloaded, extractor, time.monotonic()
+                ).result()
+        except Exception as e:
+            if not job.progress.cancelled:
+                logger.exception("Download of %s failed", job.request.VideoUrl)
+                self._metrics.errors.inc(stage, error_class(e))
+                response = downloadServer_pb2.DownloadReply(
+                    Status=error_status(e), Error=str(e)
+                )
+        finally:
+            # Killing ffmpeg fails the job rather than raising DownloadCancelled
+            if job.progress.cancelled and response.Status != downloadServer_pb2.DONE:
+                response = self._cancelled(job)
+            job.progress.finish(response)
+            self._downloads_in_flight.done(key)
+            self._metrics.downloads.inc(
+                extractor, downloadServer_pb2.Status.Name(response.Status)
+            )
 
-        if status == 0:
-            response.Status = downloadServer_pb2.DONE
-            response.Filename = glob.glob(f"{glob.escape(request.OutputPath)}*")[0]
-        else:
-            response.Status = downloadServer_pb2.TEMPORARY_ERROR
-            response.ExitCode = status
+    def _observe_download(self, job: Job, extractor: str, started_at: float) -> None:
+        """Split the time a download held its slot into extraction and download."""
+        finished_at = time.monotonic()
+        downloading_at = job.progress.downloading_at
+        self._metrics.extraction_seconds.observe(
+            (downloading_at or finished_at) - started_at, "Download", extractor
+        )
+        if downloading_at is not None:
+            self._metrics.download_seconds.observe(
+                finished_at - downloading_at, extractor
+            )
+        self._metrics.downloaded_bytes.inc(
+            extractor, amount=job.progress.transferred_bytes
+        )
+
+    def _postprocess(
+        self, job: Job, info: dict[str, Any], extractor: str, queued_at: float
+    ) -> downloadServer_pb2.DownloadReply:
+        with self._postprocess_lock:
+            self._postprocess_waiting -= 1
+            self._postprocess_running += 1
+        info[PHASE_TIMINGS].append(("postprocess queued", time.monotonic() - queued_at))
+        try:
+            # Cancelled while waiting for a slot
+            if job.progress.cancelled:
+                return downloadServer_pb2.DownloadReply(
+                    Status=downloadServer_pb2.CANCELLED
+                )
+            started_at = time.monotonic()
+            try:
+                return self._postprocessor.postprocess(job.request, info, job.progress)
+            finally:
+                self._metrics.postprocess_seconds.observe(
+                    time.monotonic() - started_at, extractor
+                )
+        finally:
+            with self._postprocess_lock:
+                self._postprocess_running -= 1
+
+    def _cancelled(self, job: Job) -> downloadServer_pb2.DownloadReply:
+        if job.interrupted:
+            # Resumed from the journal once the server is back
+            logger.info("Interrupted download of %s", job.request.VideoUrl)
+            if JOURNAL is not None:
+                JOURNAL.release(job.request.OutputPath)
+            return downloadServer_pb2.DownloadReply(
+                Status=downloadServer_pb2.TEMPORARY_ERROR,
+                Error="The server is shutting down",
+            )
 
-        # response.Progress = 1
+        logger.info("Cancelled download of %s", job.request.VideoUrl)
+        output_path = job.request.OutputPath
 
-        return response
+        match "keep" if job.keep_partials else CANCELLED_DOWNLOADS:
+            case "keep":
+                if JOURNAL is not None:
+                    JOURNAL.hold(output_path)
+            case _:
+                remove_partials(output_path, job.progress.filenames)
+                if JOURNAL is not None:
+                    JOURNAL.finish(output_path)
 
+        return downloadServer_pb2.DownloadReply(Status=downloadServer_pb2.CANCELLED)
 
-if __name__ == "__main__":
-    logging.basicConfig()
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=2))
+    def close(self) -> None:
+        """Interrupt the downloads still running, and wait for them to stop."""
+        for job in self._jobs.jobs():
+            if not job.progress.done:
+                job.interrupt()
+        self._download_pool.shutdown()
 
-    bind_to = "0.0.0.0:30033"
-    server.add_insecure_port(bind_to)
 
-    # Create a health check servicer
-    health_servicer = health.HealthServicer(
-        experimental_non_blocking=True,
-        experimental_thread_pool=futures.ThreadPoolExecutor(max_workers=2),
+async def serve() -> None:
+    scheduler = DownloadScheduler(
+        MAX_DOWNLOADS, MAX_DOWNLOADS_PER_HOST, MAX_QUEUED_DOWNLOADS
+    )
+    runner: JobRunner
+    postprocessor: JobRunner
+    match JOB_EXECUTOR:
+        case "process":
+            runner = ProcessRunner(
+                WORKER_PROCESSES, WORKER_MAX_JOBS, WORKER_MAX_RSS_MB * 1024 * 1024
+            )
+            postprocessor = ProcessRunner(
+                POSTPROCESS_WORKERS, WORKER_MAX_JOBS, WORKER_MAX_RSS_MB * 1024 * 1024
+            )
+        case _:
+            runner = postprocessor = ThreadRunner()
+    about_cache = AboutCache(
+        ABOUT_CACHE_ENTRIES,
+        ABOUT_STATIC_TTL,
+        ABOUT_VOLATILE_TTL,
+        ABOUT_CACHE_PATH,
+        ABOUT_CACHE_DISK_ENTRIES,
+    )
+    # Worker processes only see prefetched segments through a cache file
+    prefetcher = (
+        SponsorBlockPrefetcher(SPONSORBLOCK)
+        if JOB_EXECUTOR != "process" or SPONSORBLOCK_CACHE_PATH
+        else None
+    )
+    metrics = Metrics()
+    queue: JobQueue | None
+    match JOB_QUEUE:
+        case "":
+            queue = None
+        case "memory":
+            queue = MemoryJobQueue(JOB_QUEUE_MAX_ATTEMPTS, JOB_RETENTION)
+        case _:
+            queue = SQLiteJobQueue(JOB_QUEUE, JOB_QUEUE_MAX_ATTEMPTS, JOB_RETENTION)
+    downloader = Downloader(
+        scheduler,
+        runner,
+        postprocessor,
+        about_cache,
+        JobRegistry(JOB_RETENTION),
+        prefetcher,
+        metrics,
+        queue,
+    )
+    load = LoadMonitor(
+        scheduler,
+        lambda: downloader.postprocessing,
+        OUTPUT_DIR,
+        MIN_FREE_DISK_MB * 1024 * 1024,
+        HEALTH_MAX_QUEUED,
     )
-
-    downloadServer_pb2_grpc.add_YTDownloaderServicer_to_server(Downloader(), server)
 
     # Create a tuple of all of the services we want to export via reflection.
-    services = tuple(
+    downloader_services = tuple(
         service.full_name
         for service in downloadServer_pb2.DESCRIPTOR.services_by_name.values()
-    ) + (reflection.SERVICE_NAME, health.SERVICE_NAME)
+    )
+    services = downloader_services + (reflection.SERVICE_NAME, health.SERVICE_NAME)
+
+    # RPCs waiting on downloads or extractions hold no thread, only the event loop
+    server = grpc.aio.server(
+        interceptors=[LoadReportInterceptor(load, downloader_services)]
+    )
 
-    # Mark all services as healthy.
+    bind_to = LISTEN_ADDRESS
+    server.add_insecure_port(bind_to)
+    downloadServer_pb2_grpc.add_YTDownloaderServicer_to_server(downloader, server)
+
+    # Create a health check servicer
+    health_servicer = health.aio.HealthServicer()  # pyright: ignore[reportAttributeAccessIssue]
+
+    # Mark all services as healthy, and the server as a whole and the downloader
+    # as not while it is saturated or out of disk
     health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
     for service in services:
-        health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+        await health_servicer.set(service, health_pb2.HealthCheckResponse.SERVING)
+    watching = asyncio.create_task(
+        load.watch(health_servicer, ("",) + downloader_services, HEALTH_INTERVAL)
+    )
     reflection.enable_server_reflection(services, server)
 
-    server.start()
+    await server.start()
+    if JOURNAL is not None:
+        await asyncio.to_thread(
+            downloader.resume_interrupted, JOURNAL, DOWNLOAD_RESUME_AGE
+        )
+    worker = None
+    if queue is not None:
+
+        def has_room() -> bool:
+            # Only claim what can start now, leaving the rest to idle servers
+            busy = scheduler.active + scheduler.queued
+            return busy < scheduler.max_active and load.serving(load.load())
+
+        worker = QueueWorker(
+            queue,
+            NODE_NAME,
+            JOB_QUEUE_LEASE,
+            JOB_QUEUE_POLL_INTERVAL,
+            has_room,
+            downloader.start_queued,
+        )
     print(f"YT-DLP version {yt_dlp.version.__version__}")
     print(f"Listening on {bind_to}")
-    server.wait_for_termination()
+    metrics_server = metrics.serve(METRICS_PORT) if METRICS_PORT else None
+    stopping = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(signum, stopping.set)
+    try:
+        await stopping.wait()
+    finally:
+        if worker is not None:
+            worker.close()
+        watching.cancel()
+        await server.stop(None)
+        await asyncio.to_thread(downloader.close)
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        runner.close()
+        if postprocessor is not runner:
+            postprocessor.close()
+        about_cache.close()
+        if prefetcher is not None:
+            prefetcher.close()
+        SPONSORBLOCK.close()
+        if JOURNAL is not None:
+            JOURNAL.close()
+        if queue is not None:
+            queue.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    asyncio.run(serve())
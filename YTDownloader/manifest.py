@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+from typing import Any
+
+import downloadServer_pb2
+from postprocess import uncut_path
+
+
+def _sidecars(info: dict[str, Any]) -> list[tuple[str, str, str | None]]:
+    """The files written beside the media, as (path, kind, language)."""
+    found: list[tuple[str | None, str, str | None]] = []
+    for lang, sub_info in (info.get("requested_subtitles") or {}).items():
+        found.append((sub_info.get("filepath"), "subtitle", lang))
+    for thumbnail in info.get("thumbnails") or []:
+        found.append((thumbnail.get("filepath"), "thumbnail", None))
+    infojson = info.get("infojson_filename") or info.get("__infojson_filename")
+    found.append((infojson, "infojson", None))
+    # Kept for recutting, by downloads that were cut
+    found.append((uncut_path(info["filepath"]), "uncut", None))
+
+    # Embedded or deleted ones are left behind in the info
+    seen = {info["filepath"]}
+    sidecars: list[tuple[str, str, str | None]] = []
+    for path, kind, lang in found:
+        if path and path not in seen and os.path.isfile(path):
+            seen.add(path)
+            sidecars.append((path, kind, lang))
+    return sidecars
+
+
+def _codec(codec: str | None) -> str | None:
+    return None if codec in (None, "none") else codec
+
+
+def build_manifest(
+    info: dict[str, Any], content_hash: bool
+) -> downloadServer_pb2.DownloadManifest:
+    """Describe the files a finished download left, from its info after postprocessing.
+
+    The media file is hashed straight after the postprocessor writing it
+    last, while it is still in the page cache.
+    """
+    path = info["filepath"]
+    manifest = downloadServer_pb2.DownloadManifest(
+        Media=downloadServer_pb2.DownloadedFile(
+            Path=path, Size=os.path.getsize(path), Kind="media"
+        ),
+        Container=info.get("ext") or os.path.splitext(path)[1][1:],
+    )
+
+    video_codec = _codec(info.get("vcodec"))
+    if video_codec is not None:
+        manifest.VideoCodec = video_codec
+    audio_codec = _codec(info.get("acodec"))
+    if audio_codec is not None:
+        manifest.AudioCodec = audio_codec
+
+    for sidecar, kind, lang in _sidecars(info):
+        file = manifest.Sidecars.add(
+            Path=sidecar, Size=os.path.getsize(sidecar), Kind=kind
+        )
+        if lang is not None:
+            file.Language = lang
+
+    if content_hash:
+        with open(path, "rb") as f:
+            manifest.Sha256 = hashlib.file_digest(f, "sha256").hexdigest()
+    return manifest
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import bisect
+import http.server
+import math
+import threading
+from collections import defaultdict
+from collections.abc import Callable, Sequence
+
+# Seconds, from a quick About up to a long video postprocessed on a slow disk
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+_Labels = tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: _Labels, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def expose(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: defaultdict[_Labels, float] = defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] += amount
+
+    def expose(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return super().expose() + [
+            f"{self.name}{_format_labels(self.labels, k)} {_format_value(v)}"
+            for k, v in values
+        ]
+
+
+class Gauge(_Metric):
+    """A value read when scraped, from a callback."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]) -> None:
+        super().__init__(name, help)
+        self._read = read
+
+    def expose(self) -> list[str]:
+        return super().expose() + [f"{self.name} {_format_value(self._read())}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DURATION_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # Per label values: a count per bucket, then the total count and sum
+        self._values: dict[_Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            counts, totals = self._values.setdefault(
+                labels, ([0] * len(self.buckets), [0, 0.0])
+            )
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(counts):
+                counts[index] += 1
+            totals[0] += 1
+            totals[1] += value
+
+    def expose(self) -> list[str]:
+        with self._lock:
+            values = sorted(
+                (k, list(counts), list(totals))
+                for k, (counts, totals) in self._values.items()
+            )
+
+        lines = super().expose()
+        for k, counts, (count, total) in values:
+            labels = _format_labels(self.labels, k)
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                le = f'le="{_format_value(bound)}"'
+                bucket_labels = _format_labels(self.labels, k, le)
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            bucket_labels = _format_labels(self.labels, k, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            lines.append(f"{self.name}_count{labels} {count}")
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        return lines
+
+
+class Metrics:
+    """Everything the server counts, in the Prometheus text format.
+
+    Queue depth and the like are read from `gauges` when scraped. Bytes
+    downloaded per extractor are counted as each download finishes, so
+    throughput is their rate, or their total over the download seconds.
+    """
+
+    def __init__(self) -> None:
+        self._gauges: list[Gauge] = []
+
+        self.extraction_seconds = Histogram(
+            "ytdownloader_extraction_seconds",
+            "Time extracting video info, for About or before a download starts",
+            ("rpc", "extractor"),
+        )
+        self.download_seconds = Histogram(
+            "ytdownloader_download_seconds",
+            "Time downloading, from the first byte to the file being merged",
+            ("extractor",),
+        )
+        self.postprocess_seconds = Histogram(
+            "ytdownloader_postprocess_seconds",
+            "Time postprocessing a download, without waiting for a slot",
+            ("extractor",),
+        )
+        self.downloaded_bytes = Counter(
+            "ytdownloader_downloaded_bytes_total",
+            "Bytes downloaded, not counting those resumed from partial files",
+            ("extractor",),
+        )
+        self.downloads = Counter(
+            "ytdownloader_downloads_total",
+            "Downloads finished, by final status",
+            ("extractor", "status"),
+        )
+        self.errors = Counter(
+            "ytdownloader_errors_total",
+            "Failed About calls and downloads, by stage and exception class",
+            ("stage", "error"),
+        )
+        self.about_cache = Counter(
+            "ytdownloader_about_cache_requests_total",
+            'About calls answered from the cache ("hit") or by extracting ("miss")',
+            ("result",),
+        )
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> None:
+        self._gauges.append(Gauge(name, help, read))
+
+    def expose(self) -> str:
+        metrics: list[_Metric] = [
+            *self._gauges,
+            self.extraction_seconds,
+            self.download_seconds,
+            self.postprocess_seconds,
+            self.downloaded_bytes,
+            self.downloads,
+            self.errors,
+            self.about_cache,
+        ]
+        return "\n".join(line for m in metrics for line in m.expose()) + "\n"
+
+    def serve(self, port: int) -> http.server.ThreadingHTTPServer:
+        """Serve /metrics on `port` from a background thread."""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.expose().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        server = http.server.ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
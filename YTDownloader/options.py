@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import copy
+from collections.abc import Mapping
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Final
+
+import downloadServer_pb2
+import postprocess  # noqa: F401  Registers SinglePassFFmpeg and PhaseMark
+import sponsorblock  # noqa: F401  Registers CachedSponsorBlock
+
+DEFAULT_SPONSORBLOCK_API: Final = "https://sponsor.ajay.app"
+
+# Templates only: jobs must go through JobOptions rather than handing these to yt-dlp
+YDL_DOWNLOAD_OPTS: Final[Mapping[str, Any]] = {
+    "format": "(bv[vcodec~='^(avc|h264)']+ba[acodec~='^(aac|mp?4a)']) / "
+    "(bv[vcodec~='^(vp9)']+ba[acodec=opus])",
+    "format_sort": ["res:1080"],
+    "fragment_retries": 10,
+    "ignoreerrors": "only_download",
+    "outtmpl": {"default": "test"},
+    "postprocessors": [
+        {
+            "key": "CachedSponsorBlock",
+            "api": DEFAULT_SPONSORBLOCK_API,
+            "categories": {
+                "chapter",
+                "filler",
+                "interaction",
+                "intro",
+                "music_offtopic",
+                "outro",
+                "poi_highlight",
+                "preview",
+                "selfpromo",
+                "sponsor",
+            },
+            "when": "after_filter",
+        },
+        # FFmpegEmbedSubtitle, ModifyChapters and FFmpegMetadata, without
+        # rewriting the video for each of them
+        {
+            "key": "SinglePassFFmpeg",
+            "already_have_subtitle": False,
+            "force_keyframes": False,
+            "remove_chapters_patterns": [],
+            "remove_ranges": [],
+            "remove_sponsor_segments": {"interaction", "selfpromo", "sponsor"},
+            "sponsorblock_chapter_title": "[SponsorBlock]: %(category_names)l",
+            "add_chapters": True,
+            "add_metadata": True,
+        },
+        {"key": "EmbedThumbnail", "already_have_thumbnail": False},
+    ],
+    "retries": 10,
+    "writeautomaticsub": True,
+}
+
+YDL_OPTS: Final[Mapping[str, Any]] = {
+    "fragment_retries": 10,
+    "ignoreerrors": "only_download",
+    "outtmpl": {"default": "test", "pl_thumbnail": ""},
+    "retries": 10,
+}
+
+# Where extraction ends and each later phase starts, for timings.PhaseTimer
+PHASE_MARKERS: Final = (
+    {"key": "PhaseMark", "phase": "format resolution", "when": "pre_process"},
+    {"key": "PhaseMark", "phase": "sidecars", "when": "video"},
+    {"key": "PhaseMark", "phase": "download", "when": "before_dl"},
+)
+
+
+# Download templates by profile name, more of them loaded by jobs from a file
+DOWNLOAD_PROFILES: dict[str, Mapping[str, Any]] = {"default": YDL_DOWNLOAD_OPTS}
+
+
+def add_profile(name: str, options: Mapping[str, Any]) -> None:
+    """Make a download template of options compiled by `profiles`.
+
+    Retries default to those of the built in template, while errors are
+    always left for `jobs` to handle from the exit code.
+    """
+    DOWNLOAD_PROFILES[name] = MappingProxyType(
+        {
+            "fragment_retries": YDL_DOWNLOAD_OPTS["fragment_retries"],
+            "retries": YDL_DOWNLOAD_OPTS["retries"],
+            **options,
+            "ignoreerrors": YDL_DOWNLOAD_OPTS["ignoreerrors"],
+            "outtmpl": YDL_DOWNLOAD_OPTS["outtmpl"],
+        }
+    )
+
+
+def output_prefix(output_path: str) -> str:
+    """What every file named by the output template `output_path` starts with.
+
+    That is the text before its first field, such as "x." for x.%(ext)s, or
+    all of it for a plain path.
+    """
+    return output_path.split("%(", 1)[0]
+
+
+def _profile(name: str) -> Mapping[str, Any]:
+    return DOWNLOAD_PROFILES[name or "default"]
+
+
+def _postprocessors(
+    template: Mapping[str, Any], after_download: bool
+) -> list[dict[str, Any]]:
+    """The download postprocessors run on the finished file, or all the others.
+
+    Those without a `when` run once yt-dlp has downloaded and merged the file.
+    """
+    return [
+        pp
+        for pp in template.get("postprocessors", [])
+        if (pp.get("when", "post_process") == "post_process") == after_download
+    ]
+
+
+def _recut_postprocessors(template: Mapping[str, Any]) -> list[dict[str, Any]]:
+    """SponsorBlock and the cutting half of SinglePassFFmpeg, as downloads use them."""
+    by_key = {pp["key"]: pp for pp in template.get("postprocessors", [])}
+    sponsorblock_pp = by_key.get("CachedSponsorBlock", {"key": "CachedSponsorBlock"})
+    segments = {k: v for k, v in sponsorblock_pp.items() if k != "when"}
+    single_pass = by_key.get("SinglePassFFmpeg", {})
+    recut = {
+        k: single_pass[k]
+        for k in (
+            "force_keyframes",
+            "remove_chapters_patterns",
+            "remove_ranges",
+            "remove_sponsor_segments",
+            "sponsorblock_chapter_title",
+        )
+        if k in single_pass
+    }
+    return [segments, {"key": "Recut", **recut}]
+
+
+@dataclass(frozen=True)
+class JobOptions:
+    """The yt-dlp options for a single job.
+
+    Built from a deep copy of the templates above, so concurrent jobs never
+    share mutable state. yt-dlp writes to the params it is given, so
+    `ydl_params` hands out a fresh copy for every YoutubeDL instance.
+    """
+
+    params: Mapping[str, Any]
+
+    @classmethod
+    def for_about(cls) -> "JobOptions":
+        # Raise extraction errors rather than returning no info, so callers can
+        # tell a private video from a network blip
+        return cls._from_template(
+            YDL_OPTS, {"ignoreerrors": False, "postprocessors": list(PHASE_MARKERS)}
+        )
+
+    @classmethod
+    def for_playlist(cls) -> "JobOptions":
+        return cls._from_template(
+            YDL_OPTS,
+            {
+                "extract_flat": "in_playlist",
+                "ignoreerrors": False,
+                "lazy_playlist": True,
+            },
+        )
+
+    @classmethod
+    def for_download(
+        cls,
+        request: downloadServer_pb2.DownloadRequest,
+        format_ids: str | None = None,
+    ) -> "JobOptions":
+        template = _profile(request.Profile)
+        overrides: dict[str, Any] = {
+            "outtmpl": {"default": request.OutputPath},
+            "postprocessors": _postprocessors(template, after_download=False)
+            + list(PHASE_MARKERS),
+        }
+        if format_ids:
+            # Prefer the formats an interrupted attempt chose, so it can carry
+            # on from its partial files, falling back to choosing afresh
+            fallback = template.get("format", "bestvideo*+bestaudio/best")
+            overrides["format"] = f"{format_ids}/{fallback}"
+        return cls._from_template(template, overrides)
+
+    @classmethod
+    def for_postprocess(
+        cls, request: downloadServer_pb2.DownloadRequest
+    ) -> "JobOptions":
+        """The postprocessors `for_download` leaves out, run once it has finished."""
+        template = _profile(request.Profile)
+        return cls._from_template(
+            template,
+            {
+                "outtmpl": {"default": request.OutputPath},
+                "postprocessors": _postprocessors(template, after_download=True),
+            },
+        )
+
+    @classmethod
+    def for_recut(cls, request: downloadServer_pb2.RecutRequest) -> "JobOptions":
+        """Extraction for `jobs.recut`, with postprocessors to run on the original."""
+        return cls._from_template(
+            YDL_OPTS,
+            {
+                "ignoreerrors": False,
+                "postprocessors": _recut_postprocessors(_profile(request.Profile)),
+            },
+        )
+
+    @classmethod
+    def _from_template(
+        cls, template: Mapping[str, Any], overrides: Mapping[str, Any]
+    ) -> "JobOptions":
+        params = copy.deepcopy(dict(template))
+        params.update(copy.deepcopy(dict(overrides)))
+        return cls(MappingProxyType(params))
+
+    def ydl_params(self) -> dict[str, Any]:
+        return copy.deepcopy(dict(self.params))
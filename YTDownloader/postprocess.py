@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+# pyright: reportPrivateUsage=false
+import copy
+import itertools
+import os
+import shutil
+from collections.abc import Collection, Iterable
+from typing import Any
+
+from yt_dlp.globals import postprocessors
+from yt_dlp.postprocessor.common import PostProcessor
+from yt_dlp.postprocessor.ffmpeg import FFmpegMetadataPP
+from yt_dlp.postprocessor.modify_chapters import (
+    DEFAULT_SPONSORBLOCK_CHAPTER_TITLE,
+    ModifyChaptersPP,
+)
+from yt_dlp.utils import ISO639Utils, PostProcessingError, prepend_extension
+
+SUBTITLE_EXTS = ("mp4", "mov", "m4a", "webm", "mkv", "mka")
+# Containers ffmpeg can add a cover to while copying everything else
+MATROSKA_EXTS = ("mkv", "mka")
+COVER_EXTS = ("mp4", "mov", "m4v", *MATROSKA_EXTS)
+# Covers the others take without converting them first
+COVER_IMAGE_EXTS = ("jpg", "jpeg", "png")
+
+
+class SinglePassFFmpegPP(ModifyChaptersPP):
+    """Embeds subtitles, cuts chapters and adds metadata in one ffmpeg run.
+
+    Running FFmpegEmbedSubtitle, ModifyChapters, FFmpegMetadata and
+    EmbedThumbnail one after another rewrites the whole video up to four
+    times. This does the same work, with the same options, but only writes
+    the video once: cuts go through the concat demuxer as an input, while
+    subtitles, the chapters file and the cover are further inputs of the
+    same command. Only the subtitle files are cut separately beforehand.
+
+    Covers are embedded for the containers ffmpeg can attach them to, and
+    taken off the info so a following EmbedThumbnail only handles the rest.
+    `embed_subtitles` and `embed_thumbnail` leave out the parts whose
+    postprocessor was not asked for.
+
+    Videos it cuts are also written uncut by the same command, with the
+    same subtitles, chapters, metadata and cover, to `uncut_path` for
+    RecutPP. That doubles the space they take, so `keep_uncut` turns it off.
+    """
+
+    # Whether cut videos keep their uncut original at `uncut_path` for RecutPP
+    keep_uncut = True
+
+    def __init__(
+        self,
+        downloader: Any = None,
+        remove_chapters_patterns: Iterable[Any] | None = None,
+        remove_sponsor_segments: Collection[str] | None = None,
+        remove_ranges: Iterable[tuple[float, float]] | None = None,
+        *,
+        sponsorblock_chapter_title: str = DEFAULT_SPONSORBLOCK_CHAPTER_TITLE,
+        force_keyframes: bool = False,
+        add_metadata: bool = True,
+        add_chapters: bool = True,
+        embed_subtitles: bool = True,
+        already_have_subtitle: bool = False,
+        embed_thumbnail: bool = True,
+        already_have_thumbnail: bool = False,
+    ) -> None:
+        super().__init__(
+            downloader,
+            remove_chapters_patterns,
+            remove_sponsor_segments,
+            remove_ranges,
+            sponsorblock_chapter_title=sponsorblock_chapter_title,
+            force_keyframes=force_keyframes,
+        )
+        # Only used to build options, never run
+        self._metadata = FFmpegMetadataPP(downloader, add_metadata, add_chapters)
+        self._add_metadata = add_metadata
+        self._add_chapters = add_chapters
+        self._embed_subtitles = embed_subtitles
+        self._embed_thumbnail = embed_thumbnail
+        self._already_have_subtitle = already_have_subtitle
+        self._already_have_thumbnail = already_have_thumbnail
+
+    @PostProcessor._restrict_to(images=False)  # pyright: ignore[reportAttributeAccessIssue]
+    def run(self, info: dict[str, Any]) -> tuple[list[str], dict[str, Any]]:
+        filename = info["filepath"]
+        audio_only = info["ext"] == "m4a"
+        self._fixup_chapters(info)
+        # The uncut original gets them as they were downloaded
+        chapters = info.get("chapters")
+
+        # Our own intermediate files, always removed
+        scratch: list[str] = []
+        # Subtitles as they were before being cut, by the file they were cut in
+        uncut_subs: dict[str, str] = {}
+
+        inputs: list[tuple[str, list[str]]] = [(filename, [])]
+        thumbnail = None
+
+        try:
+            cut = self._cut(info)
+            keep_uncut = cut is not None and self.keep_uncut
+            if cut is not None:
+                cuts, concat_opts = cut
+                inputs[0] = self._concat_input(info, cuts, concat_opts, scratch)
+                for sub_file in self._get_supported_subs(info):
+                    cut_file = self.remove_chapters(sub_file, cuts, concat_opts)
+                    if keep_uncut:
+                        uncut_subs[sub_file] = uncut_path(sub_file)
+                        scratch.append(uncut_subs[sub_file])
+                        os.replace(sub_file, uncut_subs[sub_file])
+                    os.replace(cut_file, sub_file)
+
+            subtitles = self._subtitles(info) if self._embed_subtitles else []
+            if self._embed_thumbnail and not audio_only:
+                thumbnail = self._cover(info)
+            opts = self._embed_opts(
+                info, 0, subtitles, info.get("chapters"), thumbnail, inputs, scratch
+            )
+            if cut is None and not opts:
+                self.to_screen("There is nothing to embed or cut")
+                return [], info
+
+            temp_filename = prepend_extension(filename, "temp")
+            outputs = [(temp_filename, self._stream_copy_opts(info, 0) + opts)]
+            if keep_uncut:
+                # Written by the same run, with everything the cut video gets,
+                # so RecutPP has more than the bare video and audio to start from
+                source = len(inputs)
+                inputs.append((filename, []))
+                uncut_subtitles = [
+                    (lang, name, uncut_subs.get(sub_file, sub_file))
+                    for lang, name, sub_file in subtitles
+                ]
+                opts = self._embed_opts(
+                    info, source, uncut_subtitles, chapters, thumbnail, inputs, scratch
+                )
+                outputs.append(
+                    (
+                        prepend_extension(uncut_path(filename), "temp"),
+                        self._stream_copy_opts(info, source) + opts,
+                    )
+                )
+
+            mtime = os.stat(filename).st_mtime
+            self.to_screen(f'Embedding and cutting in one pass for "{filename}"')
+            self.real_run_ffmpeg(inputs, outputs)
+            if keep_uncut:
+                os.replace(outputs[1][0], uncut_path(filename))
+                self.try_utime(uncut_path(filename), mtime, mtime)
+            os.replace(temp_filename, filename)
+            self.try_utime(filename, mtime, mtime)
+        finally:
+            self._delete_downloaded_files(*scratch, msg=None)
+
+        files_to_delete: list[str] = []
+        if not self._already_have_subtitle:
+            files_to_delete += [sub_file for _, _, sub_file in subtitles]
+        if thumbnail is not None and not self._already_have_thumbnail:
+            files_to_delete.append(thumbnail)
+        return files_to_delete, info
+
+    def _stream_copy_opts(self, info: dict[str, Any], source: int) -> list[str]:
+        """Copy the streams of input `source`, as yt-dlp's postprocessors do."""
+        audio_only = info["ext"] == "m4a"
+        # All but the -map 0 it starts with
+        opts = ["-map", str(source)]
+        opts += itertools.islice(
+            self.stream_copy_opts(not audio_only, ext=info["ext"]), 2, None
+        )
+        if audio_only:
+            opts += ["-vn", "-acodec", "copy"]
+        return opts
+
+    def _embed_opts(
+        self,
+        info: dict[str, Any],
+        source: int,
+        subtitles: list[tuple[str, str | None, str]],
+        chapters: list[dict[str, Any]] | None,
+        thumbnail: str | None,
+        inputs: list[tuple[str, list[str]]],
+        scratch: list[str],
+    ) -> list[str]:
+        """Options adding the subtitles, chapters, metadata and cover to `source`.
+
+        Appends the further inputs they need to `inputs`, and the chapters
+        file it writes for them to `scratch`. No options if there is nothing
+        to add.
+        """
+        opts: list[str] = []
+        if subtitles:
+            # Don't copy existing subtitles, like FFmpegEmbedSubtitle
+            opts += ["-map", f"-{source}:s"]
+        for i, (lang, name, sub_file) in enumerate(subtitles):
+            opts += ["-map", f"{len(inputs)}:0"]
+            inputs.append((sub_file, []))
+            lang_code = ISO639Utils.short2long(lang) or lang
+            opts += [f"-metadata:s:s:{i}", f"language={lang_code}"]
+            if name:
+                opts += [f"-metadata:s:s:{i}", f"handler_name={name}"]
+                opts += [f"-metadata:s:s:{i}", f"title={name}"]
+
+        if self._add_chapters and chapters:
+            metadata_filename = prepend_extension(
+                info["filepath"], "meta" if source == 0 else "uncut.meta"
+            )
+            scratch.append(metadata_filename)
+            # Writes the file as it goes, its option assumes it is input 1
+            for _ in self._metadata._get_chapter_opts(chapters, metadata_filename):
+                pass
+            opts += ["-map_metadata", str(len(inputs))]
+            opts += ["-map_chapters", str(len(inputs))]
+            inputs.append((metadata_filename, []))
+        elif source != 0:
+            # ffmpeg would take them from the first input
+            opts += ["-map_metadata", str(source), "-map_chapters", str(source)]
+
+        if self._add_metadata:
+            opts += itertools.chain.from_iterable(
+                self._metadata._get_metadata_opts(info)
+            )
+
+        if thumbnail is not None:
+            opts += self._cover_opts(info, thumbnail, len(inputs))
+            if info["ext"] not in MATROSKA_EXTS:
+                inputs.append((thumbnail, []))
+        return opts
+
+    def _cut(
+        self, info: dict[str, Any]
+    ) -> tuple[list[dict[str, Any]], list[dict[str, str]]] | None:
+        """The ranges to cut and their concat options, like ModifyChapters.
+
+        Updates the chapters and duration in `info` the same way it does.
+        """
+        chapters, sponsor_chapters = self._mark_chapters_to_remove(
+            copy.deepcopy(info.get("chapters")) or [],
+            copy.deepcopy(info.get("sponsorblock_chapters")) or [],
+        )
+        if not chapters and not sponsor_chapters:
+            return None
+
+        real_duration = self._get_real_video_duration(info["filepath"])
+        if not chapters:
+            chapters = [
+                {
+                    "start_time": 0,
+                    "end_time": info.get("duration") or real_duration,
+                    "title": info["title"],
+                }
+            ]
+
+        info["chapters"], cuts = self._remove_marked_arrange_sponsors(
+            chapters + sponsor_chapters
+        )
+        if not cuts:
+            return None
+        if not info["chapters"]:
+            self.report_warning(
+                "You have requested to remove the entire video, which is not possible"
+            )
+            return None
+
+        original_duration, info["duration"] = (
+            info.get("duration"),
+            info["chapters"][-1]["end_time"],
+        )
+        if self._duration_mismatch(real_duration, original_duration, 1):
+            if not self._duration_mismatch(real_duration, info["duration"]):
+                self.to_screen("Skipping cuts, the video appears to be already cut")
+                return None
+            if not info.get("__real_download"):
+                raise PostProcessingError(
+                    "Cannot cut video since the real and expected durations "
+                    "mismatch. Different chapters may have already been removed"
+                )
+            self.write_debug("Expected and actual durations mismatch")
+
+        return cuts, self._make_concat_opts(cuts, real_duration)
+
+    def _concat_input(
+        self,
+        info: dict[str, Any],
+        cuts: list[dict[str, Any]],
+        concat_opts: list[dict[str, str]],
+        scratch: list[str],
+    ) -> tuple[str, list[str]]:
+        in_file = info["filepath"]
+        if self._force_keyframes:
+            in_file = self.force_keyframes(
+                in_file, (t for c in cuts for t in (c["start_time"], c["end_time"]))
+            )
+            scratch.append(in_file)
+
+        concat_file = prepend_extension(info["filepath"], "concat")
+        scratch.append(concat_file)
+        with open(concat_file, "w", encoding="utf-8") as f:
+            f.writelines(self._concat_spec([in_file] * len(concat_opts), concat_opts))
+        return concat_file, ["-hide_banner", "-nostdin", "-f", "concat", "-safe", "0"]
+
+    def _subtitles(self, info: dict[str, Any]) -> list[tuple[str, str | None, str]]:
+        """The subtitles FFmpegEmbedSubtitle would embed, as (language, name, file)."""
+        ext = info["ext"]
+        subtitles = info.get("requested_subtitles")
+        if not subtitles:
+            return []
+        if ext not in SUBTITLE_EXTS:
+            self.to_screen(
+                f"Subtitles can only be embedded in {', '.join(SUBTITLE_EXTS)} files"
+            )
+            return []
+
+        found: list[tuple[str, str | None, str]] = []
+        for lang, sub_info in subtitles.items():
+            if not os.path.exists(sub_info.get("filepath", "")):
+                self.report_warning(
+                    f"Skipping embedding {lang} subtitle because the file is missing"
+                )
+                continue
+            sub_ext = sub_info["ext"]
+            if sub_ext == "json":
+                self.report_warning("JSON subtitles cannot be embedded")
+            elif ext != "webm" or sub_ext == "vtt":
+                found.append((lang, sub_info.get("name"), sub_info["filepath"]))
+            else:
+                self.report_warning("Only WebVTT subtitles can be embedded in webm")
+        return found
+
+    def _cover(self, info: dict[str, Any]) -> str | None:
+        """The thumbnail on disk to embed as the cover, if ffmpeg can here."""
+        if info["ext"] not in COVER_EXTS:
+            return None
+
+        for thumbnail in reversed(info.get("thumbnails") or []):
+            path = thumbnail.get("filepath")
+            if not path:
+                continue
+            if not os.path.exists(path):
+                return None
+            image_ext = os.path.splitext(path)[1][1:].lower()
+            if info["ext"] not in MATROSKA_EXTS and image_ext not in COVER_IMAGE_EXTS:
+                # EmbedThumbnail converts it first
+                return None
+            # EmbedThumbnail only looks at thumbnails on disk
+            del thumbnail["filepath"]
+            return path
+
+        return None
+
+    def _cover_opts(
+        self, info: dict[str, Any], thumbnail: str, index: int
+    ) -> list[str]:
+        thumbnail_ext = os.path.splitext(thumbnail)[1][1:].lower()
+        if info["ext"] in MATROSKA_EXTS:
+            mimetype = f"image/{thumbnail_ext.replace('jpg', 'jpeg')}"
+            return [
+                "-attach",
+                self._ffmpeg_filename_argument(thumbnail),
+                "-metadata:s:t",
+                f"mimetype={mimetype}",
+                "-metadata:s:t",
+                f"filename=cover.{thumbnail_ext}",
+            ]
+
+        # The cover follows the video streams of the first input
+        videos = sum(
+            1
+            for f in info.get("requested_formats") or [info]
+            if f.get("vcodec") != "none"
+        )
+        return ["-map", str(index), f"-disposition:v:{videos}", "attached_pic"]
+
+
+def uncut_path(filename: str) -> str:
+    """Where the uncut original of a download is kept once it has been cut."""
+    return prepend_extension(filename, "uncut")
+
+
+class RecutPP(SinglePassFFmpegPP):
+    """Cuts a download again from the uncut original `uncut_path` kept.
+
+    Takes the original as `filepath`, and writes the cut video to the path
+    it was kept for, leaving the original alone for the next recut. Streams
+    and metadata already in the original are copied as they are, while the
+    chapters are rebuilt from those in `info` and its SponsorBlock segments.
+    """
+
+    def __init__(
+        self,
+        downloader: Any = None,
+        remove_chapters_patterns: Iterable[Any] | None = None,
+        remove_sponsor_segments: Collection[str] | None = None,
+        remove_ranges: Iterable[tuple[float, float]] | None = None,
+        *,
+        sponsorblock_chapter_title: str = DEFAULT_SPONSORBLOCK_CHAPTER_TITLE,
+        force_keyframes: bool = False,
+    ) -> None:
+        super().__init__(
+            downloader,
+            remove_chapters_patterns,
+            remove_sponsor_segments,
+            remove_ranges,
+            sponsorblock_chapter_title=sponsorblock_chapter_title,
+            force_keyframes=force_keyframes,
+            add_metadata=False,
+            embed_subtitles=False,
+            embed_thumbnail=False,
+        )
+
+    @PostProcessor._restrict_to(images=False)  # pyright: ignore[reportAttributeAccessIssue]
+    def run(self, info: dict[str, Any]) -> tuple[list[str], dict[str, Any]]:
+        original = info["filepath"]
+        root, ext = os.path.splitext(original)
+        filename = root.removesuffix(".uncut") + ext
+        self._fixup_chapters(info)
+
+        real_duration = self._get_real_video_duration(original)
+        if self._duration_mismatch(real_duration, info.get("duration"), 1):
+            raise PostProcessingError(
+                f"{original} is shorter than the video, so it may already be cut"
+            )
+
+        scratch: list[str] = []
+        temp_filename = prepend_extension(filename, "temp")
+        try:
+            cut = self._cut(info)
+            if cut is None:
+                self.to_screen("Nothing to cut, restoring the uncut video")
+                shutil.copyfile(original, temp_filename)
+            else:
+                cuts, concat_opts = cut
+                inputs = [
+                    self._concat_input(info, cuts, concat_opts, scratch),
+                    (original, []),
+                ]
+                opts = self._copy_opts(original, ext[1:])
+
+                metadata_filename = prepend_extension(filename, "meta")
+                scratch.append(metadata_filename)
+                for _ in self._metadata._get_chapter_opts(
+                    info["chapters"], metadata_filename
+                ):
+                    pass
+                opts += ["-map_metadata", "1", "-map_chapters", "2"]
+                inputs.append((metadata_filename, []))
+
+                self.to_screen(f'Cutting "{original}" again into "{filename}"')
+                self.real_run_ffmpeg(inputs, [(temp_filename, opts)])
+            os.replace(temp_filename, filename)
+        finally:
+            self._delete_downloaded_files(*scratch, msg=None)
+
+        info["filepath"] = filename
+        return [], info
+
+    def _copy_opts(self, original: str, ext: str) -> list[str]:
+        """Copy every stream, cut through the concat demuxer as input 0.
+
+        Covers and attachments come whole from the original as input 1, as
+        the concat demuxer would only give them to the first part.
+        """
+        opts: list[str] = []
+        videos = 0
+        for stream in self.get_metadata_object(original)["streams"]:
+            kind = stream.get("codec_type")
+            if kind == "data":
+                continue
+            whole = kind == "attachment" or bool(
+                stream.get("disposition", {}).get("attached_pic")
+            )
+            opts += ["-map", f"{1 if whole else 0}:{stream['index']}"]
+            if kind == "video":
+                if whole:
+                    opts += [f"-disposition:v:{videos}", "attached_pic"]
+                videos += 1
+
+        opts += ["-c", "copy"]
+        if ext in ("mp4", "mov", "m4a", "m4v"):
+            opts += ["-movflags", "+faststart"]
+        return opts
+
+
+class PhaseMarkPP(PostProcessor):
+    """Does nothing, but tells `timings.PhaseTimer` yt-dlp has reached `phase`.
+
+    yt-dlp has no hooks between extracting, choosing formats and
+    downloading, but does run postprocessors at each of those points.
+    """
+
+    def __init__(self, downloader: Any = None, phase: str = "") -> None:
+        super().__init__(downloader)
+        self._phase = phase
+
+    def run(self, information: dict[str, Any]) -> tuple[list[str], dict[str, Any]]:  # pyright: ignore[reportIncompatibleMethodOverride]
+        return [], information
+
+    def _hook_progress(self, status: dict[str, Any], info_dict: dict[str, Any]) -> None:
+        super()._hook_progress(  # pyright: ignore[reportAttributeAccessIssue]
+            {**status, "phase": self._phase}, info_dict
+        )
+
+
+# Lets options refer to them by key, the same as yt-dlp's own postprocessors
+postprocessors.value["SinglePassFFmpegPP"] = SinglePassFFmpegPP
+postprocessors.value["RecutPP"] = RecutPP
+postprocessors.value["PhaseMarkPP"] = PhaseMarkPP
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import functools
+import shlex
+import tomllib
+from collections.abc import Sequence
+from typing import Any
+
+import yt_dlp
+import yt_dlp.options
+
+_create_parser = yt_dlp.options.create_parser
+
+# Defaults the command line differs from the API in, kept as the API has them
+_API_DEFAULTS = {
+    "ignoreerrors": False,
+    "retries": 0,
+    "fragment_retries": 0,
+    "extract_flat": False,
+    "concat_playlist": "never",
+}
+
+# yt-dlp postprocessors SinglePassFFmpeg does the work of, with their options
+_SINGLE_PASS = {
+    "FFmpegEmbedSubtitle": ("already_have_subtitle",),
+    "ModifyChapters": (
+        "force_keyframes",
+        "remove_chapters_patterns",
+        "remove_ranges",
+        "remove_sponsor_segments",
+        "sponsorblock_chapter_title",
+    ),
+    "FFmpegMetadata": ("add_chapters", "add_metadata"),
+}
+
+
+def _parse(args: Sequence[str]) -> dict[str, Any]:
+    parser = _create_parser()
+    parser.defaults.update(_API_DEFAULTS)
+    yt_dlp.options.create_parser = lambda: parser
+    try:
+        return dict(yt_dlp.parse_options(list(args)).ydl_opts)
+    finally:
+        yt_dlp.options.create_parser = _create_parser
+
+
+@functools.cache
+def _defaults() -> dict[str, Any]:
+    return _parse([])
+
+
+def cli_to_api(args: Sequence[str]) -> dict[str, Any]:
+    """The API options `args` set, as NetworkPlaybackAgent/cli_to_api.py has them."""
+    defaults = _defaults()
+    options = {k: v for k, v in _parse(args).items() if defaults[k] != v}
+    if "postprocessors" in options:
+        options["postprocessors"] = [
+            pp
+            for pp in options["postprocessors"]
+            if pp not in defaults["postprocessors"]
+        ]
+    return options
+
+
+def _postprocessors(pps: list[dict[str, Any]]) -> list[dict[str, Any]]:
+    """`pps`, with ours in place of the yt-dlp postprocessors they replace.
+
+    Each run of FFmpegEmbedSubtitle, ModifyChapters and FFmpegMetadata
+    becomes one SinglePassFFmpeg, embedding the cover if EmbedThumbnail
+    follows it.
+    """
+    compiled: list[dict[str, Any]] = []
+    single_pass: dict[str, Any] | None = None
+    folded: set[str] = set()
+    for pp in pps:
+        key = pp["key"]
+        if key in _SINGLE_PASS:
+            if single_pass is None or key in folded:
+                single_pass = {
+                    "key": "SinglePassFFmpeg",
+                    "embed_subtitles": False,
+                    "embed_thumbnail": False,
+                    "add_chapters": False,
+                    "add_metadata": False,
+                }
+                folded = set()
+                compiled.append(single_pass)
+            folded.add(key)
+            single_pass.update({k: pp[k] for k in _SINGLE_PASS[key] if k in pp})
+            if key == "FFmpegEmbedSubtitle":
+                single_pass["embed_subtitles"] = True
+            continue
+
+        if key == "EmbedThumbnail" and single_pass is not None:
+            single_pass["embed_thumbnail"] = True
+            single_pass["already_have_thumbnail"] = pp["already_have_thumbnail"]
+        elif key == "SponsorBlock":
+            pp = {**pp, "key": "CachedSponsorBlock"}
+        compiled.append(pp)
+        single_pass = None
+
+    return compiled
+
+
+def compile_profile(args: str | Sequence[str]) -> dict[str, Any]:
+    """The yt-dlp options for a profile's command line arguments."""
+    if isinstance(args, str):
+        args = shlex.split(args)
+    options = cli_to_api(args)
+    if "postprocessors" in options:
+        options["postprocessors"] = _postprocessors(options["postprocessors"])
+    return options
+
+
+def load_profiles(path: str) -> dict[str, dict[str, Any]]:
+    """The yt-dlp options for every profile in a TOML file, by name.
+
+    The file maps each name to its command line arguments, as a string or
+    a list, which are translated once here:
+
+        archive = "-S res:2160 --sponsorblock-mark all --embed-subs --embed-metadata"
+        fast = ["-S", "res:480", "--embed-metadata"]
+        audio-only = "-x --audio-format opus --embed-metadata --embed-thumbnail"
+    """
+    with open(path, "rb") as f:
+        config = tomllib.load(f)
+
+    profiles: dict[str, dict[str, Any]] = {}
+    for name, args in config.items():
+        if not isinstance(args, (str, list)):
+            raise ValueError(f"Profile {name} must be a string or a list of arguments")
+        profiles[name] = compile_profile(args)  # pyright: ignore[reportUnknownArgumentType]
+    return profiles
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections.abc import AsyncIterator, Callable
+from typing import Any
+
+import downloadServer_pb2
+from wakeups import Wakeups
+from yt_dlp.utils import DownloadCancelled
+
+
+class DownloadProgress:
+    """Collects yt-dlp progress and postprocessor hooks into DownloadReply snapshots.
+
+    The hooks are called on the thread running yt-dlp, while `updates` is
+    consumed on the event loop by the gRPC handler streaming the replies back
+    to the client.
+    `on_change` is called after every change, with no lock held.
+    """
+
+    def __init__(self, on_change: Callable[[], None] | None = None) -> None:
+        self._changed = threading.Condition()
+        self._wakeups = Wakeups()
+        self._on_change = on_change
+        self._reply = downloadServer_pb2.DownloadReply(
+            Status=downloadServer_pb2.STARTING, Stage=downloadServer_pb2.QUEUED
+        )
+        self._version = 0
+        self._done = False
+        self._cancelled = False
+        self._on_cancel: Callable[[], None] | None = None
+        # Bytes each file started from and got to, which differ when resumed
+        self._files: dict[str, tuple[int, int]] = {}
+        # Every file yt-dlp reported downloading into, final and temporary names
+        self._filenames: set[str] = set()
+        self.finished_at: float | None = None
+        # When the first byte arrived, after extraction
+        self.downloading_at: float | None = None
+
+    @property
+    def version(self) -> int:
+        """Increases with every change, so watchers can tell what they have seen."""
+        with self._changed:
+            return self._version
+
+    @property
+    def done(self) -> bool:
+        with self._changed:
+            return self._done
+
+    @property
+    def transferred_bytes(self) -> int:
+        """Bytes downloaded so far, leaving out any resumed from partial files."""
+        with self._changed:
+            return sum(last - first for first, last in self._files.values())
+
+    @property
+    def filenames(self) -> list[str]:
+        """The files downloaded into so far, subtitles included, before merging."""
+        with self._changed:
+            return sorted(self._filenames)
+
+    @property
+    def cancelled(self) -> bool:
+        with self._changed:
+            return self._cancelled
+
+    def cancel(self) -> None:
+        """Make the next hook call stop yt-dlp, and call the `on_cancel` callback."""
+        with self._changed:
+            self._cancelled = True
+            callback = self._on_cancel
+        if callback is not None:
+            callback()
+
+    def on_cancel(self, callback: Callable[[], None] | None) -> None:
+        """Set a callback stopping whatever the hooks cannot, such as ffmpeg.
+
+        It is called straight away if the download is already cancelled.
+        """
+        with self._changed:
+            self._on_cancel = callback
+            cancelled = self._cancelled
+        if callback is not None and cancelled:
+            callback()
+
+    def start(self) -> None:
+        with self._changed:
+            self._reply.Stage = downloadServer_pb2.EXTRACTING
+            self._changed_locked()
+        self._notify()
+
+    def queue_postprocessing(self) -> None:
+        """Note the download is done, and waiting for a postprocessing slot."""
+        with self._changed:
+            self._reply.Stage = downloadServer_pb2.QUEUED
+            self._changed_locked()
+        self._notify()
+
+    def progress_hook(self, d: dict[str, Any]) -> None:
+        with self._changed:
+            if self._cancelled:
+                raise DownloadCancelled()
+            reply = self._reply
+            reply.Status = downloadServer_pb2.IN_PROGRESS
+            reply.Stage = downloadServer_pb2.DOWNLOADING
+            if self.downloading_at is None:
+                self.downloading_at = time.monotonic()
+
+            if d.get("filename") is not None:
+                reply.Filename = d["filename"]
+            for key in ("filename", "tmpfilename"):
+                if d.get(key):
+                    self._filenames.add(d[key])
+
+            downloaded = d.get("downloaded_bytes")
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            if downloaded is not None:
+                reply.DownloadedBytes = int(downloaded)
+                name = d.get("tmpfilename") or d.get("filename") or ""
+                first = self._files.get(name, (int(downloaded), 0))[0]
+                self._files[name] = (first, int(downloaded))
+            if total:
+                reply.TotalBytes = int(total)
+                if downloaded is not None:
+                    reply.Progress = min(float(downloaded) / total, 1.0)
+
+            if d["status"] == "finished":
+                reply.Progress = 1.0
+                reply.ClearField("Speed")
+                reply.ClearField("Eta")
+            else:
+                if d.get("speed") is not None:
+                    reply.Speed = float(d["speed"])
+                if d.get("eta") is not None:
+                    reply.Eta = int(d["eta"])
+
+            self._changed_locked()
+        self._notify()
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None:
+        with self._changed:
+            if self._cancelled:
+                raise DownloadCancelled()
+            reply = self._reply
+            reply.Status = downloadServer_pb2.IN_PROGRESS
+            reply.Stage = (
+                downloadServer_pb2.MERGING
+                if d["postprocessor"] == "Merger"
+                else downloadServer_pb2.POSTPROCESSING
+            )
+            reply.ClearField("Speed")
+            reply.ClearField("Eta")
+            self._changed_locked()
+        self._notify()
+
+    def finish(self, reply: downloadServer_pb2.DownloadReply) -> None:
+        with self._changed:
+            self._reply = reply
+            self._done = True
+            self.finished_at = time.monotonic()
+            self._changed_locked()
+        self._notify()
+
+    def snapshot(self) -> downloadServer_pb2.DownloadReply:
+        """The latest reply, without waiting."""
+        with self._changed:
+            reply = downloadServer_pb2.DownloadReply()
+            reply.CopyFrom(self._reply)
+            return reply
+
+    def wait(self, timeout: float) -> bool:
+        """Wait up to `timeout` seconds for the download to finish, True if it has."""
+        with self._changed:
+            return self._changed.wait_for(lambda: self._done, timeout=timeout)
+
+    def result(self) -> downloadServer_pb2.DownloadReply:
+        """Wait for the download to finish, and return its final reply."""
+        with self._changed:
+            self._changed.wait_for(lambda: self._done)
+            reply = downloadServer_pb2.DownloadReply()
+            reply.CopyFrom(self._reply)
+            return reply
+
+    async def finished(self) -> downloadServer_pb2.DownloadReply:
+        """Like `result`, waiting on the event loop."""
+        await self._wakeups.wait_for(self._changed, lambda: self._done)
+        return self.snapshot()
+
+    def _changed_locked(self) -> None:
+        self._version += 1
+        self._changed.notify_all()
+        self._wakeups.wake()
+
+    def _notify(self) -> None:
+        if self._on_change is not None:
+            self._on_change()
+
+    async def updates(
+        self, interval: float
+    ) -> AsyncIterator[downloadServer_pb2.DownloadReply]:
+        """Yield a snapshot whenever progress changes, at most every `interval` seconds.
+
+        The final reply passed to `finish` is always yielded, straight away.
+        """
+        seen = -1
+        not_before = 0.0
+
+        while True:
+            await self._wakeups.wait_for(
+                self._changed, lambda: self._done or self._version != seen
+            )
+
+            delay = not_before - time.monotonic()
+            if delay > 0:
+                await self._wakeups.wait_for(
+                    self._changed, lambda: self._done, timeout=delay
+                )
+
+            with self._changed:
+                seen = self._version
+                done = self._done
+                snapshot = downloadServer_pb2.DownloadReply()
+                snapshot.CopyFrom(self._reply)
+
+            yield snapshot
+            if done:
+                return
+            not_before = time.monotonic() + interval
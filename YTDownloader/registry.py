@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+import uuid
+from collections.abc import Iterable, Iterator
+from concurrent import futures
+from contextlib import contextmanager
+
+import downloadServer_pb2
+from progress import DownloadProgress
+from scheduler import Ticket
+from wakeups import Wakeups
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """A download running in the background, whoever is waiting for it.
+
+    Jobs are cancelled once every RPC attached to them has ended, by the
+    client going away or its deadline passing, unless something asked to
+    keep them.
+    """
+
+    def __init__(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        ticket: Ticket,
+        progress: DownloadProgress,
+        job_id: str | None = None,
+    ) -> None:
+        self.id = job_id or uuid.uuid4().hex
+        self.request = downloadServer_pb2.DownloadRequest()
+        self.request.CopyFrom(request)
+        self.ticket = ticket
+        self.progress = progress
+        # Left for another server to resume, whatever CANCELLED_DOWNLOADS says
+        self.keep_partials = False
+        # Stopped by the server shutting down, to resume when it is back
+        self.interrupted = False
+
+        self._lock = threading.Lock()
+        self._attached = 0
+        self._kept = False
+
+    @contextmanager
+    def attached(self, executor: futures.Executor | None = None) -> Iterator[None]:
+        """Keep the job running while in this block, such as an RPC waiting for it.
+
+        Cancelling an abandoned job kills its ffmpeg, so an RPC on the event
+        loop passes an `executor` to do that on.
+        """
+        with self._lock:
+            self._attached += 1
+        try:
+            yield
+        finally:
+            self._detach(executor)
+
+    def keep(self) -> None:
+        """Keep the job running whether or not any RPC is attached."""
+        with self._lock:
+            self._kept = True
+
+    def _detach(self, executor: futures.Executor | None) -> None:
+        with self._lock:
+            self._attached -= 1
+            abandoned = self._attached == 0 and not self._kept
+        if abandoned and not self.progress.done:
+            logger.info("Nobody is waiting for %s any more", self.request.VideoUrl)
+            if executor is None:
+                self.cancel()
+            else:
+                executor.submit(self.cancel)
+
+    def cancel(self) -> None:
+        # First, so a queued job woken by its ticket already counts as cancelled
+        self.progress.cancel()
+        self.ticket.cancel()
+
+    def interrupt(self) -> None:
+        """Cancel the job for the server shutting down, leaving it to resume."""
+        self.interrupted = True
+        self.cancel()
+
+    def message(self) -> downloadServer_pb2.Job:
+        request = downloadServer_pb2.DownloadRequest()
+        request.CopyFrom(self.request)
+        # Large, and no use to anyone watching the job
+        request.ClearField("Extraction")
+        return downloadServer_pb2.Job(
+            JobId=self.id, Request=request, Reply=self.progress.snapshot()
+        )
+
+
+class JobRegistry:
+    """Every download job by ID, kept for `retention` seconds after it finishes.
+
+    Clients can start a job, disconnect, and come back for its result later.
+    `version` increases whenever any job changes, so watchers can sleep
+    until there is something new to send.
+    """
+
+    def __init__(self, retention: float) -> None:
+        self.retention = retention
+
+        self._changed = threading.Condition()
+        self._wakeups = Wakeups()
+        self._jobs: dict[str, Job] = {}
+        self._version = 0
+
+    @property
+    def version(self) -> int:
+        with self._changed:
+            return self._version
+
+    def create(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        ticket: Ticket,
+        job_id: str | None = None,
+    ) -> Job:
+        job = Job(request, ticket, DownloadProgress(self._notify), job_id)
+        with self._changed:
+            self._prune()
+            self._jobs[job.id] = job
+            self._version += 1
+            self._changed.notify_all()
+        self._wakeups.wake()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self._changed:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def jobs(self, job_ids: Iterable[str] = ()) -> list[Job]:
+        """The jobs with these IDs that are still kept, or every job if none given."""
+        with self._changed:
+            self._prune()
+            job_ids = list(job_ids)
+            if not job_ids:
+                return list(self._jobs.values())
+            return [self._jobs[i] for i in job_ids if i in self._jobs]
+
+    async def wait(self, seen: int, timeout: float) -> int:
+        """Wait up to `timeout` seconds for a change since version `seen`.
+
+        Passing -1 returns at once, as `version` is never negative.
+        """
+        await self._wakeups.wait_for(
+            self._changed, lambda: self._version != seen, timeout=timeout
+        )
+        return self.version
+
+    def _notify(self) -> None:
+        with self._changed:
+            self._version += 1
+            self._changed.notify_all()
+        self._wakeups.wake()
+
+    def _prune(self) -> None:
+        expired = time.monotonic() - self.retention
+        for job_id, job in list(self._jobs.items()):
+            finished_at = job.progress.finished_at
+            if finished_at is not None and finished_at < expired:
+                del self._jobs[job_id]
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import ctypes
+import logging
+import multiprocessing
+import os
+import platform
+import signal
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from contextlib import contextmanager, nullcontext
+from multiprocessing.connection import Connection
+from multiprocessing.context import SpawnContext
+from multiprocessing.process import BaseProcess
+from typing import Any, Protocol
+
+import downloadServer_pb2
+import jobs
+from jobs import JobHooks
+from options import output_prefix
+
+logger = logging.getLogger(__name__)
+
+# The only hook fields the parent process uses, the rest (notably info_dict) is
+# too big to send for every progress update and is not always picklable
+_HOOK_FIELDS = (
+    "status",
+    "filename",
+    "tmpfilename",
+    "downloaded_bytes",
+    "total_bytes",
+    "total_bytes_estimate",
+    "speed",
+    "eta",
+    "postprocessor",
+)
+
+# ioprio_set(2) has no wrapper in the os module, so it is called by number
+_IOPRIO_SET = {"x86_64": 251, "aarch64": 30}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_SHIFT = 13
+
+
+class DownloadHooks(JobHooks, Protocol):
+    def on_cancel(self, callback: Callable[[], None] | None) -> None: ...
+
+
+@contextmanager
+def _stop_on_cancel(hooks: DownloadHooks, stop: Callable[[], None]) -> Iterator[None]:
+    """Call `stop` if the job is cancelled while in this block, but never after it."""
+    lock = threading.Lock()
+    running = True
+
+    def cancelled() -> None:
+        with lock:
+            if running:
+                stop()
+
+    hooks.on_cancel(cancelled)
+    try:
+        yield
+    finally:
+        with lock:
+            running = False
+        hooks.on_cancel(None)
+
+
+def _kill_children(output_path: str) -> None:
+    """Kill this process's children working on `output_path`, such as ffmpeg.
+
+    Templates like x.%(ext)s match the files they name by the text before
+    their first field. One with nothing before it in the file name would
+    match other jobs' files in the same directory, so nothing is killed.
+    """
+    prefix = output_prefix(output_path)
+    if not os.path.basename(prefix):
+        return
+
+    me = os.getpid()
+    for pid in filter(str.isdigit, os.listdir("/proc")):
+        try:
+            with open(f"/proc/{pid}/stat") as stat:
+                # The command name can contain spaces, so count from its end
+                ppid = int(stat.read().rsplit(")", 1)[1].split()[1])
+            if ppid != me:
+                continue
+            with open(f"/proc/{pid}/cmdline", "rb") as cmdline:
+                if prefix.encode() not in cmdline.read():
+                    continue
+            logger.info("Killing process %s working on %s", pid, output_path)
+            os.kill(int(pid), signal.SIGKILL)
+        except (OSError, IndexError, ValueError):
+            # Processes can exit while being looked at
+            continue
+
+
+def lower_priority(niceness: int, ionice: str) -> None:
+    """Run the calling thread, and whatever it starts, at a lower priority.
+
+    Linux keeps CPU and IO priority for each thread, so the rest of the
+    process is left alone. `ionice` is a class and level as ionice(1) takes
+    them, such as "2:7" for the lowest best-effort priority or "3" for idle,
+    or empty to leave IO priority as it is.
+    """
+    tid = threading.get_native_id()
+    # Raising it back needs privileges, so only ever lower it
+    if niceness > os.getpriority(os.PRIO_PROCESS, tid):
+        os.setpriority(os.PRIO_PROCESS, tid, niceness)
+
+    if not ionice:
+        return
+    syscall = _IOPRIO_SET.get(platform.machine())
+    if syscall is None:
+        logger.warning("Can't set IO priority on %s", platform.machine())
+        return
+    io_class, _, level = ionice.partition(":")
+    priority = int(io_class) << _IOPRIO_CLASS_SHIFT | int(level or 0)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall, _IOPRIO_WHO_PROCESS, tid, priority) != 0:
+        logger.warning("Can't set IO priority: %s", os.strerror(ctypes.get_errno()))
+
+
+class JobRunner(Protocol):
+    def about(
+        self, request: downloadServer_pb2.AboutRequest
+    ) -> downloadServer_pb2.AboutReply: ...
+
+    def list_playlist(
+        self, request: downloadServer_pb2.ListPlaylistRequest
+    ) -> Iterable[downloadServer_pb2.PlaylistEntry]: ...
+
+    def download(
+        self, request: downloadServer_pb2.DownloadRequest, hooks: DownloadHooks
+    ) -> dict[str, Any] | downloadServer_pb2.DownloadReply: ...
+
+    def postprocess(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        info: dict[str, Any],
+        hooks: DownloadHooks,
+    ) -> downloadServer_pb2.DownloadReply: ...
+
+    def recut(
+        self, request: downloadServer_pb2.RecutRequest
+    ) -> downloadServer_pb2.DownloadReply: ...
+
+    def close(self) -> None: ...
+
+
+class ThreadRunner:
+    """Runs jobs on the calling thread, inside the server process."""
+
+    def __init__(self) -> None:
+        jobs.warm_up()
+
+    def about(
+        self, request: downloadServer_pb2.AboutRequest
+    ) -> downloadServer_pb2.AboutReply:
+        return jobs.about(request)
+
+    def list_playlist(
+        self, request: downloadServer_pb2.ListPlaylistRequest
+    ) -> Iterable[downloadServer_pb2.PlaylistEntry]:
+        return jobs.list_playlist(request)
+
+    def download(
+        self, request: downloadServer_pb2.DownloadRequest, hooks: DownloadHooks
+    ) -> dict[str, Any] | downloadServer_pb2.DownloadReply:
+        # The hooks stop yt-dlp itself, but ffmpeg postprocessors never call them
+        with _stop_on_cancel(hooks, lambda: _kill_children(request.OutputPath)):
+            return jobs.download(request, hooks)
+
+    def postprocess(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        info: dict[str, Any],
+        hooks: DownloadHooks,
+    ) -> downloadServer_pb2.DownloadReply:
+        # Downloaded by now, so its files are named after the final filename
+        output_path = request.OutputPath
+        if info.get("filepath"):
+            output_path = f"{os.path.splitext(info['filepath'])[0]}."
+        with _stop_on_cancel(hooks, lambda: _kill_children(output_path)):
+            return jobs.postprocess(request, info, hooks)
+
+    def recut(
+        self, request: downloadServer_pb2.RecutRequest
+    ) -> downloadServer_pb2.DownloadReply:
+        return jobs.recut(request)
+
+    def close(self) -> None:
+        jobs.YDL_POOL.close()
+
+
+class _PipeHooks:
+    def __init__(self, conn: Connection) -> None:
+        self._conn = conn
+
+    def progress_hook(self, d: dict[str, Any]) -> None:
+        self._send("progress", d)
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None:
+        self._send("postprocessor", d)
+
+    def _send(self, kind: str, d: dict[str, Any]) -> None:
+        self._conn.send((kind, {k: d.get(k) for k in _HOOK_FIELDS}, False))
+
+
+def _rss() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _list_playlist(
+    request: downloadServer_pb2.ListPlaylistRequest,
+) -> list[downloadServer_pb2.PlaylistEntry]:
+    return list(jobs.list_playlist(request))
+
+
+def _serve(conn: Connection, max_jobs: int, max_rss: int) -> None:
+    """Worker process main loop, running jobs from the parent until it retires."""
+    # Lead a process group, so cancelling a job can kill its ffmpeg processes too
+    os.setpgrp()
+    hooks = _PipeHooks(conn)
+    jobs.warm_up()
+
+    for done in range(1, max_jobs + 1):
+        try:
+            func, args, with_hooks = conn.recv()
+        except EOFError:
+            break
+
+        try:
+            result = func(*args, hooks) if with_hooks else func(*args)
+            kind = "result"
+        except Exception as e:
+            # Classified here, as yt-dlp's exceptions can't be pickled
+            result, kind = jobs.WorkerError.of(e), "error"
+
+        retire = done == max_jobs or _rss() > max_rss
+        try:
+            conn.send((kind, result, retire))
+        except Exception as e:
+            # Results that can't be pickled still need to reach the parent
+            conn.send(("error", jobs.WorkerError.of(e), retire))
+
+        if retire:
+            break
+
+    jobs.YDL_POOL.close()
+
+
+class _Worker:
+    def __init__(self, ctx: SpawnContext, max_jobs: int, max_rss: int) -> None:
+        self.conn, child_conn = ctx.Pipe()
+        self.process: BaseProcess = ctx.Process(
+            target=_serve, args=(child_conn, max_jobs, max_rss), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+
+    def kill(self) -> None:
+        """Kill the worker and anything it started, part way through a job."""
+        assert self.process.pid is not None
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            self.process.kill()
+
+    def close(self) -> None:
+        self.conn.close()
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class ProcessRunner:
+    """Runs jobs in a pool of worker processes.
+
+    yt-dlp is CPU heavy between network waits, so separate processes let a
+    single downloader use every core. Each worker is replaced after
+    `max_jobs` jobs, or once its RSS passes `max_rss` bytes, so memory held
+    on to by large info dicts is handed back to the OS.
+    """
+
+    def __init__(self, processes: int, max_jobs: int, max_rss: int) -> None:
+        self.processes = processes
+        self.max_jobs = max_jobs
+        self.max_rss = max_rss
+
+        # Forking a process running gRPC's threads is unsafe
+        self._ctx = multiprocessing.get_context("spawn")
+        self._changed = threading.Condition()
+        self._idle: list[_Worker] = []
+        self._live = 0
+
+    def about(
+        self, request: downloadServer_pb2.AboutRequest
+    ) -> downloadServer_pb2.AboutReply:
+        return self._run(jobs.about, (request,), None)
+
+    def list_playlist(
+        self, request: downloadServer_pb2.ListPlaylistRequest
+    ) -> Iterable[downloadServer_pb2.PlaylistEntry]:
+        # Sent back whole, as a worker only sends back one result
+        return self._run(_list_playlist, (request,), None)
+
+    def download(
+        self, request: downloadServer_pb2.DownloadRequest, hooks: DownloadHooks
+    ) -> dict[str, Any] | downloadServer_pb2.DownloadReply:
+        return self._run(jobs.download, (request,), hooks)
+
+    def postprocess(
+        self,
+        request: downloadServer_pb2.DownloadRequest,
+        info: dict[str, Any],
+        hooks: DownloadHooks,
+    ) -> downloadServer_pb2.DownloadReply:
+        return self._run(jobs.postprocess, (request, info), hooks)
+
+    def recut(
+        self, request: downloadServer_pb2.RecutRequest
+    ) -> downloadServer_pb2.DownloadReply:
+        return self._run(jobs.recut, (request,), None)
+
+    def close(self) -> None:
+        with self._changed:
+            idle, self._idle = self._idle, []
+            self._live -= len(idle)
+
+        for worker in idle:
+            worker.close()
+
+    def _run(
+        self,
+        func: Callable[..., Any],
+        args: tuple[Any, ...],
+        hooks: DownloadHooks | None,
+    ) -> Any:
+        worker = self._checkout()
+        retire = True
+        # Killing the worker frees its slot at once, however far the job got
+        cancellation = (
+            _stop_on_cancel(hooks, worker.kill) if hooks is not None else nullcontext()
+        )
+
+        try:
+            worker.conn.send((func, args, hooks is not None))
+            with cancellation:
+                while True:
+                    try:
+                        kind, payload, retiring = worker.conn.recv()
+                    except EOFError:
+                        raise RuntimeError(
+                            f"Worker {worker.process.pid} exited with code "
+                            f"{worker.process.exitcode} while running a job"
+                        ) from None
+
+                    match kind:
+                        case "progress":
+                            assert hooks is not None
+                            hooks.progress_hook(payload)
+                        case "postprocessor":
+                            assert hooks is not None
+                            hooks.postprocessor_hook(payload)
+                        case "error":
+                            retire = retiring
+                            raise payload
+                        case _:
+                            retire = retiring
+                            return payload
+        finally:
+            self._checkin(worker, retire)
+
+    def _checkout(self) -> _Worker:
+        with self._changed:
+            self._changed.wait_for(lambda: self._idle or self._live < self.processes)
+            if self._idle:
+                return self._idle.pop()
+            self._live += 1
+
+        try:
+            return _Worker(self._ctx, self.max_jobs, self.max_rss)
+        except Exception:
+            with self._changed:
+                self._live -= 1
+                self._changed.notify()
+            raise
+
+    def _checkin(self, worker: _Worker, retire: bool) -> None:
+        if retire:
+            logger.info("Retiring worker %s", worker.process.pid)
+            worker.close()
+
+        with self._changed:
+            if retire:
+                self._live -= 1
+            else:
+                self._idle.append(worker)
+            self._changed.notify()
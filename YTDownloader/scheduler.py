@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import Counter, deque
+from types import TracebackType
+
+from extractors import limit_key
+
+
+class SchedulerFull(Exception):
+    pass
+
+
+class TicketCancelled(Exception):
+    pass
+
+
+class Ticket:
+    """A job admitted by the scheduler, holding a slot while used as a context."""
+
+    def __init__(self, scheduler: "DownloadScheduler", key: str) -> None:
+        self.key = key
+        self.cancelled = False
+        self._scheduler = scheduler
+
+    def cancel(self) -> None:
+        """Give up the place in the queue, if the job has not started yet."""
+        self._scheduler._cancel(self)  # pyright: ignore[reportPrivateUsage]
+
+    def __enter__(self) -> "Ticket":
+        self._scheduler._acquire(self)  # pyright: ignore[reportPrivateUsage]
+        return self
+
+    def __exit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc: BaseException | None,
+        tb: TracebackType | None,
+    ) -> None:
+        self._scheduler._release(self)  # pyright: ignore[reportPrivateUsage]
+
+
+class DownloadScheduler:
+    """Limits how many downloads run at once, overall and per extractor/host.
+
+    Requests beyond the limits wait in a bounded FIFO queue; once that is
+    full, `admit` refuses new work straight away instead of letting it pile
+    up behind the gRPC thread pool.
+    """
+
+    def __init__(self, max_active: int, max_per_host: int, max_queued: int) -> None:
+        self.max_active = max_active
+        self.max_per_host = max_per_host
+        self.max_queued = max_queued
+
+        self._changed = threading.Condition()
+        self._waiting: deque[Ticket] = deque()
+        self._active: Counter[str] = Counter()
+
+    @property
+    def active(self) -> int:
+        with self._changed:
+            return self._active.total()
+
+    @property
+    def queued(self) -> int:
+        with self._changed:
+            return len(self._waiting)
+
+    def admit(self, url: str) -> Ticket:
+        key = limit_key(url)
+        with self._changed:
+            if len(self._waiting) >= self.max_queued:
+                raise SchedulerFull(
+                    f"{len(self._waiting)} downloads already queued, try again later"
+                )
+
+            ticket = Ticket(self, key)
+            self._waiting.append(ticket)
+            return ticket
+
+    def _acquire(self, ticket: Ticket) -> None:
+        with self._changed:
+            self._changed.wait_for(
+                lambda: ticket.cancelled or self._next_runnable() is ticket
+            )
+            self._waiting.remove(ticket)
+            if ticket.cancelled:
+                self._changed.notify_all()
+                raise TicketCancelled()
+            self._active[ticket.key] += 1
+            self._changed.notify_all()
+
+    def _cancel(self, ticket: Ticket) -> None:
+        with self._changed:
+            ticket.cancelled = True
+            self._changed.notify_all()
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._changed:
+            self._active[ticket.key] -= 1
+            self._changed.notify_all()
+
+    def _next_runnable(self) -> Ticket | None:
+        if self._active.total() >= self.max_active:
+            return None
+
+        for ticket in self._waiting:
+            if self._active[ticket.key] < self.max_per_host:
+                return ticket
+
+        return None
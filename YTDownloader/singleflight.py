@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections.abc import Callable, Hashable
+from typing import Generic, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class InFlight(Generic[K, V]):
+    """Registry of running jobs, so identical requests share one job.
+
+    The first request for a key starts the job and registers a handle to it,
+    such as a Future or a DownloadProgress. Requests arriving while it runs
+    get the same handle, until the job's owner calls `done`.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._running: dict[K, V] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._running)
+
+    def join_or_start(self, key: K, start: Callable[[], V]) -> tuple[V, bool]:
+        """Return the handle for `key` and whether this call started the job.
+
+        `start` runs under the registry lock, so it should only set the job
+        up, and nothing is registered if it raises.
+        """
+        with self._lock:
+            if key in self._running:
+                return self._running[key], False
+
+            handle = start()
+            self._running[key] = handle
+            return handle, True
+
+    def done(self, key: K) -> None:
+        with self._lock:
+            del self._running[key]
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# pyright: reportPrivateUsage=false
+import hashlib
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from collections.abc import Iterable
+from typing import Any
+
+from extractors import extractor_for
+from yt_dlp.globals import postprocessors
+from yt_dlp.postprocessor.sponsorblock import SponsorBlockPP
+from yt_dlp.utils import PostProcessingError
+
+logger = logging.getLogger(__name__)
+
+# Segment types yt-dlp uses, the same as SponsorBlockPP asks for
+ACTION_TYPES = ("skip", "poi", "chapter")
+# Length of the video ID hash prefix looked up, as the API recommends
+HASH_PREFIX_LENGTH = 4
+
+
+def _hash_prefix(video_id: str) -> str:
+    return hashlib.sha256(video_id.encode("ascii")).hexdigest()[:HASH_PREFIX_LENGTH]
+
+
+def sponsorblock_video(url: str) -> tuple[str, str] | None:
+    """The SponsorBlock service and video ID for `url`, if SponsorBlock covers it."""
+    ie = extractor_for(url)
+    if ie is None:
+        return None
+    service = SponsorBlockPP.EXTRACTORS.get(ie.ie_key())
+    video_id = ie.get_temp_id(url)
+    if service is None or not video_id:
+        return None
+    return service, video_id
+
+
+class SponsorBlockCache:
+    """Caches SponsorBlock segments by video, in memory or in a SQLite file.
+
+    Segments are looked up by hash prefix, so the API never learns which
+    video was asked for, and every video sharing a prefix is fetched in the
+    same request. Videos without segments are cached too, as most have none.
+    Entries are used for `ttl` seconds, and after that only if the API
+    cannot be reached. A file lets worker processes share the cache.
+    """
+
+    # Rows written between sweeps of rows too old to fall back on
+    _PRUNE_EVERY = 100
+    # Seconds stale segments are kept, in case the API is down when needed
+    _KEEP_STALE = 7 * 24 * 3600
+
+    def __init__(
+        self, api: str, ttl: float, path: str | None = None, timeout: float = 10
+    ) -> None:
+        self.api = api.rstrip("/")
+        self.ttl = ttl
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False)
+        self._writes = 0
+        # Worker processes write to the same file as the server
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "service TEXT, video_id TEXT, fetched REAL, segments TEXT, "
+            "PRIMARY KEY (service, video_id))"
+        )
+        self._prune()
+
+    def segments(self, service: str, video_id: str) -> list[dict[str, Any]]:
+        """Every segment of a video, fetching them if not cached recently."""
+        cached = self._load(service, video_id)
+        if cached is not None and time.time() - cached[0] <= self.ttl:
+            return cached[1]
+
+        try:
+            self.prefetch(service, [video_id])
+        except (OSError, ValueError) as e:
+            if cached is None:
+                raise PostProcessingError(
+                    f"Unable to communicate with SponsorBlock API: {e}"
+                ) from e
+            logger.warning("Using stale SponsorBlock segments for %s: %s", video_id, e)
+            return cached[1]
+
+        cached = self._load(service, video_id)
+        assert cached is not None
+        return cached[1]
+
+    def prefetch(self, service: str, video_ids: Iterable[str]) -> None:
+        """Fetch segments for the videos not cached recently, a request per prefix."""
+        expired = time.time() - self.ttl
+        by_prefix: defaultdict[str, set[str]] = defaultdict(set)
+        with self._lock:
+            for video_id in video_ids:
+                row = self._db.execute(
+                    "SELECT fetched FROM segments WHERE service = ? AND video_id = ?",
+                    (service, video_id),
+                ).fetchone()
+                if row is None or row[0] < expired:
+                    by_prefix[_hash_prefix(video_id)].add(video_id)
+
+        for prefix, wanted in by_prefix.items():
+            found = self._fetch(service, prefix)
+            now = time.time()
+            with self._lock, self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?)",
+                    [
+                        (service, video_id, now, json.dumps(found.get(video_id, [])))
+                        for video_id in wanted
+                    ],
+                )
+                self._writes += len(wanted)
+            if self._writes >= self._PRUNE_EVERY:
+                self._prune()
+
+    def close(self) -> None:
+        self._db.close()
+
+    def _fetch(self, service: str, prefix: str) -> dict[str, list[dict[str, Any]]]:
+        url = f"{self.api}/api/skipSegments/{prefix}?" + urllib.parse.urlencode(
+            {
+                "service": service,
+                # Everything, so the cache answers whichever categories a job wants
+                "categories": json.dumps(list(SponsorBlockPP.CATEGORIES)),
+                "actionTypes": json.dumps(ACTION_TYPES),
+            }
+        )
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response:
+                videos = json.load(response)
+        except urllib.error.HTTPError as e:
+            # Not one video with this prefix has segments
+            if e.code == 404:
+                return {}
+            raise
+        return {video["videoID"]: video["segments"] for video in videos}
+
+    def _load(
+        self, service: str, video_id: str
+    ) -> tuple[float, list[dict[str, Any]]] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fetched, segments FROM segments "
+                "WHERE service = ? AND video_id = ?",
+                (service, video_id),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _prune(self) -> None:
+        with self._lock, self._db:
+            self._db.execute(
+                "DELETE FROM segments WHERE fetched < ?",
+                (time.time() - max(self.ttl, self._KEEP_STALE),),
+            )
+            self._writes = 0
+
+
+class SponsorBlockPrefetcher:
+    """Fetches segments for queued downloads in the background, in batches.
+
+    Everything added while a batch is being fetched goes in the next one,
+    so a backfill queueing many videos at once shares requests between
+    those with the same hash prefix, and downloads find their segments
+    cached by the time they start.
+    """
+
+    def __init__(self, cache: SponsorBlockCache) -> None:
+        self.cache = cache
+
+        self._queue: queue.SimpleQueue[tuple[str, str] | None] = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, url: str) -> None:
+        video = sponsorblock_video(url)
+        if video is not None:
+            self._queue.put(video)
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get())
+
+            by_service: defaultdict[str, list[str]] = defaultdict(list)
+            for video in batch:
+                if video is None:
+                    return
+                by_service[video[0]].append(video[1])
+
+            for service, video_ids in by_service.items():
+                try:
+                    self.cache.prefetch(service, video_ids)
+                except (OSError, ValueError) as e:
+                    # Downloads try again themselves, and fall back on stale segments
+                    logger.warning("Prefetching SponsorBlock segments failed: %s", e)
+
+
+class CachedSponsorBlockPP(SponsorBlockPP):
+    """SponsorBlock, looking segments up in `cache` when there is one."""
+
+    # Shared by every job in the process, set up by jobs
+    cache: SponsorBlockCache | None = None
+
+    def _get_sponsor_segments(
+        self, video_id: str, service: str
+    ) -> list[dict[str, Any]]:
+        if self.cache is None:
+            return super()._get_sponsor_segments(video_id, service)
+
+        return [
+            segment
+            for segment in self.cache.segments(service, video_id)
+            if segment["category"] in self._categories
+            and segment["actionType"] in ACTION_TYPES
+        ]
+
+
+# Lets options refer to it by key, the same as yt-dlp's own postprocessors
+postprocessors.value["CachedSponsorBlockPP"] = CachedSponsorBlockPP
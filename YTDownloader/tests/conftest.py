@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Runs the tests against the real server and bench_server.py's stand-in host.
+
+The downloadServer_pb2 modules are generated into a temporary directory
+unless they are already next to main.py, as the Dockerfile leaves them.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+from typing import Any
+
+import pytest
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+BENCHMARKS_DIR = os.path.join(SERVER_DIR, "benchmarks")
+sys.path.insert(0, SERVER_DIR)
+sys.path.insert(0, BENCHMARKS_DIR)
+
+_generated: str | None = None
+
+
+def pytest_configure(config: pytest.Config) -> None:
+    global _generated
+    try:
+        import downloadServer_pb2  # noqa: F401
+    except ImportError:
+        from grpc_tools import protoc
+
+        _generated = tempfile.mkdtemp(prefix="ytdownloader-proto-")
+        status = protoc.main(
+            [
+                "protoc",
+                f"-I{SERVER_DIR}",
+                f"--python_out={_generated}",
+                f"--grpc_python_out={_generated}",
+                os.path.join(SERVER_DIR, "downloadServer.proto"),
+            ]
+        )
+        if status != 0:
+            raise RuntimeError("Can't generate the downloadServer_pb2 modules")
+        sys.path.insert(0, _generated)
+        # For the servers the tests start
+        os.environ["PYTHONPATH"] = os.pathsep.join(
+            filter(None, [_generated, os.environ.get("PYTHONPATH")])
+        )
+
+
+def pytest_unconfigure(config: pytest.Config) -> None:
+    if _generated is not None:
+        shutil.rmtree(_generated, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def media(tmp_path_factory: pytest.TempPathFactory) -> tuple[str, dict[str, Any]]:
+    """A short test video, as bench_server.py's stand-in host serves it."""
+    if shutil.which("ffmpeg") is None:
+        pytest.skip("Needs ffmpeg on the PATH")
+    import bench_server
+
+    directory = str(tmp_path_factory.mktemp("media"))
+    return directory, bench_server._make_media(directory, 4)  # pyright: ignore[reportPrivateUsage]
+
+
+@pytest.fixture(scope="session")
+def origin(media: tuple[str, dict[str, Any]]) -> str:
+    """The stand-in video host, serving the test video."""
+    import bench_server
+
+    return bench_server._start_host(*media, 0)  # pyright: ignore[reportPrivateUsage]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# pyright: reportPrivateUsage=false
+import argparse
+import itertools
+import os
+import signal
+from collections.abc import Iterator
+from concurrent import futures
+from pathlib import Path
+from typing import Any
+
+import bench_server
+import downloadServer_pb2
+import downloadServer_pb2_grpc
+import grpc
+import pytest
+
+# Downloads sent at once, all of them running together
+DOWNLOADS = 12
+
+
+@pytest.fixture(params=["thread", "process"])
+def stub(request: pytest.FixtureRequest, origin: str, tmp_path: Path) -> Iterator[Any]:
+    args = argparse.Namespace(
+        executor=request.param, concurrency=DOWNLOADS, jobs=DOWNLOADS
+    )
+    with open(tmp_path / "server.log", "w") as log:
+        server, address = bench_server._start_server(args, origin, log)
+        try:
+            with grpc.insecure_channel(address) as channel:
+                yield downloadServer_pb2_grpc.YTDownloaderStub(channel)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+
+
+def test_parallel_downloads_land_at_their_own_output_paths(
+    stub: Any, origin: str, tmp_path: Path
+) -> None:
+    kinds = itertools.cycle(("progressive", "dash", "hls"))
+    requests = [
+        downloadServer_pb2.DownloadRequest(
+            VideoUrl=f"{origin}/watch/{kind}/video-{i:02}",
+            OutputPath=str(tmp_path / f"out-{i}" / f"video-{i:02}.%(ext)s"),
+        )
+        for i, kind in zip(range(DOWNLOADS), kinds)
+    ]
+
+    with futures.ThreadPoolExecutor(DOWNLOADS) as pool:
+        replies = list(
+            pool.map(lambda request: stub.Download(request, timeout=300), requests)
+        )
+
+    for i, reply in enumerate(replies):
+        assert reply.Status == downloadServer_pb2.DONE, reply
+        out = tmp_path / f"out-{i}"
+        expected = str(out / f"video-{i:02}.mp4")
+        assert reply.Filename == expected
+        assert reply.Manifest.Media.Path == expected
+        # The file is the video this request asked for, going by the title
+        # embedded in it, not another job's
+        assert f"Server benchmark video-{i:02}".encode() in Path(expected).read_bytes()
+        # And nothing of any other job was written next to it
+        assert all(name.startswith(f"video-{i:02}.") for name in os.listdir(out))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# pyright: reportPrivateUsage=false
+import argparse
+import os
+import signal
+import threading
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import bench_server
+import downloadServer_pb2
+import downloadServer_pb2_grpc
+import grpc
+import pytest
+from progress import DownloadProgress
+from registry import Job
+from scheduler import DownloadScheduler, TicketCancelled
+
+# Jobs waiting behind the one download slot, all cancelled before they start
+QUEUED = 6
+
+# Seconds the slow host waits before each response, keeping the slot busy
+LATENCY = 1
+
+
+@pytest.fixture(scope="module")
+def slow_origin(media: tuple[str, dict[str, Any]]) -> str:
+    return bench_server._start_host(*media, LATENCY)
+
+
+@pytest.fixture(params=["thread", "process"])
+def stub(
+    request: pytest.FixtureRequest, slow_origin: str, tmp_path: Path
+) -> Iterator[Any]:
+    args = argparse.Namespace(executor=request.param, concurrency=1, jobs=QUEUED + 1)
+    with open(tmp_path / "server.log", "w") as log:
+        server, address = bench_server._start_server(args, slow_origin, log)
+        try:
+            with grpc.insecure_channel(address) as channel:
+                yield downloadServer_pb2_grpc.YTDownloaderStub(channel)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+
+
+def test_cancelling_queued_jobs_cancels_them(
+    stub: Any, slow_origin: str, tmp_path: Path
+) -> None:
+    def start(name: str) -> downloadServer_pb2.Job:
+        return stub.StartJob(
+            downloadServer_pb2.DownloadRequest(
+                VideoUrl=f"{slow_origin}/watch/progressive/{name}",
+                OutputPath=str(tmp_path / name / f"{name}.%(ext)s"),
+            )
+        )
+
+    running = start("running")
+    queued = [start(f"queued-{i}") for i in range(QUEUED)]
+    for job in queued:
+        stub.CancelJob(downloadServer_pb2.JobRequest(JobId=job.JobId))
+
+    replies = {
+        job.JobId: job.Reply
+        for job in stub.WatchJobs(
+            downloadServer_pb2.WatchJobsRequest(
+                JobIds=[job.JobId for job in queued], ProgressInterval=0.1
+            ),
+            timeout=60,
+        )
+    }
+    for i, job in enumerate(queued):
+        reply = replies[job.JobId]
+        assert reply.Status == downloadServer_pb2.CANCELLED, reply
+        # They never started, so there is nothing of them on disk
+        assert not os.path.exists(tmp_path / f"queued-{i}")
+
+    # While the job holding the slot carries on
+    reply = stub.GetJob(downloadServer_pb2.JobRequest(JobId=running.JobId)).Reply
+    assert reply.Status in (
+        downloadServer_pb2.STARTING,
+        downloadServer_pb2.IN_PROGRESS,
+        downloadServer_pb2.DONE,
+    )
+
+
+def test_queued_job_is_cancelled_by_the_time_its_ticket_wakes_it(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    url = "https://example.com/video"
+    scheduler = DownloadScheduler(max_active=1, max_per_host=1, max_queued=1)
+    woken = threading.Event()
+    cancelled_when_woken: list[bool] = []
+
+    with scheduler.admit(url):
+        job = Job(
+            downloadServer_pb2.DownloadRequest(VideoUrl=url),
+            scheduler.admit(url),
+            DownloadProgress(lambda: None),
+        )
+
+        def download() -> None:
+            try:
+                with job.ticket:
+                    pass
+            except TicketCancelled:
+                cancelled_when_woken.append(job.progress.cancelled)
+                woken.set()
+
+        thread = threading.Thread(target=download)
+        thread.start()
+        # Gives the queued download every chance to run once its ticket wakes it
+        cancel_ticket = job.ticket.cancel
+        monkeypatch.setattr(
+            job.ticket, "cancel", lambda: (cancel_ticket(), woken.wait(timeout=0.5))
+        )
+        job.cancel()
+        thread.join(timeout=5)
+
+    assert cancelled_when_woken == [True]
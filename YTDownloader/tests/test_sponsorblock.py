@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# pyright: reportPrivateUsage=false
+import itertools
+import json
+import threading
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import pytest
+from sponsorblock import SponsorBlockCache, _hash_prefix
+from yt_dlp.utils import PostProcessingError
+
+SEGMENT = {"segment": [1.0, 2.0], "category": "sponsor", "actionType": "skip"}
+
+
+class _StandInAPI(ThreadingHTTPServer):
+    """SponsorBlock's skipSegments endpoint, answering from `videos`."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.videos: dict[str, list[dict[str, Any]]] = {}
+        self.status = 200
+        self.requests: list[str] = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        api = self.server
+        assert isinstance(api, _StandInAPI)
+        prefix = self.path.split("?")[0].rsplit("/", 1)[-1]
+        api.requests.append(prefix)
+        found = [
+            {"videoID": video_id, "segments": segments}
+            for video_id, segments in api.videos.items()
+            if _hash_prefix(video_id) == prefix
+        ]
+
+        if api.status != 200:
+            self.send_error(api.status)
+        elif not found:
+            # As the API answers when no video with the prefix has segments
+            self.send_error(404)
+        else:
+            body = json.dumps(found).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+def _neighbour(video_id: str) -> str:
+    """Another video ID with the same hash prefix."""
+    prefix = _hash_prefix(video_id)
+    return next(
+        f"{video_id}-{i}"
+        for i in itertools.count()
+        if _hash_prefix(f"{video_id}-{i}") == prefix
+    )
+
+
+@pytest.fixture
+def api() -> Iterator[_StandInAPI]:
+    server = _StandInAPI()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_hit_is_fetched_once(api: _StandInAPI) -> None:
+    api.videos["sponsored"] = [SEGMENT]
+    cache = SponsorBlockCache(api.url, ttl=60)
+
+    assert cache.segments("YouTube", "sponsored") == [SEGMENT]
+    assert cache.segments("YouTube", "sponsored") == [SEGMENT]
+    assert api.requests == [_hash_prefix("sponsored")]
+
+
+def test_miss_shares_the_request_for_its_prefix(api: _StandInAPI) -> None:
+    api.videos["sponsored"] = [SEGMENT]
+    unsponsored = _neighbour("sponsored")
+    cache = SponsorBlockCache(api.url, ttl=60)
+
+    cache.prefetch("YouTube", ["sponsored", unsponsored])
+    assert cache.segments("YouTube", unsponsored) == []
+    assert cache.segments("YouTube", "sponsored") == [SEGMENT]
+    assert api.requests == [_hash_prefix("sponsored")]
+
+
+def test_prefix_without_segments_is_cached(api: _StandInAPI) -> None:
+    cache = SponsorBlockCache(api.url, ttl=60)
+
+    assert cache.segments("YouTube", "unsponsored") == []
+    assert cache.segments("YouTube", "unsponsored") == []
+    assert api.requests == [_hash_prefix("unsponsored")]
+
+
+def test_upstream_error_falls_back_on_stale_segments(api: _StandInAPI) -> None:
+    api.videos["sponsored"] = [SEGMENT]
+    cache = SponsorBlockCache(api.url, ttl=0)
+    assert cache.segments("YouTube", "sponsored") == [SEGMENT]
+
+    api.status = 500
+    assert cache.segments("YouTube", "sponsored") == [SEGMENT]
+    assert len(api.requests) == 2
+
+    with pytest.raises(PostProcessingError, match="SponsorBlock API"):
+        cache.segments("YouTube", "never-fetched")
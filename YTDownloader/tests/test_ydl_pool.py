@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# pyright: reportPrivateUsage=false
+from pathlib import Path
+from typing import Any
+
+import pytest
+import ydl_pool
+from options import JobOptions
+from ydl_pool import YoutubeDLPool
+
+
+class _Recorder:
+    def __init__(self) -> None:
+        self.filenames: set[str] = set()
+
+    def progress_hook(self, d: dict[str, Any]) -> None:
+        self.filenames.add(d["filename"])
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None:
+        pass
+
+
+def _options(output_path: Path, format_id: str) -> JobOptions:
+    return JobOptions(
+        {
+            "quiet": True,
+            "noprogress": True,
+            "format": format_id,
+            "outtmpl": {"default": str(output_path)},
+        }
+    )
+
+
+def test_jobs_on_one_instance_keep_their_own_options_and_hooks(
+    origin: str, tmp_path: Path
+) -> None:
+    pool = YoutubeDLPool(1)
+    jobs = [
+        (tmp_path / "first.%(ext)s", "video", _Recorder()),
+        (tmp_path / "second.%(ext)s", "audio", _Recorder()),
+    ]
+    used = []
+
+    for output_path, format_id, hooks in jobs:
+        with pool.checkout(_options(output_path, format_id), hooks) as ydl:
+            used.append(ydl)
+            info = ydl.extract_info(f"{origin}/watch/progressive/{format_id}")
+            assert info is not None
+            assert info["format_id"] == format_id
+            assert ydl.reported_error is None
+
+    assert used[0] is used[1]
+    first, second = (hooks.filenames for _, _, hooks in jobs)
+    assert first == {str(tmp_path / "first.mp4")}
+    assert second == {str(tmp_path / "second.m4a")}
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["first.mp4", "second.m4a"]
+    pool.close()
+
+
+def test_instances_missing_job_state_are_not_pooled(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(ydl_pool, "_JOB_RECORDS", ("_renamed_by_an_upgrade",))
+    pool = YoutubeDLPool(1)
+    options = _options(tmp_path / "%(id)s.%(ext)s", "video")
+
+    with pool.checkout(options) as first:
+        pass
+    with pool.checkout(options) as second:
+        pass
+
+    assert first is not second
+    assert pool._idle_count == 0
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import logging
+import os
+import pstats
+import time
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from typing import Any
+
+import downloadServer_pb2
+from ydl_pool import JobHooks
+
+logger = logging.getLogger(__name__)
+
+# Phases in the order they started, with how long each took in seconds
+Timings = list[tuple[str, float]]
+
+
+class PhaseTimer:
+    """Times a job's phases from its yt-dlp hooks, passing them on to `hooks`.
+
+    Times `phase` from the start, and the phases `options.PHASE_MARKERS`
+    marks after it. Each postprocessor is a phase of its own, taken out of
+    the time of the phase it ran in. Downloads are timed per file, and
+    fragmented ones in batches of `fragment_batch` fragments.
+    """
+
+    def __init__(self, hooks: JobHooks | None, fragment_batch: int, phase: str) -> None:
+        self._hooks = hooks
+        self._fragment_batch = fragment_batch
+        self._timings: Timings = []
+        # Phases under way, postprocessors above the phase they interrupted,
+        # and when the one on top started or carried on
+        self._open = [phase]
+        self._since = time.monotonic()
+        # The file and batch being downloaded, and the phase to go back to
+        self._download: tuple[str, int] | None = None
+        self._resume = phase
+
+    def mark(self, phase: str) -> None:
+        """End the current phase, and start `phase`."""
+        self._switch()
+        self._open[-1:] = [phase]
+
+    def timings(self) -> Timings:
+        """Time spent in each phase so far, those run more than once added up."""
+        timings = self._timings
+        if self._open:
+            timings = timings + [(self._open[-1], time.monotonic() - self._since)]
+
+        totals: dict[str, float] = {}
+        for phase, seconds in timings:
+            totals[phase] = totals.get(phase, 0.0) + seconds
+        return list(totals.items())
+
+    def progress_hook(self, d: dict[str, Any]) -> None:
+        if d["status"] == "downloading":
+            self._downloading(d)
+        elif d["status"] == "finished" and self._download is not None:
+            self._download = None
+            self.mark(self._resume)
+        if self._hooks is not None:
+            self._hooks.progress_hook(d)
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None:
+        if d["postprocessor"] == "PhaseMark":
+            if d["status"] == "started":
+                self.mark(d["phase"])
+            return
+
+        if d["status"] == "started":
+            self._switch()
+            self._open.append(d["postprocessor"])
+        elif d["status"] == "finished":
+            self._switch()
+            self._open.pop()
+        if self._hooks is not None:
+            self._hooks.postprocessor_hook(d)
+
+    def _downloading(self, d: dict[str, Any]) -> None:
+        filename = d.get("tmpfilename") or d.get("filename") or ""
+        format_id = (d.get("info_dict") or {}).get("format_id") or filename
+        index = d.get("fragment_index")
+        if index is None:
+            batch = 0
+            phase = f"download {format_id}"
+        else:
+            # Counted from 1, or 0 before the first fragment
+            batch = max(index - 1, 0) // self._fragment_batch
+            first = batch * self._fragment_batch + 1
+            last = first + self._fragment_batch - 1
+            count = d.get("fragment_count")
+            if count is not None:
+                last = min(last, count)
+            phase = f"download {format_id} fragments {first}-{last}"
+
+        if self._download != (filename, batch):
+            if self._download is None:
+                self._resume = self._open[-1]
+            self._download = (filename, batch)
+            self.mark(phase)
+
+    def _switch(self) -> None:
+        """Add the time since the last change to the phase on top."""
+        now = time.monotonic()
+        if self._open:
+            self._timings.append((self._open[-1], now - self._since))
+        self._since = now
+
+
+def timing_messages(
+    timings: Iterable[tuple[str, float]],
+) -> list[downloadServer_pb2.PhaseTiming]:
+    return [
+        downloadServer_pb2.PhaseTiming(Phase=phase, Seconds=seconds)
+        for phase, seconds in timings
+    ]
+
+
+@contextmanager
+def profiled(path: str | None, append: bool = False) -> Iterator[None]:
+    """Write a cProfile of the block to `path`, adding to it with `append`.
+
+    Only one profile can run at a time, and it sees every thread, so jobs
+    are best profiled with JOB_EXECUTOR=process.
+    """
+    if path is None:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        logger.warning("Not profiling to %s: %s", path, e)
+        yield
+        return
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        stats = pstats.Stats(profiler)
+        if append and os.path.exists(path):
+            stats.add(path)
+        stats.dump_stats(path)
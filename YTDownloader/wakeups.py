@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import threading
+from collections.abc import Callable
+
+
+class Wakeups:
+    """Lets coroutines wait for changes that threads make under a Condition.
+
+    The threads call `wake` after every change, which is safe from any
+    thread and never blocks on the event loop.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._waiting: dict[asyncio.Event, asyncio.AbstractEventLoop] = {}
+
+    def wake(self) -> None:
+        with self._lock:
+            waiting = list(self._waiting.items())
+        for event, loop in waiting:
+            loop.call_soon_threadsafe(event.set)
+
+    async def wait_for(
+        self,
+        condition: threading.Condition,
+        predicate: Callable[[], bool],
+        timeout: float | None = None,
+    ) -> bool:
+        """Like `condition.wait_for`, without holding up the event loop."""
+        event = asyncio.Event()
+        with self._lock:
+            self._waiting[event] = asyncio.get_running_loop()
+        try:
+            async with asyncio.timeout(timeout):
+                while True:
+                    # Cleared before checking, so a change in between sets it again
+                    event.clear()
+                    with condition:
+                        if predicate():
+                            return True
+                    await event.wait()
+        except TimeoutError:
+            with condition:
+                return predicate()
+        finally:
+            with self._lock:
+                del self._waiting[event]
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+import copy
+import json
+import logging
+import sys
+import threading
+from collections import OrderedDict
+from collections.abc import Iterator
+from contextlib import contextmanager
+from typing import Any, Protocol
+
+import yt_dlp
+from options import JobOptions
+from yt_dlp.utils import DownloadError, YoutubeDLError
+
+# Options that differ for every job, and are swapped into a pooled instance
+# rather than making it unusable for the next job
+PER_JOB_PARAMS = ("format", "outtmpl")
+
+# YoutubeDL's private per-job counters and records, reset between jobs. An
+# instance missing any, as after a yt-dlp upgrade renames them, is used for one
+# job and closed rather than risk the next job inheriting its state.
+_JOB_COUNTERS = (
+    "_download_retcode",
+    "_num_downloads",
+    "_num_videos",
+    "_playlist_level",
+)
+_JOB_RECORDS = ("_playlist_urls", "_printed_messages")
+_JOB_METHODS = ("_parse_outtmpl",)
+
+logger = logging.getLogger(__name__)
+
+
+class JobHooks(Protocol):
+    def progress_hook(self, d: dict[str, Any]) -> None: ...
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None: ...
+
+
+class _NoHooks:
+    def progress_hook(self, d: dict[str, Any]) -> None:
+        pass
+
+    def postprocessor_hook(self, d: dict[str, Any]) -> None:
+        pass
+
+
+class PooledYoutubeDL(yt_dlp.YoutubeDL):
+    """A YoutubeDL that remembers the last error it reported for the job.
+
+    With ignoreerrors set, yt-dlp reports errors without raising them, and
+    only the exit code says anything went wrong.
+    """
+
+    reported_error: BaseException | None = None
+
+    def trouble(
+        self, message: str | None = None, tb: Any = None, is_error: bool = True
+    ) -> None:
+        if is_error:
+            # Reported from the except block handling it, if there is one
+            self.reported_error = sys.exc_info()[1] or DownloadError(message or "")
+        super().trouble(message, tb, is_error)
+
+
+class _Slot:
+    """A YoutubeDL instance, with hooks forwarding to whichever job has it."""
+
+    def __init__(self, key: str, options: JobOptions) -> None:
+        self.key = key
+        self.hooks: JobHooks = _NoHooks()
+        self.ydl = PooledYoutubeDL(options.ydl_params())
+        self.ydl.add_progress_hook(lambda d: self.hooks.progress_hook(d))
+        self.ydl.add_postprocessor_hook(lambda d: self.hooks.postprocessor_hook(d))
+        self.reusable = all(
+            hasattr(self.ydl, name)
+            for name in _JOB_COUNTERS + _JOB_RECORDS + _JOB_METHODS
+        )
+
+    def prepare(self, options: JobOptions, hooks: JobHooks) -> None:
+        self.hooks = hooks
+        if not self.reusable:
+            # Built for this job, so already has its options
+            return
+
+        ydl = self.ydl
+        for param in PER_JOB_PARAMS:
+            if param in options.params:
+                ydl.params[param] = copy.deepcopy(options.params[param])
+        getattr(ydl, "_parse_outtmpl")()
+        # YoutubeDL only parses the format spec when it is built
+        format_spec = ydl.params.get("format")
+        if isinstance(format_spec, str) and format_spec != "-":
+            ydl.format_selector = ydl.build_format_selector(format_spec)
+
+    def reset(self) -> None:
+        ydl = self.ydl
+        for name in _JOB_COUNTERS:
+            setattr(ydl, name, 0)
+        for name in _JOB_RECORDS:
+            getattr(ydl, name).clear()
+        ydl.reported_error = None
+        self.hooks = _NoHooks()
+
+
+def _fingerprint(options: JobOptions) -> str:
+    shared = {k: v for k, v in options.params.items() if k not in PER_JOB_PARAMS}
+    return json.dumps(
+        shared,
+        sort_keys=True,
+        default=lambda o: sorted(o) if isinstance(o, (set, frozenset)) else repr(o),
+    )
+
+
+class YoutubeDLPool:
+    """Reuses YoutubeDL instances between jobs with the same options.
+
+    Building a YoutubeDL processes every option, sets up the cookie jar and
+    networking, and starts each extractor with an empty player JS cache.
+    Instances are checked out for one job at a time, reset afterwards, and
+    kept while idle up to `max_idle`, dropping the least recently used.
+    """
+
+    def __init__(self, max_idle: int) -> None:
+        self.max_idle = max_idle
+
+        self._lock = threading.Lock()
+        self._idle: OrderedDict[str, list[_Slot]] = OrderedDict()
+        self._idle_count = 0
+        self._warned = False
+
+    @contextmanager
+    def checkout(
+        self, options: JobOptions, hooks: JobHooks | None = None
+    ) -> Iterator[PooledYoutubeDL]:
+        key = _fingerprint(options)
+        slot = self._take(key) or _Slot(key, options)
+        slot.prepare(options, hooks or _NoHooks())
+
+        try:
+            yield slot.ydl
+        except YoutubeDLError:
+            self._give_back(slot)
+            raise
+        except BaseException:
+            # Anything else may have left the instance half way through a job
+            slot.ydl.close()
+            raise
+        else:
+            self._give_back(slot)
+
+    def warm(self, options: JobOptions) -> None:
+        """Build an instance for `options` ahead of the first job needing it."""
+        self._give_back(_Slot(_fingerprint(options), options))
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, OrderedDict()
+            self._idle_count = 0
+
+        for slots in idle.values():
+            for slot in slots:
+                slot.ydl.close()
+
+    def _take(self, key: str) -> _Slot | None:
+        with self._lock:
+            slots = self._idle.get(key)
+            if not slots:
+                return None
+
+            self._idle_count -= 1
+            slot = slots.pop()
+            # Eviction takes from the first key, so it must never be left empty
+            if slots:
+                self._idle.move_to_end(key)
+            else:
+                del self._idle[key]
+            return slot
+
+    def _give_back(self, slot: _Slot) -> None:
+        if not slot.reusable:
+            if not self._warned:
+                self._warned = True
+                logger.warning("Can't reset this yt-dlp between jobs, not pooling it")
+            slot.ydl.close()
+            return
+
+        slot.reset()
+        evicted: list[_Slot] = []
+
+        with self._lock:
+            self._idle.setdefault(slot.key, []).append(slot)
+            self._idle.move_to_end(slot.key)
+            self._idle_count += 1
+
+            while self._idle_count > self.max_idle:
+                key, slots = next(iter(self._idle.items()))
+                evicted.append(slots.pop(0))
+                self._idle_count -= 1
+                if not slots:
+                    del self._idle[key]
+
+        for old in evicted:
+            old.ydl.close()